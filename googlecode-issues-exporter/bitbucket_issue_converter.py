@@ -87,13 +87,14 @@ class IssueService(issues.IssueService):
     self._bitbucket_issues = []
     self._bitbucket_comments = []
 
-  def GetIssues(self, state="open"):
+  def GetIssues(self, state="open", fields=None):
     """Gets all of the issue for the repository.
 
     Since BitBucket does not have an issue API, always returns an empty list.
 
     Args:
       state: The state of the repository can be either 'open' or 'closed'.
+      fields: Ignored.
 
     Returns:
       An empty list.
@@ -169,7 +170,7 @@ class IssueService(issues.IssueService):
 
 
 def ExportIssues(issue_file_path, project_name,
-                 user_file_path, default_issue_kind):
+                 user_file_path, default_issue_kind, issue_filter=None):
   """Exports all issues for a given project.
   """
   issue_service = IssueService()
@@ -179,7 +180,8 @@ def ExportIssues(issue_file_path, project_name,
   user_map = issues.LoadUserData(user_file_path, user_service)
 
   issue_exporter = issues.IssueExporter(
-      issue_service, user_service, issue_data, project_name, user_map)
+      issue_service, user_service, issue_data, project_name, user_map,
+      issue_filter=issue_filter)
 
   try:
     issue_exporter.Init()
@@ -215,6 +217,7 @@ def main(args):
                       help="A non-null string containing one of the following"
                       "values: bug, enhancement, proposal, task. Defaults to"
                       "bug")
+  issues.AddIssueFilterArguments(parser)
   parsed_args, _ = parser.parse_known_args(args)
 
   # Default value.
@@ -224,7 +227,8 @@ def main(args):
 
   ExportIssues(
     parsed_args.issue_file_path, parsed_args.project_name,
-    parsed_args.user_file_path, parsed_args.default_issue_kind)
+    parsed_args.user_file_path, parsed_args.default_issue_kind,
+    issues.IssueFilterFromArguments(parsed_args))
 
 
 if __name__ == "__main__":
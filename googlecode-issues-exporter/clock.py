@@ -0,0 +1,63 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Clocks used for all time keeping and sleeping during an export.
+
+Services take a clock instance rather than calling the time module directly,
+so that an export can be simulated against a VirtualClock without sleeping.
+"""
+
+import threading
+import time
+
+
+class Clock(object):
+  """The real wall clock."""
+
+  def Now(self):
+    """Returns the current time in seconds since the epoch."""
+    return time.time()
+
+  def Sleep(self, seconds):
+    """Sleeps for the given number of seconds."""
+    time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+  """A clock which only advances when asked to.
+
+  Sleeping returns immediately, moving the clock forward instead.
+  """
+
+  def __init__(self, start_time=0.0):
+    """Initialize the VirtualClock.
+
+    Args:
+      start_time: The initial time in seconds since the epoch.
+    """
+    self._now = float(start_time)
+    self._lock = threading.Lock()
+
+  def Now(self):
+    """Returns the current virtual time."""
+    return self._now
+
+  def Sleep(self, seconds):
+    """Advances the virtual time by the given number of seconds."""
+    self.Advance(seconds)
+
+  def Advance(self, seconds):
+    """Advances the virtual time by the given number of seconds."""
+    with self._lock:
+      self._now += max(0.0, seconds)
@@ -0,0 +1,47 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the clocks."""
+
+# pylint: disable=missing-docstring,protected-access
+
+import unittest
+
+import clock
+import github_services
+
+
+class TestVirtualClock(unittest.TestCase):
+
+  def testSleepAdvances(self):
+    virtual_clock = clock.VirtualClock(100)
+    virtual_clock.Sleep(5)
+    virtual_clock.Advance(0.5)
+    virtual_clock.Sleep(-1)
+    self.assertEqual(105.5, virtual_clock.Now())
+
+  def testServiceSleepsOnClock(self):
+    virtual_clock = clock.VirtualClock(100)
+    github_service = github_services.GitHubService(
+        "owner", "repo", "token", False,
+        http_instance=github_services.Http2Mock(),
+        clock_instance=virtual_clock)
+    github_service._WaitForRateLimit({"x-ratelimit-reset": "160"})
+    self.assertEqual(161, virtual_clock.Now())
+    self.assertEqual(61, github_service.metrics.sleep_seconds["rate_limit"])
+    self.assertEqual(61, github_service.metrics.GetElapsedSeconds())
+
+
+if __name__ == "__main__":
+  unittest.main(buffer=True)
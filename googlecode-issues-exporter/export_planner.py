@@ -0,0 +1,500 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tool for estimating how long a GitHub issue export will take.
+
+  Reads a Google Takeout dump and runs the real issue exporter against a
+  simulated GitHub, on a virtual clock so nothing actually sleeps. Reports the
+  API calls the export will make, the expected duration under GitHub's rate
+  limits, and how many comment workers (see --comment_workers of
+  github_issue_converter.py) are worth using.
+"""
+
+import argparse
+import collections
+import contextlib
+import heapq
+import json
+import math
+import sys
+import StringIO
+import time
+import urlparse
+
+import httplib2
+
+import clock
+import github_services
+import issues
+import metrics
+
+
+# Simulated GitHub latency per request, in seconds.
+DEFAULT_LATENCY = 0.3
+# GitHub's hourly request limit for authenticated users.
+DEFAULT_HOURLY_LIMIT = 5000
+# The number of issue and comment writes per minute GitHub tolerates before
+# its abuse detection kicks in. Undocumented, so this is a guess.
+DEFAULT_ABUSE_LIMIT = 20
+# The largest number of comment workers to consider.
+DEFAULT_MAX_WORKERS = 16
+# A worker count is recommended if it is within this fraction of the best.
+RECOMMENDATION_SLACK = 0.05
+
+
+class SimulatedGitHubHttp(object):
+  """An in-memory GitHub repository served through the httplib2 interface.
+
+  Every request takes 'latency' seconds of virtual time. Requests beyond the
+  hourly limit and writes beyond the abuse limit are rejected the way GitHub
+  rejects them, so the exporter's rate limit handling is exercised as well.
+
+  Attributes:
+    calls: Counter of requests made, by kind (e.g. 'POST comment').
+    rejected: The number of requests rejected by a rate limit.
+  """
+
+  def __init__(self, clock_instance, latency=DEFAULT_LATENCY,
+               hourly_limit=DEFAULT_HOURLY_LIMIT,
+               abuse_limit_per_minute=DEFAULT_ABUSE_LIMIT):
+    """Initialize the SimulatedGitHubHttp.
+
+    Args:
+      clock_instance: The clock.VirtualClock to advance.
+      latency: The time in seconds every request takes.
+      hourly_limit: The number of requests allowed per hour, 0 for no limit.
+      abuse_limit_per_minute: The number of writes allowed per minute, 0 for
+          no limit.
+    """
+    self._clock = clock_instance
+    self._latency = latency
+    self._hourly_limit = hourly_limit
+    self._abuse_limit = abuse_limit_per_minute
+    self._issues = []
+    self._comments = {}
+    self._next_comment_id = 1
+    self._window_reset = None
+    self._window_requests = 0
+    self._recent_writes = collections.deque()
+    self.calls = collections.Counter()
+    self.rejected = 0
+
+  def request(self, url, method, headers=None, body=None):
+    """Serves a request to the simulated repository.
+
+    Args:
+      url: The url to make the call to.
+      method: The type of call. POST, GET, etc.
+      headers: The HTTP headers for the request.
+      body: The request of the body.
+
+    Returns:
+      A tuple of a response and its content.
+    """
+    self._clock.Advance(self._latency)
+    now = self._clock.Now()
+    parsed_url = urlparse.urlparse(url)
+    path = parsed_url.path.split("/")
+    params = dict(urlparse.parse_qsl(parsed_url.query))
+
+    if self._window_reset is None or now >= self._window_reset:
+      self._window_reset = now + 3600
+      self._window_requests = 0
+    if path[1] == "rate_limit":
+      remaining = (max(0, self._hourly_limit - self._window_requests)
+                   if self._hourly_limit else 1)
+      return self._Respond(200, {"rate": {"remaining": remaining}})
+
+    if self._hourly_limit and self._window_requests >= self._hourly_limit:
+      self.rejected += 1
+      return self._Respond(403, {"message": "API rate limit exceeded"}, {
+          "x-ratelimit-remaining": "0",
+          "x-ratelimit-reset": str(int(math.ceil(self._window_reset))),
+      })
+    self._window_requests += 1
+
+    if method != "GET" and self._abuse_limit:
+      while self._recent_writes and self._recent_writes[0] <= now - 60:
+        self._recent_writes.popleft()
+      if len(self._recent_writes) >= self._abuse_limit:
+        self.rejected += 1
+        retry_after = int(math.ceil(self._recent_writes[0] + 60 - now))
+        return self._Respond(403, {"message": "abuse detection"},
+                             {"retry-after": str(max(1, retry_after))})
+      self._recent_writes.append(now)
+
+    # Paths look like /repos/<owner>/<repo>/issues[/<number>[/comments]] or
+    # /repos/<owner>/<repo>/issues/comments/<id>.
+    resource = path[5:]
+    request_body = json.loads(body) if body else {}
+    if method == "GET" and not resource:
+      self.calls["GET issues"] += 1
+      return self._Respond(200, self._ListIssues(params))
+    if method == "GET":
+      self.calls["GET comments"] += 1
+      return self._Respond(200, self._Page(
+          self._comments[int(resource[0])], params))
+    if method == "POST" and not resource:
+      self.calls["POST issue"] += 1
+      issue = {
+          "number": len(self._issues) + 1,
+          "title": request_body["title"],
+          "body": request_body["body"],
+          "state": "open",
+          "comments": 0,
+      }
+      self._issues.append(issue)
+      self._comments[issue["number"]] = []
+      return self._Respond(201, issue)
+    if method == "POST" and resource[0] == "comments":
+      self.calls["POST comment edit"] += 1
+      return self._Respond(200, {"id": int(resource[1])})
+    if method == "POST":
+      self.calls["POST comment"] += 1
+      issue_number = int(resource[0])
+      comment = {
+          "id": self._next_comment_id,
+          "body": request_body["body"],
+          "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                      time.gmtime(now)),
+      }
+      self._next_comment_id += 1
+      self._comments[issue_number].append(comment)
+      self._issues[issue_number - 1]["comments"] += 1
+      return self._Respond(201, comment)
+    issue = self._issues[int(resource[0]) - 1]
+    if request_body.keys() == ["state"]:
+      self.calls["PATCH issue close"] += 1
+    else:
+      self.calls["PATCH issue edit"] += 1
+    issue.update(request_body)
+    return self._Respond(200, issue)
+
+  def _ListIssues(self, params):
+    """Returns a page of issues filtered by state, as GitHub would."""
+    state = params.get("state", "open")
+    matching = [issue for issue in self._issues
+                if state == "all" or issue["state"] == state]
+    if params.get("direction") == "desc":
+      matching.reverse()
+    return self._Page(matching, params)
+
+  def _Page(self, items, params):
+    """Returns the requested page of a list."""
+    per_page = int(params.get("per_page", 30))
+    page = max(1, int(params.get("page", 1)))
+    return items[(page - 1) * per_page:page * per_page]
+
+  def _Respond(self, status, content, headers=None):
+    """Returns an httplib2 response and its JSON encoded content."""
+    info = {"status": str(status)}
+    info.update(headers or {})
+    return httplib2.Response(info), json.dumps(content)
+
+
+class _TimingCommentScheduler(object):
+  """Stands in for issues.CommentScheduler, timing each issue's comments.
+
+  Comments are posted right away, on the exporter's thread, and the virtual
+  time they took is recorded so that the schedule of a real CommentScheduler
+  can be replayed later for any number of workers, see _SimulateWorkers.
+
+  Attributes:
+    jobs: A list of (ready time, seconds) tuples, one per scheduled issue. The
+        ready time is when the exporter scheduled the issue, not counting the
+        time spent posting comments of earlier issues.
+  """
+
+  def __init__(self, issue_service, clock_instance):
+    self._issue_service = issue_service
+    self._clock = clock_instance
+    self._comment_seconds = 0.0
+    self.jobs = []
+
+  def Schedule(self, issue_number, googlecode_comments, close_issue=False):
+    start = self._clock.Now()
+    for googlecode_comment in googlecode_comments:
+      self._issue_service.CreateComment(issue_number, googlecode_comment)
+    if close_issue:
+      self._issue_service.CloseIssue(issue_number)
+    seconds = self._clock.Now() - start
+    self.jobs.append((start - self._comment_seconds, seconds))
+    self._comment_seconds += seconds
+
+  def GetExporterSeconds(self):
+    """Returns the virtual time spent outside of posting comments."""
+    return self._clock.Now() - self._comment_seconds
+
+  def Wait(self):
+    pass
+
+  def Close(self):
+    pass
+
+
+def _SimulateWorkers(jobs, start_time, end_time, workers):
+  """Replays a CommentScheduler schedule with the given number of workers.
+
+  The exporter hands issues to the scheduler in order, blocking while the
+  scheduler's queue is full, and each issue's comments are posted by the
+  first free worker.
+
+  Args:
+    jobs: The (ready time, seconds) tuples recorded by _TimingCommentScheduler.
+    start_time: When the export started.
+    end_time: When the exporter would have finished, had it not had to post
+        any comments.
+    workers: The number of workers.
+
+  Returns:
+    The number of seconds the export takes.
+  """
+  max_pending = workers * 2
+  free_workers = [start_time] * workers
+  starts = []
+  delay = 0.0
+  finish = end_time
+  for idx, (ready_time, seconds) in enumerate(jobs):
+    queued_time = ready_time + delay
+    if idx >= max_pending:
+      queued_time = max(queued_time, starts[idx - max_pending])
+    delay = queued_time - ready_time
+    job_start = max(queued_time, heapq.heappop(free_workers))
+    starts.append(job_start)
+    heapq.heappush(free_workers, job_start + seconds)
+    finish = max(finish, job_start + seconds)
+  return max(finish, end_time + delay) - start_time
+
+
+@contextlib.contextmanager
+def _SuppressOutput():
+  """Hides the exporter's progress output."""
+  stdout = sys.stdout
+  sys.stdout = StringIO.StringIO()
+  try:
+    yield
+  finally:
+    sys.stdout = stdout
+
+
+def _RunExport(issue_json_data, project_name, rewrite_comments, rate_limit,
+               comment_delay, http_instance, clock_instance,
+               comment_scheduler_factory=None):
+  """Runs the exporter against a simulated GitHub.
+
+  Args:
+    issue_json_data: The Google Code issues, as loaded by LoadIssueData.
+    project_name: The name of the Google Code project.
+    rewrite_comments: Whether to run a second pass rewriting the comments.
+    rate_limit: Whether to add the --rate_limit delay to writes.
+    comment_delay: The delay between comments.
+    http_instance: The SimulatedGitHubHttp instance to use.
+    clock_instance: The clock.VirtualClock to use.
+    comment_scheduler_factory: Optional function from an issue service to the
+        comment scheduler to use.
+
+  Returns:
+    The metrics.ExportMetrics of the run.
+  """
+  export_metrics = metrics.ExportMetrics(clock=clock_instance.Now)
+  github_service = github_services.GitHubService(
+      "owner", "repo", "token", rate_limit, http_instance=http_instance,
+      metrics_instance=export_metrics, clock_instance=clock_instance)
+  issue_service = github_services.IssueService(github_service, comment_delay)
+  comment_scheduler = (comment_scheduler_factory(issue_service)
+                       if comment_scheduler_factory else None)
+  user_service = github_services.UserService(github_service)
+  user_map = issues.IdentityDict()
+  user_map["user_requesting_export"] = "owner"
+
+  with _SuppressOutput():
+    # Comments can only be rewritten once all issues have been exported.
+    for rewrite in ([False, True] if rewrite_comments else [False]):
+      issue_exporter = issues.IssueExporter(
+          issue_service, user_service, issue_json_data, project_name,
+          user_map, metrics_instance=export_metrics,
+          comment_scheduler=comment_scheduler)
+      issue_exporter.Init(rewrite)
+      issue_exporter.Start(rewrite)
+  return export_metrics
+
+
+def PlanExport(issue_json_data, project_name, rewrite_comments=False,
+               rate_limit=False, latency=DEFAULT_LATENCY,
+               hourly_limit=DEFAULT_HOURLY_LIMIT,
+               abuse_limit_per_minute=DEFAULT_ABUSE_LIMIT,
+               comment_delay=github_services.COMMENT_DELAY,
+               max_workers=DEFAULT_MAX_WORKERS):
+  """Estimates the cost of exporting issues to a new GitHub repository.
+
+  The export is simulated twice. Once as github_issue_converter.py runs by
+  default, with the rate limits in effect, giving the exact API calls and the
+  expected duration. And once without rate limits, posting comments through a
+  timing scheduler, to estimate the duration with comment workers. That
+  estimate is bounded below by the time the rate limits allow the calls to
+  take.
+
+  Args:
+    issue_json_data: The Google Code issues, as loaded by LoadIssueData.
+    project_name: The name of the Google Code project.
+    rewrite_comments: Whether the comments will be rewritten in a second pass.
+    rate_limit: Whether the export will be run with --rate_limit.
+    latency: The expected time in seconds of a GitHub request.
+    hourly_limit: GitHub's hourly request limit, 0 for none.
+    abuse_limit_per_minute: GitHub's assumed limit on writes per minute, 0
+        for none.
+    comment_delay: The delay between comments without comment workers.
+    max_workers: The largest number of comment workers to consider.
+
+  Returns:
+    A dictionary with the API calls by kind ('api_calls'), the calls rejected
+    by rate limits ('rejected_calls'), the seconds spent sleeping by reason
+    ('sleep_seconds'), the duration without comment workers
+    ('sequential_seconds'), a list of (workers, seconds) estimates
+    ('concurrent_seconds') and the recommended number of workers
+    ('recommended_workers').
+  """
+  virtual_clock = clock.VirtualClock()
+  http_instance = SimulatedGitHubHttp(
+      virtual_clock, latency, hourly_limit, abuse_limit_per_minute)
+  export_metrics = _RunExport(
+      issue_json_data, project_name, rewrite_comments, rate_limit,
+      comment_delay, http_instance, virtual_clock)
+
+  timing_clock = clock.VirtualClock()
+  timing_http = SimulatedGitHubHttp(timing_clock, latency, 0, 0)
+  schedulers = []
+
+  def CreateScheduler(issue_service):
+    schedulers.append(_TimingCommentScheduler(issue_service, timing_clock))
+    return schedulers[-1]
+
+  _RunExport(issue_json_data, project_name, rewrite_comments, rate_limit, 0,
+             timing_http, timing_clock, CreateScheduler)
+  scheduler = schedulers[0]
+
+  calls = sum(http_instance.calls.values())
+  writes = sum(count for kind, count in http_instance.calls.items()
+               if not kind.startswith("GET"))
+  limit_seconds = 0.0
+  if hourly_limit:
+    limit_seconds = max(limit_seconds, (calls - 1) // hourly_limit * 3600)
+  if abuse_limit_per_minute:
+    limit_seconds = max(limit_seconds, writes * 60.0 / abuse_limit_per_minute)
+  concurrent_seconds = []
+  for workers in range(1, max_workers + 1):
+    seconds = _SimulateWorkers(scheduler.jobs, 0.0,
+                               scheduler.GetExporterSeconds(), workers)
+    concurrent_seconds.append((workers, max(seconds, limit_seconds)))
+  best = min(seconds for _, seconds in concurrent_seconds)
+  recommended_workers = min(
+      workers for workers, seconds in concurrent_seconds
+      if seconds <= best * (1 + RECOMMENDATION_SLACK))
+
+  return {
+      "api_calls": http_instance.calls,
+      "rejected_calls": http_instance.rejected,
+      "sleep_seconds": dict(export_metrics.sleep_seconds),
+      "sequential_seconds": export_metrics.GetElapsedSeconds(),
+      "concurrent_seconds": concurrent_seconds,
+      "recommended_workers": recommended_workers,
+  }
+
+
+def FormatDuration(seconds):
+  """Formats a number of seconds as e.g. '2d 3h 4m'."""
+  minutes = int(math.ceil(seconds / 60.0))
+  days, minutes = divmod(minutes, 60 * 24)
+  hours, minutes = divmod(minutes, 60)
+  parts = []
+  if days:
+    parts.append("%dd" % days)
+  if days or hours:
+    parts.append("%dh" % hours)
+  parts.append("%dm" % minutes)
+  return " ".join(parts)
+
+
+def FormatPlan(plan):
+  """Returns a human readable report of an export plan."""
+  lines = ["API calls:"]
+  for kind in sorted(plan["api_calls"]):
+    lines.append("  %-20s %d" % (kind, plan["api_calls"][kind]))
+  lines.append("  %-20s %d" % ("total", sum(plan["api_calls"].values())))
+  lines.append("  %-20s %d" % ("rate limited", plan["rejected_calls"]))
+  lines.append("")
+  lines.append("Estimated duration without comment workers: %s" %
+               FormatDuration(plan["sequential_seconds"]))
+  for reason in sorted(plan["sleep_seconds"]):
+    lines.append("  sleeping for %-14s %s" % (
+        reason, FormatDuration(plan["sleep_seconds"][reason])))
+  lines.append("")
+  lines.append("Estimated duration with --comment_workers:")
+  for workers, seconds in plan["concurrent_seconds"]:
+    lines.append("  %3d  %s%s" % (
+        workers, FormatDuration(seconds),
+        "  <- recommended" if workers == plan["recommended_workers"] else ""))
+  return "\n".join(lines)
+
+
+def main(args):
+  """The main function.
+
+  Args:
+    args: The command line arguments.
+
+  Raises:
+    ProjectNotFoundError: The user passed in an invalid project name.
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--issue_file_path", required=True,
+                      help="The path to the file containing the issues from"
+                      "Google Code.")
+  parser.add_argument("--project_name", required=True,
+                      help="The name of the Google Code project you wish to"
+                      "export")
+  parser.add_argument("--rate_limit", required=False, action="store_true",
+                      help="Plan for an export run with --rate_limit.")
+  parser.add_argument("--rewrite_comments", required=False,
+                      action="store_true",
+                      help="Plan for a second run with --rewrite_comments.")
+  parser.add_argument("--latency", required=False, type=float,
+                      default=DEFAULT_LATENCY,
+                      help="The expected latency of a GitHub request in "
+                      "seconds.")
+  parser.add_argument("--hourly_limit", required=False, type=int,
+                      default=DEFAULT_HOURLY_LIMIT,
+                      help="GitHub's hourly request limit, 0 for none.")
+  parser.add_argument("--abuse_limit_per_minute", required=False, type=int,
+                      default=DEFAULT_ABUSE_LIMIT,
+                      help="The number of writes per minute GitHub allows "
+                      "before its abuse detection kicks in, 0 for none.")
+  parser.add_argument("--max_workers", required=False, type=int,
+                      default=DEFAULT_MAX_WORKERS,
+                      help="The largest number of comment workers to "
+                      "consider.")
+  parsed_args, _ = parser.parse_known_args(args)
+
+  issue_data = issues.LoadIssueData(parsed_args.issue_file_path,
+                                    parsed_args.project_name)
+  plan = PlanExport(
+      issue_data, parsed_args.project_name, parsed_args.rewrite_comments,
+      parsed_args.rate_limit, parsed_args.latency, parsed_args.hourly_limit,
+      parsed_args.abuse_limit_per_minute,
+      max_workers=parsed_args.max_workers)
+  print FormatPlan(plan)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
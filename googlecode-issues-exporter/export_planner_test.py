@@ -0,0 +1,108 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the export planner."""
+
+# pylint: disable=missing-docstring,protected-access
+
+import unittest
+
+import export_planner
+
+from issues_test import COMMENT_ONE
+from issues_test import COMMENT_TWO
+from issues_test import COMMENT_THREE
+from issues_test import REPO
+
+
+def _MakeIssues(count):
+  return [{
+      "id": idx,
+      "title": "Title%d" % idx,
+      "state": "closed" if idx % 2 else "open",
+      "labels": ["Type-Defect"],
+      "comments": {"items": [COMMENT_ONE, COMMENT_TWO, COMMENT_THREE]},
+  } for idx in range(1, count + 1)]
+
+
+class TestExportPlanner(unittest.TestCase):
+
+  def testApiCalls(self):
+    plan = export_planner.PlanExport(
+        _MakeIssues(4), REPO, rewrite_comments=True, hourly_limit=0,
+        abuse_limit_per_minute=0, max_workers=2)
+    self.assertEqual({
+        "GET issues": 6,
+        "GET comments": 4,
+        "POST issue": 4,
+        "POST comment": 8,
+        "POST comment edit": 8,
+        "PATCH issue close": 2,
+        "PATCH issue edit": 4,
+    }, dict(plan["api_calls"]))
+    self.assertEqual(0, plan["rejected_calls"])
+
+  def testSequentialDuration(self):
+    plan = export_planner.PlanExport(
+        _MakeIssues(2), REPO, latency=1, hourly_limit=0,
+        abuse_limit_per_minute=0, comment_delay=0.5)
+    # 2 GETs, 2 creates, 4 comments and a close, plus the comment delays.
+    self.assertEqual(9 + 2, plan["sequential_seconds"])
+    self.assertEqual({"comment_delay": 2}, plan["sleep_seconds"])
+
+  def testRateLimitsAreWaitedOut(self):
+    plan = export_planner.PlanExport(
+        _MakeIssues(3), REPO, latency=1, hourly_limit=5,
+        abuse_limit_per_minute=0, comment_delay=0)
+    self.assertTrue(plan["rejected_calls"])
+    self.assertEqual(13, sum(plan["api_calls"].values()))
+    self.assertGreater(plan["sequential_seconds"], 2 * 3600)
+    self.assertGreater(plan["sleep_seconds"]["rate_limit"], 2 * 3600 - 60)
+
+  def testCommentWorkers(self):
+    plan = export_planner.PlanExport(
+        _MakeIssues(10), REPO, latency=1, hourly_limit=0,
+        abuse_limit_per_minute=0, max_workers=4)
+    durations = dict(plan["concurrent_seconds"])
+    # The first issue is created after 3 seconds, then a single worker
+    # posts 20 comments and closes 5 issues.
+    self.assertEqual(3 + 25, durations[1])
+    # Creating all issues takes 12 seconds, the last issue's comments 2.
+    self.assertEqual(12 + 2, durations[4])
+    self.assertEqual(3, plan["recommended_workers"])
+
+  def testAbuseLimitBoundsWorkers(self):
+    plan = export_planner.PlanExport(
+        _MakeIssues(10), REPO, latency=1, hourly_limit=0,
+        abuse_limit_per_minute=10, max_workers=4)
+    # 35 writes at 10 per minute.
+    self.assertEqual(210, dict(plan["concurrent_seconds"])[4])
+    self.assertEqual(1, plan["recommended_workers"])
+
+  def testSimulateWorkersBlocksOnFullQueue(self):
+    jobs = [(1, 10), (2, 10), (3, 10), (4, 10)]
+    # With one worker two jobs may wait, so the exporter blocks on the fourth
+    # job until the second is picked up at 11, 7 seconds late.
+    self.assertEqual(41, export_planner._SimulateWorkers(jobs, 0, 5, 1))
+    self.assertEqual(57, export_planner._SimulateWorkers(jobs, 0, 50, 1))
+    self.assertEqual(14, export_planner._SimulateWorkers(jobs, 0, 5, 4))
+
+  def testFormatDuration(self):
+    self.assertEqual("1m", export_planner.FormatDuration(1))
+    self.assertEqual("2h 0m", export_planner.FormatDuration(7200))
+    self.assertEqual("1d 0h 1m", export_planner.FormatDuration(86401))
+
+
+if __name__ == "__main__":
+  unittest.main(buffer=True)
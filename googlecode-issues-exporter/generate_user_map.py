@@ -72,8 +72,8 @@ def Generate(issue_file_path, project_name):
   """Generates a user map for the specified issues. """
   issue_data = None
 
-  user_file = open(issue_file_path)
-  user_data = json.load(user_file)
+  with issues.OpenIssueFile(issue_file_path) as user_file:
+    user_data = json.load(user_file)
   user_projects = user_data["projects"]
 
   for project in user_projects:
@@ -0,0 +1,286 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tool for uploading the issues of many Google Code projects to GitHub.
+
+  Exports every project listed in a manifest in a single process. All exports
+  use the same GitHub token, so they share its rate limit budget and a pool of
+  connections rather than trampling each other's limit. Projects are started
+  in order of priority, several at a time, and a higher priority also buys a
+  larger share of the rate limit. Finished projects are checkpointed, so an
+  interrupted batch picks up where it left off.
+
+  The manifest is a JSON file of the form:
+
+    {"projects": [{"project_name": "...",
+                   "issue_file_path": "...",
+                   "github_owner_username": "...",
+                   "github_repo_name": "...",
+                   "user_file_path": "...",   (optional)
+                   "priority": 1},            (optional)
+                  ...]}
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import traceback
+
+import github_issue_converter
+import github_services
+import issues
+
+
+# The keys every project in the manifest must have.
+REQUIRED_PROJECT_KEYS = ("project_name", "issue_file_path",
+                         "github_owner_username", "github_repo_name")
+# The default number of projects exported at the same time.
+DEFAULT_PARALLEL_PROJECTS = 2
+# Checkpoint states of a project.
+DONE = "done"
+FAILED = "failed"
+
+
+class ManifestError(issues.Error):
+  """The batch manifest is malformed."""
+
+
+def LoadManifest(manifest_path):
+  """Loads the projects to export from a manifest file.
+
+  Args:
+    manifest_path: The path to the manifest.
+
+  Returns:
+    The list of projects, each a dictionary.
+
+  Raises:
+    ManifestError: A project is missing a required key, or two projects
+        export to the same repository.
+  """
+  with open(manifest_path) as manifest_file:
+    projects = json.load(manifest_file)["projects"]
+  seen = set()
+  for project in projects:
+    missing = [key for key in REQUIRED_PROJECT_KEYS if key not in project]
+    if missing:
+      raise ManifestError("Project %s is missing %s" % (
+          project.get("project_name"), ", ".join(missing)))
+    key = GetProjectKey(project)
+    if key in seen:
+      raise ManifestError("Project %s is listed twice" % key)
+    seen.add(key)
+  return projects
+
+
+def GetProjectKey(project):
+  """Returns the key identifying a manifest project in the checkpoint."""
+  return "%s:%s/%s" % (project["project_name"],
+                       project["github_owner_username"],
+                       project["github_repo_name"])
+
+
+class BatchCheckpoint(object):
+  """Records which projects of a batch have been exported.
+
+  The checkpoint is a JSON file from project key to its state, rewritten
+  after every project finishes.
+  """
+
+  def __init__(self, checkpoint_path):
+    """Initialize the BatchCheckpoint, loading it if it exists.
+
+    Args:
+      checkpoint_path: The path of the checkpoint file.
+    """
+    self._checkpoint_path = checkpoint_path
+    self._lock = threading.Lock()
+    self._states = {}
+    if os.path.exists(checkpoint_path):
+      with open(checkpoint_path) as checkpoint_file:
+        self._states = json.load(checkpoint_file)
+
+  def IsDone(self, project_key):
+    """Returns whether the project has been exported."""
+    return self._states.get(project_key, {}).get("state") == DONE
+
+  def GetStates(self):
+    """Returns a dictionary from project key to its state."""
+    with self._lock:
+      return dict((key, value["state"])
+                  for key, value in self._states.items())
+
+  def MarkDone(self, project_key):
+    """Records that the project has been exported."""
+    self._Set(project_key, {"state": DONE})
+
+  def MarkFailed(self, project_key, error):
+    """Records that exporting the project failed, and why."""
+    self._Set(project_key, {"state": FAILED, "error": error})
+
+  def _Set(self, project_key, value):
+    """Sets the state of a project and rewrites the checkpoint file."""
+    with self._lock:
+      self._states[project_key] = value
+      # Write to a temporary file first so a crash never leaves a partial
+      # checkpoint behind.
+      temp_path = self._checkpoint_path + ".tmp"
+      with open(temp_path, "w") as checkpoint_file:
+        json.dump(self._states, checkpoint_file, indent=2, sort_keys=True)
+      os.rename(temp_path, self._checkpoint_path)
+
+
+def ExportBatch(github_oauth_token, projects, checkpoint_path, rate_limit,
+                rewrite_comments, parallel_projects=DEFAULT_PARALLEL_PROJECTS,
+                comment_workers=0, request_timeout=None, read_tokens=None,
+                low_memory=False,
+                export_function=github_issue_converter.ExportIssues):
+  """Exports the issues of several projects, sharing one rate limit budget.
+
+  Args:
+    github_oauth_token: The oauth token used for all projects.
+    projects: The projects to export, as loaded by LoadManifest.
+    checkpoint_path: The path of the checkpoint file. Projects it lists as
+        done are skipped.
+    rate_limit: Whether or not to rate limit GitHub API requests.
+    rewrite_comments: Whether to rewrite the comments of exported issues.
+    parallel_projects: The number of projects to export at the same time.
+    comment_workers: The number of comment workers of each project.
+    request_timeout: Optional timeout in seconds for each HTTP request.
+    read_tokens: Optional additional oauth tokens to spread reads over.
+    low_memory: Whether to decode the issues of each project one at a time.
+    export_function: The function exporting a single project, with the
+        signature of github_issue_converter.ExportIssues.
+
+  Returns:
+    A dictionary from project key to its checkpoint state.
+  """
+  checkpoint = BatchCheckpoint(checkpoint_path)
+  rate_limit_budget = github_services.RateLimitBudget()
+  http_pool = github_services.HttpPool(request_timeout)
+  token_pool = None
+  if read_tokens:
+    token_pool = github_services.TokenPool(
+        [github_oauth_token] + list(read_tokens))
+
+  # Higher priorities first, otherwise in manifest order.
+  pending = sorted(
+      (project for project in projects
+       if not checkpoint.IsDone(GetProjectKey(project))),
+      key=lambda project: -project.get("priority", 1))
+  pending_lock = threading.Lock()
+
+  def Work():
+    while True:
+      with pending_lock:
+        if not pending:
+          return
+        project = pending.pop(0)
+      project_key = GetProjectKey(project)
+      print "Exporting %s" % project_key
+      try:
+        exported = export_function(
+            project["github_owner_username"], project["github_repo_name"],
+            github_oauth_token, project["issue_file_path"],
+            project["project_name"], project.get("user_file_path"),
+            rate_limit, rewrite_comments, comment_workers=comment_workers,
+            request_timeout=request_timeout,
+            rate_limit_budget=rate_limit_budget,
+            priority=project.get("priority", 1), http_pool=http_pool,
+            token_pool=token_pool, low_memory=low_memory)
+      except Exception, e:  # pylint: disable=broad-except
+        # One broken project shouldn't stop the others.
+        traceback.print_exc()
+        checkpoint.MarkFailed(project_key, "%s: %s" % (type(e).__name__, e))
+        continue
+      if exported:
+        checkpoint.MarkDone(project_key)
+      else:
+        checkpoint.MarkFailed(project_key, "Export reported an error")
+
+  threads = []
+  for _ in range(max(1, parallel_projects)):
+    thread = threading.Thread(target=Work)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    # Join with a timeout so that Ctrl+C still interrupts the main thread.
+    while thread.is_alive():
+      thread.join(1)
+  return checkpoint.GetStates()
+
+
+def main(args):
+  """The main function.
+
+  Args:
+    args: The command line arguments.
+  """
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--github_oauth_token", required=True,
+                      help="You can generate an oauth token here: "
+                      "https://github.com/settings/applications")
+  parser.add_argument("--manifest_path", required=True,
+                      help="The path to the JSON manifest listing the "
+                      "projects to export and their repositories.")
+  parser.add_argument("--checkpoint_path", required=False,
+                      help="The path of the file recording finished projects."
+                      " Defaults to the manifest path with '.checkpoint' "
+                      "appended.")
+  parser.add_argument("--parallel_projects", required=False, type=int,
+                      default=DEFAULT_PARALLEL_PROJECTS,
+                      help="The number of projects to export at the same "
+                      "time.")
+  parser.add_argument("--rate_limit", required=False, action="store_true",
+                      help="Rate limit GitHub requests to not run into"
+                      "anti-abuse limits.")
+  parser.add_argument("--rewrite_comments", required=False,
+                      action="store_true",
+                      help="Rewrite comments, such as remapping issue IDs.")
+  parser.add_argument("--comment_workers", required=False, type=int,
+                      default=0,
+                      help="The number of comment workers of each project, "
+                      "see github_issue_converter.py.")
+  parser.add_argument("--request_timeout", required=False, type=float,
+                      help="Timeout in seconds for each GitHub request.")
+  parser.add_argument("--github_read_token", required=False,
+                      action="append", default=[],
+                      help="An additional oauth token to spread read "
+                      "requests over, may be given several times.")
+  parser.add_argument("--low_memory", required=False, action="store_true",
+                      help="Memory-map the issue files and decode one issue "
+                      "at a time.")
+  parsed_args, _ = parser.parse_known_args(args)
+
+  projects = LoadManifest(parsed_args.manifest_path)
+  checkpoint_path = (parsed_args.checkpoint_path or
+                     parsed_args.manifest_path + ".checkpoint")
+  states = ExportBatch(
+      parsed_args.github_oauth_token, projects, checkpoint_path,
+      parsed_args.rate_limit, parsed_args.rewrite_comments,
+      parsed_args.parallel_projects, parsed_args.comment_workers,
+      parsed_args.request_timeout, parsed_args.github_read_token,
+      parsed_args.low_memory)
+  failed = sorted(key for key, state in states.items() if state == FAILED)
+  print "\n%d of %d projects exported." % (
+      len(states) - len(failed), len(projects))
+  for project_key in failed:
+    print "  Failed: %s" % project_key
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -0,0 +1,97 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the batch converter."""
+
+# pylint: disable=missing-docstring,protected-access
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import github_batch_converter
+
+
+def _Project(name, priority=1):
+  return {
+      "project_name": name,
+      "issue_file_path": "%s.json" % name,
+      "github_owner_username": "owner",
+      "github_repo_name": name,
+      "priority": priority,
+  }
+
+
+class TestBatchConverter(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.checkpoint_path = os.path.join(self.temp_dir, "checkpoint")
+    self.exported = []
+    self.budgets = set()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _Export(self, github_owner_username, github_repo_name,
+              github_oauth_token, issue_file_path, project_name,
+              user_file_path, rate_limit, rewrite_comments, **kwargs):
+    self.exported.append(project_name)
+    self.budgets.add(kwargs["rate_limit_budget"])
+    if project_name == "broken":
+      raise ValueError("bad dump")
+    return project_name != "invalid"
+
+  def _ExportBatch(self, projects):
+    return github_batch_converter.ExportBatch(
+        "token", projects, self.checkpoint_path, False, False,
+        parallel_projects=1, export_function=self._Export)
+
+  def testLoadManifest(self):
+    manifest_path = os.path.join(self.temp_dir, "manifest.json")
+    with open(manifest_path, "w") as manifest_file:
+      json.dump({"projects": [_Project("a"), {"project_name": "b"}]},
+                manifest_file)
+    with self.assertRaises(github_batch_converter.ManifestError):
+      github_batch_converter.LoadManifest(manifest_path)
+
+  def testPriorityOrderAndSharedBudget(self):
+    states = self._ExportBatch(
+        [_Project("low"), _Project("high", priority=5), _Project("mid", 2)])
+    self.assertEqual(["high", "mid", "low"], self.exported)
+    self.assertEqual(1, len(self.budgets))
+    self.assertEqual(set(["done"]), set(states.values()))
+
+  def testFailuresAreCheckpointed(self):
+    states = self._ExportBatch(
+        [_Project("broken"), _Project("invalid"), _Project("fine")])
+    self.assertEqual("failed", states["broken:owner/broken"])
+    self.assertEqual("failed", states["invalid:owner/invalid"])
+    self.assertEqual("done", states["fine:owner/fine"])
+    with open(self.checkpoint_path) as checkpoint_file:
+      checkpoint = json.load(checkpoint_file)
+    self.assertEqual("ValueError: bad dump",
+                     checkpoint["broken:owner/broken"]["error"])
+
+  def testResumeSkipsFinishedProjects(self):
+    self._ExportBatch([_Project("a"), _Project("broken")])
+    self.exported = []
+    self._ExportBatch([_Project("a"), _Project("broken"), _Project("b")])
+    self.assertEqual(["broken", "b"], self.exported)
+
+
+if __name__ == "__main__":
+  unittest.main(buffer=True)
@@ -27,35 +27,103 @@ import sys
 
 import github_services
 import issues
+import metrics
 
 
 def ExportIssues(github_owner_username, github_repo_name, github_oauth_token,
                  issue_file_path, project_name, user_file_path, rate_limit,
-                 rewrite_comments):
-  """Exports all issues for a given project."""
+                 rewrite_comments, metrics_trace_path=None,
+                 metrics_file_path=None,
+                 metrics_interval=metrics.DEFAULT_FLUSH_INTERVAL,
+                 record_cassette_path=None, replay_cassette_path=None,
+                 replay_original_timing=False, comment_workers=0,
+                 verify_comment_order=False, request_timeout=None,
+                 rate_limit_budget=None, priority=1, http_pool=None,
+                 token_pool=None, sync_manifest_path=None, issue_filter=None,
+                 low_memory=False, cache_issue_data=False,
+                 export_journal_path=None,
+                 fill_workers=issues.DEFAULT_FILL_WORKERS):
+  """Exports all issues for a given project.
+
+  Returns:
+    True if the export finished, False if it failed with an error that was
+    reported.
+  """
+  export_metrics = metrics.ExportMetrics(
+      metrics_trace_path, metrics_file_path, metrics_interval)
+  http_instance = None
+  if replay_cassette_path:
+    http_instance = github_services.ReplayHttp(
+        replay_cassette_path, replay_original_timing)
+  elif record_cassette_path:
+    http_instance = github_services.RecordingHttp(record_cassette_path)
+  if (comment_workers or export_journal_path) and not rate_limit_budget:
+    # The comment or fill workers write at the same time, they have to space
+    # out their writes together to stay under the abuse limit.
+    rate_limit_budget = github_services.RateLimitBudget()
   github_service = github_services.GitHubService(
       github_owner_username, github_repo_name, github_oauth_token,
-      rate_limit)
-  issue_service = github_services.IssueService(github_service)
+      rate_limit, http_instance=http_instance,
+      metrics_instance=export_metrics, request_timeout=request_timeout,
+      rate_limit_budget=rate_limit_budget, budget_weight=priority,
+      http_pool=http_pool, token_pool=token_pool)
+  comment_scheduler = None
+  if export_journal_path:
+    # Each issue's comments are posted by a single fill worker, in order.
+    issue_service = github_services.IssueService(
+        github_service, comment_delay=0)
+  elif comment_workers:
+    # The scheduler keeps comments in order, no need for a delay.
+    issue_service = github_services.IssueService(
+        github_service, comment_delay=0)
+    comment_scheduler = issues.CommentScheduler(
+        issue_service, comment_workers, verify_comment_order,
+        metrics_instance=export_metrics)
+  else:
+    issue_service = github_services.IssueService(github_service)
   user_service = github_services.UserService(github_service)
 
-  issue_data = issues.LoadIssueData(issue_file_path, project_name)
-  user_map = issues.LoadUserData(user_file_path, user_service)
-
-  # Add a special "user_requesting_export" user, which comes in handy.
-  user_map["user_requesting_export"] = github_owner_username
-
-  issue_exporter = issues.IssueExporter(
-      issue_service, user_service, issue_data, project_name, user_map)
-
+  issue_data = None
+  export_journal = None
   try:
+    issue_data = issues.LoadIssueData(
+        issue_file_path, project_name, lazy=low_memory,
+        use_cache=cache_issue_data)
+    user_map = issues.LoadUserData(user_file_path, user_service)
+
+    # Add a special "user_requesting_export" user, which comes in handy.
+    user_map["user_requesting_export"] = github_owner_username
+
+    sync_manifest = None
+    if sync_manifest_path:
+      sync_manifest = issues.SyncManifest(sync_manifest_path)
+    if export_journal_path:
+      export_journal = issues.ExportJournal(export_journal_path)
+    issue_exporter = issues.IssueExporter(
+        issue_service, user_service, issue_data, project_name, user_map,
+        metrics_instance=export_metrics, comment_scheduler=comment_scheduler,
+        sync_manifest=sync_manifest, issue_filter=issue_filter,
+        export_journal=export_journal, fill_workers=fill_workers)
     issue_exporter.Init(rewrite_comments)
     issue_exporter.Start(rewrite_comments)
     print "\nDone!\n"
+    return True
   except IOError, e:
     print "[IOError] ERROR: %s" % e
   except issues.InvalidUserError, e:
     print "[InvalidUserError] ERROR: %s" % e
+  finally:
+    if comment_scheduler:
+      comment_scheduler.Close()
+    github_service.Close()
+    export_metrics.Close()
+    if record_cassette_path and not replay_cassette_path:
+      http_instance.Close()
+    if isinstance(issue_data, issues.LazyIssueList):
+      issue_data.Close()
+    if export_journal:
+      export_journal.Close()
+  return False
 
 
 def main(args):
@@ -90,13 +158,85 @@ def main(args):
                      "anti-abuse limits.")
   parser.add_argument("--rewrite_comments", required=False, action='store_true',
                      help="Rewrite comments, such as remapping issue IDs.")
+  parser.add_argument("--metrics_trace_path", required=False,
+                      help="The path to a JSONL file to append a trace of "
+                      "all operations, API calls and sleeps to.")
+  parser.add_argument("--metrics_file_path", required=False,
+                      help="The path to an OpenMetrics text file that is "
+                      "periodically refreshed with export metrics.")
+  parser.add_argument("--metrics_interval", required=False, type=float,
+                      default=metrics.DEFAULT_FLUSH_INTERVAL,
+                      help="Seconds between refreshes of the metrics file.")
+  parser.add_argument("--record_cassette_path", required=False,
+                      help="Record all GitHub API traffic to this cassette "
+                      "file.")
+  parser.add_argument("--replay_cassette_path", required=False,
+                      help="Serve GitHub API responses from this cassette "
+                      "file instead of contacting GitHub.")
+  parser.add_argument("--replay_original_timing", required=False,
+                      action="store_true",
+                      help="Delay replayed responses by their recorded "
+                      "latency.")
+  parser.add_argument("--comment_workers", required=False, type=int,
+                      default=0,
+                      help="Post the comments of this many issues "
+                      "concurrently, in order per issue, instead of sleeping "
+                      "between comments.")
+  parser.add_argument("--verify_comment_order", required=False,
+                      action="store_true",
+                      help="With --comment_workers, verify the timestamps of "
+                      "posted comments and repair their order if needed.")
+  parser.add_argument("--request_timeout", required=False, type=float,
+                      help="Timeout in seconds for each GitHub request. "
+                      "Timed out creates are checked for before retrying, so "
+                      "they don't create duplicates.")
+  parser.add_argument("--github_read_token", required=False,
+                      action="append", default=[],
+                      help="An additional oauth token to spread read "
+                      "requests over, may be given several times. Writes "
+                      "always use --github_oauth_token.")
+  parser.add_argument("--sync_manifest_path", required=False,
+                      help="Only create, edit and close what changed since "
+                      "the last run recorded to this manifest file, and "
+                      "record the changes.")
+  parser.add_argument("--low_memory", required=False, action="store_true",
+                      help="Memory-map the issue file and decode one issue "
+                      "at a time, for projects too large to load at once.")
+  parser.add_argument("--cache_issue_data", required=False,
+                      action="store_true",
+                      help="Cache the parsed issues next to the issue file, "
+                      "so that later runs start faster.")
+  parser.add_argument("--export_journal_path", required=False,
+                      help="Export in two phases: create placeholder issues "
+                      "in order first, recording their numbers to this "
+                      "journal file, then fill them in concurrently.")
+  parser.add_argument("--fill_workers", required=False, type=int,
+                      default=issues.DEFAULT_FILL_WORKERS,
+                      help="The number of issues filled in at the same time "
+                      "with --export_journal_path.")
+  issues.AddIssueFilterArguments(parser)
   parsed_args, _ = parser.parse_known_args(args)
 
+  token_pool = None
+  if parsed_args.github_read_token:
+    token_pool = github_services.TokenPool(
+        [parsed_args.github_oauth_token] + parsed_args.github_read_token)
   ExportIssues(
       parsed_args.github_owner_username, parsed_args.github_repo_name,
       parsed_args.github_oauth_token, parsed_args.issue_file_path,
       parsed_args.project_name, parsed_args.user_file_path,
-      parsed_args.rate_limit, parsed_args.rewrite_comments)
+      parsed_args.rate_limit, parsed_args.rewrite_comments,
+      parsed_args.metrics_trace_path, parsed_args.metrics_file_path,
+      parsed_args.metrics_interval, parsed_args.record_cassette_path,
+      parsed_args.replay_cassette_path, parsed_args.replay_original_timing,
+      parsed_args.comment_workers, parsed_args.verify_comment_order,
+      parsed_args.request_timeout, token_pool=token_pool,
+      sync_manifest_path=parsed_args.sync_manifest_path,
+      issue_filter=issues.IssueFilterFromArguments(parsed_args),
+      low_memory=parsed_args.low_memory,
+      cache_issue_data=parsed_args.cache_issue_data,
+      export_journal_path=parsed_args.export_journal_path,
+      fill_workers=parsed_args.fill_workers)
 
 
 if __name__ == "__main__":
@@ -18,6 +18,7 @@
 
 import unittest
 
+import github_issue_converter
 import github_services
 import issues
 
@@ -260,5 +261,42 @@ class TestIssueExporter(unittest.TestCase):
     self.assertEqual(3, self.issue_exporter._issue_number)
 
 
+class TestExportIssues(unittest.TestCase):
+  """Tests for setting up an export."""
+
+  def setUp(self):
+    self.budgets = []
+    self.github_service_class = github_services.GitHubService
+    github_services.GitHubService = self._GitHubService
+
+  def tearDown(self):
+    github_services.GitHubService = self.github_service_class
+
+  def _GitHubService(self, *args, **kwargs):
+    self.budgets.append(kwargs["rate_limit_budget"])
+    # Stop the export, only the service is of interest.
+    raise StopIteration()
+
+  def _ExportIssues(self, **kwargs):
+    with self.assertRaises(StopIteration):
+      github_issue_converter.ExportIssues(
+          GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, "issues.json", REPO,
+          None, True, False, **kwargs)
+    return self.budgets.pop()
+
+  def testCommentWorkersShareBudget(self):
+    self.assertEqual(None, self._ExportIssues())
+    self.assertIsInstance(self._ExportIssues(comment_workers=4),
+                          github_services.RateLimitBudget)
+    budget = github_services.RateLimitBudget()
+    self.assertIs(budget, self._ExportIssues(comment_workers=4,
+                                             rate_limit_budget=budget))
+
+  def testFillWorkersShareBudget(self):
+    self.assertIsInstance(
+        self._ExportIssues(export_journal_path="journal.jsonl"),
+        github_services.RateLimitBudget)
+
+
 if __name__ == "__main__":
   unittest.main(buffer=True)
@@ -15,24 +15,63 @@
 """Wrappers around the GitHub APIs."""
 
 import collections
+import gzip
 import json
+import random
 import re
+import socket
 import sys
+import threading
 import time
 import urllib
+import urlparse
 
 import httplib
 import httplib2
 
+import clock
 import issues
+import metrics
 
 # The URL used for calls to GitHub.
 GITHUB_API_URL = "https://api.github.com"
-# The maximum number of retries to make for an HTTP request that has failed.
-MAX_HTTP_REQUESTS = 3
+# Classes of failed requests, see _ClassifyResponse.
+TRANSIENT_ERROR = "transient"
+RATE_LIMITED_ERROR = "rate_limited"
+PERMANENT_ERROR = "permanent"
+# The maximum number of retries to make for a failed HTTP request, per class
+# of error.
+RETRY_BUDGETS = {
+    TRANSIENT_ERROR: 5,
+    RATE_LIMITED_ERROR: 10,
+    PERMANENT_ERROR: 0,
+}
+# The base and maximum delay (in seconds) of the exponential retry backoff.
+BACKOFF_BASE_DELAY = 1
+BACKOFF_MAX_DELAY = 60
+# The number of consecutive transient failures after which GitHub is
+# considered degraded and requests are paused.
+CIRCUIT_FAILURE_THRESHOLD = 5
+# The initial and maximum time (in seconds) requests are paused for while
+# GitHub is degraded.
+CIRCUIT_RESET_TIME = 60
+CIRCUIT_MAX_RESET_TIME = 60 * 30
+# The maximum time (in seconds) a single request keeps retrying while GitHub
+# is degraded before giving up.
+DEGRADED_RETRY_TIME = 60 * 60 * 2
+# How many recent issues or comments to check for one created by a request
+# that failed ambiguously, and how far back (in seconds) to look for comments.
+CREATED_CHECK_PAGE_SIZE = 30
+CREATED_CHECK_SLACK = 60 * 5
 # The time (in seconds) to wait before trying to see if more requests are
 # available.
 REQUEST_CHECK_TIME = 60 * 5
+# GitHub's hourly request limit for authenticated requests.
+HOURLY_REQUEST_LIMIT = 5000
+# The number of writes per minute made when rate limiting, so as not to trigger
+# GitHub's anti-abuse mechanism. The exact quota is undocumented, so this is
+# simply a guess. See: https://developer.github.com/v3/#abuse-rate-limits
+ABUSE_LIMIT_WRITES_PER_MINUTE = 15
 # GitHub orders the comments based on time alone, and because we upload ours
 # relatively quickly we need a delay to keep things being posted in
 # chronological order.
@@ -52,6 +91,366 @@ def _CheckSuccessful(response):
   return "status" in response and 200 <= int(response["status"]) < 300
 
 
+def _ClassifyResponse(response):
+  """Classifies a response as a success or one of the error classes.
+
+  Args:
+    response: An HTTP response.
+
+  Returns:
+    None if the request was successful, otherwise one of TRANSIENT_ERROR,
+    RATE_LIMITED_ERROR or PERMANENT_ERROR.
+  """
+  if _CheckSuccessful(response):
+    return None
+  status = int(response.get("status", 0))
+  # GitHub answers both the hourly rate limit and the abuse rate limit with a
+  # 403, telling them apart from other 403s only through the headers.
+  if status == 429 or (status == 403 and (
+      response.get("x-ratelimit-remaining") == "0" or
+      "retry-after" in response)):
+    return RATE_LIMITED_ERROR
+  if status >= 500 or status == 408 or status == 0:
+    return TRANSIENT_ERROR
+  return PERMANENT_ERROR
+
+
+def _DecodeProjectedList(content, fields):
+  """Decodes a JSON list of objects, keeping only some fields of each.
+
+  Each page is decoded whole, which is faster than skipping the unwanted
+  fields, and only the wanted fields of its objects are kept across pages.
+  The issues.IDEMPOTENCY_KEY_FIELD field is computed from the body, so only
+  the key of a body needs to be kept.
+
+  Args:
+    content: The JSON content, a list of objects.
+    fields: The names of the fields to keep.
+
+  Returns:
+    The list of objects, each with the fields it has out of the wanted ones.
+
+  Raises:
+    ValueError: The content is not a complete JSON list.
+  """
+  items = json.loads(content)
+  if not isinstance(items, list):
+    raise ValueError("Not a JSON list: %.50r" % content)
+  projected_items = []
+  for item in items:
+    projected_item = {field: item[field] for field in fields if field in item}
+    if issues.IDEMPOTENCY_KEY_FIELD in fields:
+      projected_item[issues.IDEMPOTENCY_KEY_FIELD] = (
+          issues.FindIdempotencyKey(item.get("body")))
+    projected_items.append(projected_item)
+  return projected_items
+
+
+def _DecodeContent(content):
+  """Decodes JSON content, returning the raw text if it isn't JSON.
+
+  Error pages (e.g. an HTML 502 from a proxy) are not JSON, and should still be
+  reported rather than raise.
+  """
+  try:
+    return json.loads(content)
+  except ValueError:
+    return content
+
+
+class RetryPolicy(object):
+  """Decides whether and when to retry a failed request.
+
+  Retries are limited per error class, and delayed using exponential backoff
+  with full jitter (a random delay between zero and the exponential bound), so
+  that retries from a burst of failures are spread out.
+  """
+
+  def __init__(self, budgets=None, base_delay=BACKOFF_BASE_DELAY,
+               max_delay=BACKOFF_MAX_DELAY, random_instance=None):
+    """Initialize the RetryPolicy.
+
+    Args:
+      budgets: Dictionary from error class to the maximum number of retries,
+          defaults to RETRY_BUDGETS.
+      base_delay: The bound of the first backoff delay in seconds.
+      max_delay: The maximum backoff delay in seconds.
+      random_instance: The random.Random instance to use for jitter.
+    """
+    self._budgets = budgets if budgets is not None else RETRY_BUDGETS
+    self._base_delay = base_delay
+    self._max_delay = max_delay
+    self._random = random_instance if random_instance else random.Random()
+
+  def CanRetry(self, error_class, retries):
+    """Returns whether a request that has been retried 'retries' times for
+    the given error class may be retried again."""
+    return retries < self._budgets.get(error_class, 0)
+
+  def GetBackoff(self, retries):
+    """Returns the number of seconds to wait before the next retry."""
+    bound = min(self._max_delay, self._base_delay * (2 ** retries))
+    return self._random.uniform(0, bound)
+
+
+class CircuitBreaker(object):
+  """Pauses all requests while GitHub appears to be degraded.
+
+  After 'failure_threshold' consecutive transient failures the circuit opens,
+  and requests wait until the reset time has passed. The next request is then
+  let through as a probe: if it succeeds the circuit closes again, otherwise
+  it re-opens with double the reset time (up to 'max_reset_time').
+  """
+
+  def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+               reset_time=CIRCUIT_RESET_TIME,
+               max_reset_time=CIRCUIT_MAX_RESET_TIME, clock=None):
+    """Initialize the CircuitBreaker.
+
+    Args:
+      failure_threshold: Consecutive failures before the circuit opens.
+      reset_time: The initial time in seconds the circuit stays open.
+      max_reset_time: The maximum time in seconds the circuit stays open.
+      clock: Function returning the current time in seconds, defaults to
+          time.time.
+    """
+    self._failure_threshold = failure_threshold
+    self._initial_reset_time = reset_time
+    self._reset_time = reset_time
+    self._max_reset_time = max_reset_time
+    self._clock = clock if clock else time.time
+    self._failures = 0
+    self._open_until = None
+
+  def IsOpen(self):
+    """Returns whether GitHub is currently considered degraded."""
+    return self._open_until is not None
+
+  def GetWaitTime(self):
+    """Returns the seconds to wait before the next request may be made."""
+    if self._open_until is None:
+      return 0
+    return max(0, self._open_until - self._clock())
+
+  def RecordSuccess(self):
+    """Records a successful request, closing the circuit."""
+    self._failures = 0
+    self._open_until = None
+    self._reset_time = self._initial_reset_time
+
+  def RecordFailure(self):
+    """Records a transient failure, opening the circuit if needed."""
+    self._failures += 1
+    if self._open_until is not None:
+      # The probe failed, back off further.
+      self._reset_time = min(self._max_reset_time, self._reset_time * 2)
+      self._open_until = self._clock() + self._reset_time
+    elif self._failures >= self._failure_threshold:
+      self._open_until = self._clock() + self._reset_time
+
+
+class RateLimitBudget(object):
+  """The hourly request budget of a token, shared by the services using it.
+
+  GitHub reports the remaining requests and when they reset with every
+  response. Each client (a GitHubService) is entitled to a share of the hourly
+  limit in proportion to its weight, and may only use more as long as the
+  unused shares of the other clients remain available. Writes are spaced out
+  across all clients, so several exports together stay under the abuse limit.
+  """
+
+  def __init__(self, hourly_limit=HOURLY_REQUEST_LIMIT,
+               writes_per_minute=ABUSE_LIMIT_WRITES_PER_MINUTE, clock=None):
+    """Initialize the RateLimitBudget.
+
+    Args:
+      hourly_limit: The number of requests allowed per hour, updated from
+          GitHub's responses.
+      writes_per_minute: The number of writes allowed per minute when
+          rate limiting.
+      clock: Function returning the current time in seconds, defaults to
+          time.time.
+    """
+    self._limit = hourly_limit
+    self._write_interval = 60.0 / writes_per_minute
+    self._clock = clock if clock else time.time
+    self._lock = threading.Lock()
+    self._weights = {}
+    self._used = collections.defaultdict(int)
+    self._remaining = None
+    self._reset_time = None
+    self._next_write_time = None
+
+  def Register(self, client, weight=1):
+    """Adds a client, entitled to a share of the budget by its weight."""
+    with self._lock:
+      self._weights[client] = weight
+
+  def Unregister(self, client):
+    """Removes a client, releasing its share of the budget to the others."""
+    with self._lock:
+      self._weights.pop(client, None)
+      self._used.pop(client, None)
+
+  def Acquire(self, client):
+    """Takes a request from the budget for the client.
+
+    Args:
+      client: The registered client making the request.
+
+    Returns:
+      0 if the request may be made, otherwise the seconds to wait before
+      asking again.
+    """
+    with self._lock:
+      now = self._clock()
+      if self._reset_time is not None and now >= self._reset_time:
+        # A new hour, the remaining requests are unknown until the next
+        # response.
+        self._remaining = None
+        self._reset_time = None
+        self._used.clear()
+      self._weights.setdefault(client, 1)
+      if self._remaining is not None and not self._MayUse(client):
+        if self._reset_time is None:
+          return REQUEST_CHECK_TIME
+        return self._reset_time - now + 1
+      if self._remaining is not None:
+        self._remaining -= 1
+      self._used[client] += 1
+      return 0
+
+  def _MayUse(self, client):
+    """Returns whether the client may use one of the remaining requests."""
+    if self._remaining <= 0:
+      return False
+    total_weight = float(sum(self._weights.values()))
+    if self._used[client] < self._limit * self._weights[client] / total_weight:
+      return True
+    reserved = sum(
+        max(0, self._limit * weight / total_weight - self._used[other])
+        for other, weight in self._weights.items() if other is not client)
+    return self._remaining > reserved
+
+  def Update(self, response):
+    """Updates the budget from the rate limit headers of a response."""
+    if "x-ratelimit-remaining" not in response:
+      return
+    remaining = int(response["x-ratelimit-remaining"])
+    reset_time = (int(response["x-ratelimit-reset"])
+                  if "x-ratelimit-reset" in response else None)
+    with self._lock:
+      if "x-ratelimit-limit" in response:
+        self._limit = int(response["x-ratelimit-limit"])
+      if (reset_time is not None and self._reset_time is not None and
+          reset_time > self._reset_time):
+        self._used.clear()
+      elif (self._remaining is not None and
+            (reset_time is None or reset_time == self._reset_time)):
+        # Responses to concurrent requests may arrive out of order.
+        remaining = min(remaining, self._remaining)
+      self._remaining = remaining
+      self._reset_time = reset_time
+
+  def ReserveWrite(self):
+    """Reserves the next slot for a write.
+
+    Returns:
+      The seconds to wait before making the write.
+    """
+    with self._lock:
+      now = self._clock()
+      write_time = max(now, self._next_write_time or now)
+      self._next_write_time = write_time + self._write_interval
+      return write_time - now
+
+
+class TokenPool(object):
+  """OAuth tokens to spread read requests over.
+
+  Every token has its own hourly rate limit. Reads use the token with the most
+  requests remaining, as last reported by GitHub. Writes always use the
+  owner's token (see GitHubService), so that issues and comments are authored
+  by the owner.
+  """
+
+  def __init__(self, tokens, clock=None):
+    """Initialize the TokenPool.
+
+    Args:
+      tokens: The oauth tokens, usually starting with the owner's.
+      clock: Function returning the current time in seconds, defaults to
+          time.time.
+    """
+    self._tokens = list(tokens)
+    self._clock = clock if clock else time.time
+    self._lock = threading.Lock()
+    self._remaining = {}
+    self._reset_time = {}
+
+  def _GetRemaining(self, token):
+    """Returns the requests the token has left, or None if unknown."""
+    reset_time = self._reset_time.get(token)
+    if reset_time is not None and self._clock() >= reset_time:
+      self._remaining.pop(token, None)
+      self._reset_time.pop(token, None)
+    return self._remaining.get(token)
+
+  def GetReadToken(self):
+    """Returns the token to make a read request with."""
+    with self._lock:
+      best_token = None
+      best_remaining = None
+      for token in self._tokens:
+        remaining = self._GetRemaining(token)
+        if remaining is None:
+          remaining = HOURLY_REQUEST_LIMIT
+        if best_token is None or remaining > best_remaining:
+          best_token, best_remaining = token, remaining
+      # Count the request until GitHub reports the actual remaining requests,
+      # so concurrent reads spread over the tokens too.
+      if self._remaining.get(best_token):
+        self._remaining[best_token] -= 1
+      return best_token
+
+  def HasQuota(self):
+    """Returns whether any token may still have requests left."""
+    with self._lock:
+      return any(self._GetRemaining(token) != 0 for token in self._tokens)
+
+  def Update(self, token, response):
+    """Updates a token's remaining requests from a response's headers."""
+    if "x-ratelimit-remaining" not in response:
+      return
+    with self._lock:
+      self._remaining[token] = int(response["x-ratelimit-remaining"])
+      if "x-ratelimit-reset" in response:
+        self._reset_time[token] = int(response["x-ratelimit-reset"])
+
+
+class HttpPool(object):
+  """Hands out one httplib2.Http per thread, which is not thread-safe.
+
+  Each httplib2.Http keeps its connections open, so services sharing a pool
+  also share their connections to GitHub.
+  """
+
+  def __init__(self, timeout=None):
+    """Initialize the HttpPool.
+
+    Args:
+      timeout: Optional timeout in seconds for each HTTP request.
+    """
+    self._timeout = timeout
+    self._local = threading.local()
+
+  def Get(self):
+    """Returns the calling thread's httplib2.Http."""
+    if not hasattr(self._local, "http"):
+      self._local.http = httplib2.Http(timeout=self._timeout)
+    return self._local.http
+
+
 class GitHubService(object):
   """A connection to GitHub.
 
@@ -61,10 +460,16 @@ class GitHubService(object):
       github_owner_username: The username of the owner of the repository.
       github_repo_name: The GitHub repository name.
       rate_limit: Whether or not to rate limit API calls.
+      metrics: The metrics.ExportMetrics instance requests are recorded to.
+      clock: The clock.Clock used to keep time and sleep.
   """
 
   def __init__(self, github_owner_username, github_repo_name,
-               github_oauth_token, rate_limit, http_instance=None):
+               github_oauth_token, rate_limit, http_instance=None,
+               metrics_instance=None, retry_policy=None, circuit_breaker=None,
+               request_timeout=None, clock_instance=None,
+               rate_limit_budget=None, budget_weight=1, http_pool=None,
+               token_pool=None):
     """Initialize the GitHubService.
 
     Args:
@@ -74,65 +479,197 @@ class GitHubService(object):
       rate_limit: Whether or not to rate limit GitHub API requests.
       http_instance: The HTTP instance to use, if not set a default will be
           used.
+      metrics_instance: The metrics.ExportMetrics instance to record requests
+          and sleeps to, if not set a default will be used.
+      retry_policy: The RetryPolicy for failed requests, if not set a default
+          will be used.
+      circuit_breaker: The CircuitBreaker to pause requests with while GitHub
+          is degraded, if not set a default will be used.
+      request_timeout: Optional timeout in seconds for each HTTP request. Only
+          used if http_instance is not set.
+      clock_instance: The clock.Clock to keep time and sleep with, if not set
+          the wall clock will be used.
+      rate_limit_budget: Optional RateLimitBudget shared with other services
+          using the same token.
+      budget_weight: The weight of this service's share of the budget.
+      http_pool: The HttpPool to take connections from, if not set a new one
+          will be used. Only used if http_instance is not set.
+      token_pool: Optional TokenPool to spread reads over. Writes always use
+          github_oauth_token, which the rate_limit_budget is for.
     """
     self.github_owner_username = github_owner_username
     self.github_repo_name = github_repo_name
     self._github_oauth_token = github_oauth_token
     self._rate_limit = rate_limit
-    self._http = http_instance if http_instance else httplib2.Http()
-
-  def _PerformHttpRequest(self, method, url, body="{}", params=None):
+    # A shared HTTP instance is serialized through a lock, otherwise each
+    # thread gets its own httplib2.Http (which is not thread-safe).
+    self._http = http_instance
+    self._http_lock = threading.Lock()
+    self._http_pool = http_pool if http_pool else HttpPool(request_timeout)
+    self._rate_limit_budget = rate_limit_budget
+    self._token_pool = token_pool
+    if rate_limit_budget:
+      rate_limit_budget.Register(self, budget_weight)
+    self.clock = clock_instance if clock_instance else clock.Clock()
+    self.metrics = (metrics_instance if metrics_instance else
+                    metrics.ExportMetrics(clock=self.clock.Now))
+    self._retry_policy = retry_policy if retry_policy else RetryPolicy()
+    self._circuit_breaker = (circuit_breaker if circuit_breaker else
+                             CircuitBreaker(clock=self.clock.Now))
+
+  def _PerformHttpRequest(self, method, url, body="{}", params=None,
+                          created_check=None, decoder=json.loads):
     """Attemps to make an HTTP request for given method, url, body and params.
 
-    If the request fails try again 'MAX_HTTP_REQUESTS' number of times.  If the
-    request fails due to the the request limit being hit, wait until more
-    requests can be made.
+    Failed requests are classified as transient (5xx, connection errors),
+    rate limited or permanent (other 4xx). Transient failures are retried with
+    exponential backoff, rate limited requests wait until the limit resets, and
+    permanent failures are returned right away. Each class has its own retry
+    budget, see RetryPolicy. While GitHub is degraded (see CircuitBreaker)
+    requests are paused, and failures don't count against the budget for up to
+    DEGRADED_RETRY_TIME seconds.
+
+    A transient failure of a request that creates something is ambiguous: the
+    request may still have been applied. If 'created_check' is given it is
+    called before such a request is retried, and when it finds the created
+    object that is returned instead of creating a duplicate.
+
+    GET requests use the token from the token pool with the most requests left,
+    and a rate limited GET is retried right away if another token has some.
 
     Args:
       method: The HTTP request method as a string ('GET', 'POST', etc.).
       url: The URL to make the call to.
       body: The body of the request.
       params: A dictionary of parameters to be used in the http call.
+      created_check: Optional function returning the object created by this
+          request if it exists, or None.
+      decoder: The function decoding the content of a successful response. A
+          ValueError means the content is truncated.
 
     Returns:
       A tuple of an HTTP response (https://developer.github.com/v3/#schema) and
-      its content from the server which is decoded JSON.
+      its content from the server which is decoded JSON, or the raw content if
+      the request failed with a non-JSON body.
+
+    Raises:
+      socket.error, httplib.HTTPException: The connection failed and the retry
+          budget was exhausted.
     """
     headers = {"User-Agent": "GoogleCodeIssueExporter/1.0"}
     query = params.copy() if params else {}
-    query["access_token"] = self._github_oauth_token
-    request_url = "%s%s?%s" % (GITHUB_API_URL, url, urllib.urlencode(query))
-    requests = 0
-    while requests < MAX_HTTP_REQUESTS:
-      requests += 1
-      response, content = self._http.request(request_url, method,
-                                             headers=headers, body=body)
-      if _CheckSuccessful(response):
-        return response, json.loads(content)
-      elif self._RequestLimitReached():
-        requests -= 1
-        self._WaitForApiThrottlingToEnd()
-    return response, json.loads(content)
-
-  def PerformGetRequest(self, url, params=None):
+    retries = collections.defaultdict(int)
+    attempts = 0
+    degraded_time = 0
+    unconfirmed = False
+    while True:
+      circuit_wait = self._circuit_breaker.GetWaitTime()
+      if circuit_wait:
+        self.Sleep(circuit_wait, "circuit_breaker")
+        degraded_time += circuit_wait
+      if unconfirmed:
+        created = created_check()
+        if created is not None:
+          self._circuit_breaker.RecordSuccess()
+          return {"status": str(httplib.CREATED)}, created
+      token = self._github_oauth_token
+      if self._token_pool and method == "GET":
+        token = self._token_pool.GetReadToken()
+      if self._rate_limit_budget and token == self._github_oauth_token:
+        self._WaitForBudget()
+      query["access_token"] = token
+      request_url = "%s%s?%s" % (GITHUB_API_URL, url, urllib.urlencode(query))
+      attempts += 1
+      start = self.metrics.Now()
+      error = None
+      try:
+        response, content = self._HttpRequest(request_url, method,
+                                              headers=headers, body=body)
+      except (socket.error, httplib.HTTPException) as e:
+        error = e
+        response, content = {}, None
+      if self._token_pool:
+        self._token_pool.Update(token, response)
+      if self._rate_limit_budget and token == self._github_oauth_token:
+        self._rate_limit_budget.Update(response)
+      self.metrics.RecordApiCall(method, response.get("status"),
+                                 self.metrics.Now() - start,
+                                 retry=attempts > 1)
+
+      error_class = TRANSIENT_ERROR if error else _ClassifyResponse(response)
+      if error_class is None:
+        try:
+          decoded_content = decoder(content)
+        except ValueError:
+          # A truncated body, most likely a dropped connection.
+          error_class = TRANSIENT_ERROR
+        else:
+          self._circuit_breaker.RecordSuccess()
+          return response, decoded_content
+      elif (error_class == PERMANENT_ERROR and
+            int(response.get("status", 0)) == 403 and
+            self._RequestLimitReached()):
+        # Rate limited, but without the headers saying so.
+        error_class = RATE_LIMITED_ERROR
+
+      if error_class == TRANSIENT_ERROR:
+        unconfirmed = created_check is not None
+        was_degraded = self._circuit_breaker.IsOpen()
+        self._circuit_breaker.RecordFailure()
+        # GitHub is having an incident, don't blame this request for it.
+        if was_degraded and degraded_time < DEGRADED_RETRY_TIME:
+          continue
+
+      if not self._retry_policy.CanRetry(error_class,
+                                         retries[error_class]):
+        if error:
+          raise error
+        return response, _DecodeContent(content)
+
+      if error_class == RATE_LIMITED_ERROR:
+        if not (self._token_pool and method == "GET" and
+                self._token_pool.HasQuota()):
+          self._WaitForRateLimit(response)
+      elif not self._circuit_breaker.IsOpen():
+        self.Sleep(self._retry_policy.GetBackoff(retries[error_class]),
+                   "backoff")
+      retries[error_class] += 1
+
+  def _HttpRequest(self, url, method, headers=None, body=None):
+    """Makes a single HTTP request, safe to call from several threads."""
+    if self._http:
+      with self._http_lock:
+        return self._http.request(url, method, headers=headers, body=body)
+    return self._http_pool.Get().request(url, method, headers=headers,
+                                         body=body)
+
+  def PerformGetRequest(self, url, params=None, fields=None):
     """Makes a GET request.
 
     Args:
       url: The URL to make the call to.
       params: A dictionary of parameters to be used in the http call.
+      fields: Optional names of the fields to keep of each object of a list
+          response, the rest is discarded while decoding.
 
     Returns:
       A tuple of an HTTP response (https://developer.github.com/v3/#schema) and
       its content from the server which is decoded JSON.
     """
+    if fields:
+      return self._PerformHttpRequest(
+          "GET", url, params=params,
+          decoder=lambda content: _DecodeProjectedList(content, fields))
     return self._PerformHttpRequest("GET", url, params=params)
 
-  def PerformPostRequest(self, url, body):
+  def PerformPostRequest(self, url, body, created_check=None):
     """Makes a POST request.
 
     Args:
       url: The URL to make the call to.
       body: The body of the request.
+      created_check: Optional function returning the object created by this
+          request if it exists, see _PerformHttpRequest.
 
     Returns:
       A tuple of an HTTP response (https://developer.github.com/v3/#schema) and
@@ -141,12 +678,16 @@ class GitHubService(object):
     if self._rate_limit:
       # Add a delay to all outgoing request to GitHub, as to not trigger their
       # anti-abuse mechanism. This is separate from your typical rate limit, and
-      # only applies to certain API calls (like creating issues). And, alas, the
-      # exact quota is undocumented. So the value below is simply a guess. See:
-      # https://developer.github.com/v3/#abuse-rate-limits
-      req_min = 15
-      time.sleep(60 / req_min)
-    return self._PerformHttpRequest("POST", url, body)
+      # only applies to certain API calls (like creating issues). A shared
+      # budget spaces out the writes of all services using it instead.
+      if self._rate_limit_budget:
+        delay = self._rate_limit_budget.ReserveWrite()
+      else:
+        delay = 60 / ABUSE_LIMIT_WRITES_PER_MINUTE
+      if delay:
+        self.Sleep(delay, "abuse_limit")
+    return self._PerformHttpRequest("POST", url, body,
+                                    created_check=created_check)
 
   def PerformPatchRequest(self, url, body):
     """Makes a PATCH request.
@@ -159,6 +700,12 @@ class GitHubService(object):
       A tuple of an HTTP response (https://developer.github.com/v3/#schema) and
       its content from the server which is decoded JSON.
     """
+    if self._rate_limit and self._rate_limit_budget:
+      # Edits made concurrently with other writes, e.g. by the fill workers
+      # of a two-phase export, take their slot of the shared budget too.
+      delay = self._rate_limit_budget.ReserveWrite()
+      if delay:
+        self.Sleep(delay, "abuse_limit")
     return self._PerformHttpRequest("PATCH", url, body)
 
   def _GetRemainingRequests(self):
@@ -172,7 +719,10 @@ class GitHubService(object):
     """
     url = ("%s/rate_limit?access_token=%s" %
            (GITHUB_API_URL, self._github_oauth_token))
-    _, content = self._http.request(url, "GET")
+    start = self.metrics.Now()
+    response, content = self._HttpRequest(url, "GET")
+    self.metrics.RecordApiCall("GET", response.get("status"),
+                               self.metrics.Now() - start)
     content = json.loads(content)
     if "rate" in content and "remaining" in content["rate"]:
       return int(content["rate"]["remaining"])
@@ -182,6 +732,28 @@ class GitHubService(object):
     """Returns true if the request limit has been reached."""
     return self._GetRemainingRequests() == 0
 
+  def _WaitForRateLimit(self, response):
+    """Waits until a rate limited request may be retried.
+
+    Uses the Retry-After or X-RateLimit-Reset headers when GitHub sent them,
+    otherwise polls the remaining requests.
+    """
+    if "retry-after" in response:
+      self.Sleep(int(response["retry-after"]), "rate_limit")
+    elif "x-ratelimit-reset" in response:
+      reset_delay = int(response["x-ratelimit-reset"]) - self.clock.Now()
+      self.Sleep(max(0, reset_delay) + 1, "rate_limit")
+    else:
+      self._WaitForApiThrottlingToEnd()
+
+  def _WaitForBudget(self):
+    """Waits until the shared rate limit budget allows another request."""
+    while True:
+      wait_time = self._rate_limit_budget.Acquire(self)
+      if not wait_time:
+        return
+      self.Sleep(wait_time, "rate_limit")
+
   def _WaitForApiThrottlingToEnd(self):
     """Waits until the user is allowed to make more requests."""
     sys.stdout.write("Hourly request limit reached. Waiting for new limit, "
@@ -189,10 +761,25 @@ class GitHubService(object):
     while True:
       sys.stdout.write(".")
       sys.stdout.flush()
-      time.sleep(REQUEST_CHECK_TIME)
+      self.Sleep(REQUEST_CHECK_TIME, "rate_limit")
       if not self._RequestLimitReached():
         return
 
+  def Close(self):
+    """Releases this service's share of the rate limit budget, if any."""
+    if self._rate_limit_budget:
+      self._rate_limit_budget.Unregister(self)
+
+  def Sleep(self, seconds, reason):
+    """Sleeps, recording the time spent to the metrics.
+
+    Args:
+      seconds: The number of seconds to sleep.
+      reason: Why the sleep is needed, e.g. 'rate_limit'.
+    """
+    self.clock.Sleep(seconds)
+    self.metrics.RecordSleep(seconds, reason)
+
 
 class FakeGitHubService(GitHubService):
   """A fake of the GitHubService.
@@ -227,6 +814,8 @@ class FakeGitHubService(GitHubService):
     self.github_repo_name = github_repo_name
     self._github_oauth_token = github_oauth_token
     self._action_queue = collections.deque([])
+    self.clock = clock.Clock()
+    self.metrics = metrics.ExportMetrics()
 
   def AddSuccessfulResponse(self, content=None):
     """Adds a succesfull response with no content to the reponse queue."""
@@ -244,31 +833,34 @@ class FakeGitHubService(GitHubService):
     full_response["content"] = content if content else {}
     self._action_queue.append(full_response)
 
-  def _PerformHttpRequest(self, method, url, body="{}", params=None):
+  def _PerformHttpRequest(self, method, url, body="{}", params=None,
+                          created_check=None):
     if not self._action_queue:
       return {"status": httplib.OK}, {}
 
     full_response = self._action_queue.popleft()
     return (full_response["status"], full_response["content"])
 
-  def PerformGetRequest(self, url, params=None):
+  def PerformGetRequest(self, url, params=None, fields=None):
     """Makes a fake GET request.
 
     Args:
       url: The URL to make the call to.
       params: A dictionary of parameters to be used in the http call.
+      fields: Ignored.
 
     Returns:
       A tuple of a fake response and fake content.
     """
     return self._PerformHttpRequest("GET", url, params=params)
 
-  def PerformPostRequest(self, url, body):
+  def PerformPostRequest(self, url, body, created_check=None):
     """Makes a POST request.
 
     Args:
       url: The URL to make the call to.
       body: The body of the request.
+      created_check: Ignored.
 
     Returns:
       A tuple of a fake response and content
@@ -334,6 +926,136 @@ class Http2Mock(object):
     return (self.response, json.dumps(self.content))
 
 
+def _CassetteRequestKey(method, url):
+  """Returns the key used to match a request against a cassette.
+
+  The access token is dropped and the query parameters sorted, so cassettes
+  never contain credentials and can be replayed with any token.
+  """
+  scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+  params = sorted((key, value) for key, value in urlparse.parse_qsl(query)
+                  if key != "access_token")
+  return "%s %s" % (method, urlparse.urlunsplit(
+      (scheme, netloc, path, urllib.urlencode(params), fragment)))
+
+
+class CassetteMismatchError(Exception):
+  """Error for a replayed request which is not in the cassette."""
+
+
+class RecordingHttp(object):
+  """An httplib2.Http wrapper which records all traffic to a cassette.
+
+  The cassette is a gzipped file with one JSON record per line, holding the
+  request (method, URL without the access token, headers and body), the
+  response (headers and raw content) and its timing.
+  """
+
+  def __init__(self, cassette_path, http_instance=None, clock_instance=None):
+    """Initialize the RecordingHttp.
+
+    Args:
+      cassette_path: The path of the cassette file to write.
+      http_instance: The HTTP instance to forward requests to, if not set a
+          default will be used.
+      clock_instance: The clock.Clock to time requests with, if not set the
+          wall clock will be used.
+    """
+    self._http = http_instance if http_instance else httplib2.Http()
+    self._cassette = gzip.open(cassette_path, "wb")
+    self._clock = clock_instance if clock_instance else clock.Clock()
+    self._start_time = self._clock.Now()
+
+  def request(self, url, method, headers=None, body=None):
+    """Makes an HTTP request and records it.
+
+    Args:
+      url: The url to make the call to.
+      method: The type of call. POST, GET, etc.
+      headers: The HTTP headers for the request.
+      body: The request of the body.
+
+    Returns:
+      A tuple of a response and its content.
+    """
+    start = self._clock.Now()
+    response, content = self._http.request(url, method, headers=headers,
+                                           body=body)
+    record = {
+        "request": _CassetteRequestKey(method, url),
+        "request_headers": headers or {},
+        "request_body": body,
+        "response": dict(response),
+        "content": content,
+        "offset": start - self._start_time,
+        "elapsed": self._clock.Now() - start,
+    }
+    self._cassette.write(json.dumps(record, sort_keys=True) + "\n")
+    return response, content
+
+  def Close(self):
+    """Flushes and closes the cassette file."""
+    self._cassette.close()
+
+
+class ReplayHttp(object):
+  """An httplib2.Http replacement which serves responses from a cassette.
+
+  Requests are matched on method and URL (ignoring the access token). When the
+  same request was recorded several times the responses are served in the
+  order they were recorded, so replays don't depend on the exact interleaving
+  of unrelated requests.
+
+  Attributes:
+    requests_served: The number of requests answered from the cassette.
+  """
+
+  def __init__(self, cassette_path, original_timing=False,
+               clock_instance=None):
+    """Initialize the ReplayHttp.
+
+    Args:
+      cassette_path: The path of a cassette written by RecordingHttp.
+      original_timing: If set, each response is delayed by the latency that
+          was recorded for it. Otherwise responses are served immediately.
+      clock_instance: The clock.Clock to delay responses with, if not set the
+          wall clock will be used.
+    """
+    self._original_timing = original_timing
+    self._clock = clock_instance if clock_instance else clock.Clock()
+    self._records = collections.defaultdict(collections.deque)
+    self.requests_served = 0
+    with gzip.open(cassette_path, "rb") as cassette:
+      for line in cassette:
+        record = json.loads(line)
+        self._records[record["request"]].append(record)
+
+  def request(self, url, method, headers=None, body=None):
+    """Serves a recorded HTTP response.
+
+    Args:
+      url: The url to make the call to.
+      method: The type of call. POST, GET, etc.
+      headers: The HTTP headers for the request.
+      body: The request of the body.
+
+    Returns:
+      A tuple of a response and its content.
+
+    Raises:
+      CassetteMismatchError: The request was not recorded, or all recorded
+          responses for it have already been served.
+    """
+    key = _CassetteRequestKey(method, url)
+    if not self._records[key]:
+      raise CassetteMismatchError("No recorded response left for '%s'" % key)
+    record = self._records[key].popleft()
+    if self._original_timing:
+      self._clock.Sleep(record["elapsed"])
+    self.requests_served += 1
+    return httplib2.Response(record["response"]), record["content"]
+
+
 class UserService(issues.UserService):
   """GitHub user operations.
 
@@ -387,6 +1109,9 @@ class IssueService(issues.IssueService):
 
     Args:
       github_service: The GitHub service.
+      comment_delay: Seconds to sleep after posting a comment, to keep
+          GitHub's timestamps in order. Not needed when comments are posted
+          through an issues.CommentScheduler.
     """
     self._github_service = github_service
     self._comment_delay = comment_delay
@@ -400,11 +1125,12 @@ class IssueService(issues.IssueService):
                                  (self._github_service.github_owner_username,
                                   self._github_service.github_repo_name))
 
-  def GetIssues(self, state="open"):
+  def GetIssues(self, state="open", fields=None):
     """Gets all of the issue for the GitHub repository.
 
     Args:
       state: The state of the repository can be either 'open' or 'closed'.
+      fields: Optional names of the only fields needed of each issue.
 
     Returns:
       The list of all of the issues for the given repository.
@@ -412,12 +1138,15 @@ class IssueService(issues.IssueService):
     Raises:
       IOError: An error occurred accessing previously created issues.
     """
+    if fields:
+      # Needed to filter out pull requests.
+      fields = tuple(fields) + ("pull_request",)
     github_issues = []
     params = {"state": state, "per_page": 100, "page": 0}
     while True:
       params["page"] += 1
       response, content = self._github_service.PerformGetRequest(
-          self._github_issues_url, params=params)
+          self._github_issues_url, params=params, fields=fields)
       if not _CheckSuccessful(response):
         raise IOError("Failed to retrieve previous issues.\n\n%s" % content)
       if not content:
@@ -451,16 +1180,19 @@ class IssueService(issues.IssueService):
       issues.ServiceError: An error occurred creating the issue.
     """
     issue_title = googlecode_issue.GetTitle()
+    idempotency_key = googlecode_issue.GetIdempotencyKey()
     # NOTE: Only users with "push" access can set labels for new issues. See:
     # https://developer.github.com/v3/issues/#create-an-issue
     issue = {
         "title": issue_title,
-        "body": googlecode_issue.GetDescription(),
+        "body": issues.AddIdempotencyKey(
+            googlecode_issue.GetDescription(), idempotency_key),
         "assignee": googlecode_issue.GetOwner(),
         "labels": googlecode_issue.GetLabels(),
     }
     response, content = self._github_service.PerformPostRequest(
-        self._github_issues_url, json.dumps(issue))
+        self._github_issues_url, json.dumps(issue),
+        created_check=lambda: self._FindCreatedIssue(idempotency_key))
 
     if not _CheckSuccessful(response):
       # Newline character at the beginning of the line to allows for in-place
@@ -477,7 +1209,9 @@ class IssueService(issues.IssueService):
     issue_title = googlecode_issue.GetTitle()
     issue = {
         "title": issue_title,
-        "body": googlecode_issue.GetDescription(),
+        "body": issues.AddIdempotencyKey(
+            googlecode_issue.GetDescription(),
+            googlecode_issue.GetIdempotencyKey()),
         "assignee": googlecode_issue.GetOwner(),
         "labels": googlecode_issue.GetLabels(),
     }
@@ -516,27 +1250,40 @@ class IssueService(issues.IssueService):
       issue_number: The issue number on GitHub to post to.
       googlecode_comment: A GoogleCodeComment instance.
 
+    Returns:
+      The created comment (https://developer.github.com/v3/issues/comments/).
+
     Raises:
       issues.ServiceError: An error occurred creating the comment.
     """
     comment_url = "%s/%d/comments" % (self._github_issues_url, issue_number)
-    comment = googlecode_comment.GetDescription()
+    idempotency_key = googlecode_comment.GetIdempotencyKey()
+    comment = issues.AddIdempotencyKey(
+        googlecode_comment.GetDescription(), idempotency_key)
+    since = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(
+        self._github_service.clock.Now() - CREATED_CHECK_SLACK))
 
     json_body = json.dumps({"body": comment})
     response, content = self._github_service.PerformPostRequest(
-        comment_url, json_body)
+        comment_url, json_body,
+        created_check=lambda: self._FindCreatedComment(
+            issue_number, idempotency_key, since))
 
     if not _CheckSuccessful(response):
       raise issues.ServiceError(
           "\nFailed to create comment for issue #%d\n\n"
           "Response:\n%s\n\nContent:\n%s\n\n" %
           (issue_number, response, content))
-    time.sleep(self._comment_delay)
+    if self._comment_delay:
+      self._github_service.Sleep(self._comment_delay, "comment_delay")
+    return content
 
   def EditComment(self, googlecode_issue, googlecode_comment, comment_number):
     """Edits an existing comment."""
     comment_url = "%s/comments/%s" % (self._github_issues_url, comment_number)
-    comment = googlecode_comment.GetDescription()
+    comment = issues.AddIdempotencyKey(
+        googlecode_comment.GetDescription(),
+        googlecode_comment.GetIdempotencyKey())
 
     json_body = json.dumps({"body": comment})
     response, content = self._github_service.PerformPostRequest(
@@ -547,7 +1294,47 @@ class IssueService(issues.IssueService):
           "\nFailed to edit comment with number #%d\n\n"
           "Response:\n%s\n\nContent:\n%s\n\n" %
           (comment_number, response, content))
-    time.sleep(self._comment_delay)
+    if self._comment_delay:
+      self._github_service.Sleep(self._comment_delay, "comment_delay")
+
+  def _FindCreatedIssue(self, idempotency_key):
+    """Looks for an issue created with the given idempotency key.
+
+    Only the most recently created issues are checked, as that is where an
+    issue created by an ambiguously failed request would be.
+
+    Returns:
+      The issue, or None if it wasn't created.
+    """
+    params = {"state": "all", "sort": "created", "direction": "desc",
+              "per_page": CREATED_CHECK_PAGE_SIZE}
+    response, content = self._github_service.PerformGetRequest(
+        self._github_issues_url, params=params)
+    if not _CheckSuccessful(response):
+      raise IOError("Failed to retrieve recent issues.\n\n%s" % content)
+    for issue in content:
+      if issues.FindIdempotencyKey(issue.get("body")) == idempotency_key:
+        return issue
+    return None
+
+  def _FindCreatedComment(self, issue_number, idempotency_key, since):
+    """Looks for a comment created with the given idempotency key.
+
+    Only comments updated after 'since' (an ISO 8601 timestamp) are checked.
+
+    Returns:
+      The comment, or None if it wasn't created.
+    """
+    url = "%s/%s/comments" % (self._github_issues_url, issue_number)
+    params = {"since": since, "per_page": CREATED_CHECK_PAGE_SIZE}
+    response, content = self._github_service.PerformGetRequest(
+        url, params=params)
+    if not _CheckSuccessful(response):
+      raise IOError("Failed to retrieve recent comments.\n\n%s" % content)
+    for comment in content:
+      if issues.FindIdempotencyKey(comment.get("body")) == idempotency_key:
+        return comment
+    return None
 
   def _GetIssueNumber(self, content):
     """Get the issue number from a newly created GitHub issue.
@@ -16,7 +16,13 @@
 
 # pylint: disable=missing-docstring,protected-access
 
+import gzip
 import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 import urlparse
 
@@ -119,6 +125,11 @@ class TestGitHubService(unittest.TestCase):
     self.assertEqual(expected_fragment, actual_fragment)
     self.assertItemsEqual(expected_query_list, actual_query_list)
 
+  def testHttpRequestRecordsMetrics(self):
+    self.github_service._PerformHttpRequest("GET", "/test")
+    self.assertEqual(1, self.github_service.metrics.api_calls)
+    self.assertEqual(0, self.github_service.metrics.retries)
+
   def testGetRequest(self):
     self.github_service.PerformGetRequest("/test")
     self.assertEqual(self.http_mock.last_method, "GET")
@@ -132,6 +143,343 @@ class TestGitHubService(unittest.TestCase):
     self.assertEqual(self.http_mock.last_method, "PATCH")
 
 
+class RecordingClock(object):
+  """A clock which records sleeps instead of sleeping, at a fixed time."""
+
+  def __init__(self):
+    self.sleeps = []
+
+  def Now(self):
+    return 1000
+
+  def Sleep(self, seconds):
+    self.sleeps.append(seconds)
+
+
+class SequenceHttpMock(github_services.Http2Mock):
+  """Http2Mock returning a sequence of (response, content) pairs."""
+
+  def __init__(self, responses):
+    super(SequenceHttpMock, self).__init__()
+    self.responses = list(responses)
+    self.requests = 0
+
+  def request(self, url, method, headers=None, body=None):
+    super(SequenceHttpMock, self).request(url, method, headers, body)
+    self.requests += 1
+    response, content = self.responses.pop(0)
+    if isinstance(response, Exception):
+      raise response
+    return response, content
+
+
+class TestRetryPolicy(unittest.TestCase):
+  """Tests for retrying failed requests."""
+
+  def _CreateService(self, responses, circuit_breaker=None):
+    self.http_mock = SequenceHttpMock(responses)
+    return github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN,
+        rate_limit=False, http_instance=self.http_mock,
+        retry_policy=github_services.RetryPolicy(base_delay=0),
+        circuit_breaker=circuit_breaker)
+
+  def testClassifyResponse(self):
+    classify = github_services._ClassifyResponse
+    self.assertEqual(None, classify({"status": "201"}))
+    self.assertEqual(github_services.TRANSIENT_ERROR,
+                     classify({"status": "502"}))
+    self.assertEqual(github_services.RATE_LIMITED_ERROR,
+                     classify({"status": "403",
+                               "x-ratelimit-remaining": "0"}))
+    self.assertEqual(github_services.RATE_LIMITED_ERROR,
+                     classify({"status": "403", "retry-after": "60"}))
+    self.assertEqual(github_services.PERMANENT_ERROR,
+                     classify({"status": "422"}))
+
+  def testBackoffIsBounded(self):
+    policy = github_services.RetryPolicy(base_delay=1, max_delay=10)
+    for retries in range(10):
+      backoff = policy.GetBackoff(retries)
+      self.assertTrue(0 <= backoff <= min(10, 2 ** retries))
+
+  def testRetriesTransientErrors(self):
+    github_service = self._CreateService([
+        ({"status": "502"}, "<html>Bad Gateway</html>"),
+        (socket.error("Connection reset by peer"), None),
+        ({"status": "200"}, "{\"number\": 1}"),
+    ])
+    response, content = github_service.PerformGetRequest("/test")
+    self.assertEqual("200", response["status"])
+    self.assertEqual({"number": 1}, content)
+    self.assertEqual(3, self.http_mock.requests)
+
+  def testDoesNotRetryPermanentErrors(self):
+    github_service = self._CreateService([
+        ({"status": "422"}, "{\"message\": \"Validation Failed\"}"),
+    ])
+    response, content = github_service.PerformPostRequest("/test", "{}")
+    self.assertEqual("422", response["status"])
+    self.assertEqual({"message": "Validation Failed"}, content)
+    self.assertEqual(1, self.http_mock.requests)
+
+  def testTransientBudgetExhausted(self):
+    budget = github_services.RETRY_BUDGETS[github_services.TRANSIENT_ERROR]
+    github_service = self._CreateService(
+        [({"status": "503"}, "<html>Unavailable</html>")] * (budget + 1),
+        circuit_breaker=github_services.CircuitBreaker(
+            failure_threshold=budget + 2))
+    response, content = github_service.PerformGetRequest("/test")
+    self.assertEqual("503", response["status"])
+    self.assertEqual("<html>Unavailable</html>", content)
+    self.assertEqual(budget + 1, self.http_mock.requests)
+
+  def testRateLimitedWaitsForRetryAfter(self):
+    github_service = self._CreateService([
+        ({"status": "403", "retry-after": "0"}, "{}"),
+        ({"status": "200"}, "[]"),
+    ])
+    _, content = github_service.PerformGetRequest("/test")
+    self.assertEqual([], content)
+    self.assertIn("rate_limit", github_service.metrics.sleep_seconds)
+    self.assertEqual(2, self.http_mock.requests)
+
+  def testCircuitBreakerKeepsRetryingWhileDegraded(self):
+    budget = github_services.RETRY_BUDGETS[github_services.TRANSIENT_ERROR]
+    github_service = self._CreateService(
+        [({"status": "500"}, "")] * (budget * 2) + [({"status": "200"}, "{}")],
+        circuit_breaker=github_services.CircuitBreaker(
+            failure_threshold=2, reset_time=0))
+    response, _ = github_service.PerformGetRequest("/test")
+    self.assertEqual("200", response["status"])
+    self.assertEqual(budget * 2 + 1, self.http_mock.requests)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+  """Tests for the CircuitBreaker."""
+
+  def testOpensAndCloses(self):
+    now = [100]
+    breaker = github_services.CircuitBreaker(
+        failure_threshold=2, reset_time=10, max_reset_time=15,
+        clock=lambda: now[0])
+    breaker.RecordFailure()
+    self.assertFalse(breaker.IsOpen())
+    breaker.RecordFailure()
+    self.assertTrue(breaker.IsOpen())
+    self.assertEqual(10, breaker.GetWaitTime())
+    now[0] += 10
+    self.assertEqual(0, breaker.GetWaitTime())
+    # The probe fails, so the reset time doubles up to the maximum.
+    breaker.RecordFailure()
+    self.assertEqual(15, breaker.GetWaitTime())
+    breaker.RecordSuccess()
+    self.assertFalse(breaker.IsOpen())
+    self.assertEqual(0, breaker.GetWaitTime())
+
+
+class TestRateLimitBudget(unittest.TestCase):
+  """Tests for the RateLimitBudget."""
+
+  def setUp(self):
+    self.now = [1000]
+    self.budget = github_services.RateLimitBudget(
+        hourly_limit=10, writes_per_minute=30, clock=lambda: self.now[0])
+
+  def testUnknownBudgetAllowsRequests(self):
+    self.assertEqual(0, self.budget.Acquire("a"))
+    self.assertEqual(0, self.budget.Acquire("a"))
+
+  def testWaitsForResetWhenExhausted(self):
+    self.budget.Update({"x-ratelimit-remaining": "1",
+                        "x-ratelimit-reset": "1100"})
+    self.assertEqual(0, self.budget.Acquire("a"))
+    self.assertEqual(101, self.budget.Acquire("a"))
+    self.now[0] = 1100
+    self.assertEqual(0, self.budget.Acquire("a"))
+
+  def testSharesByWeight(self):
+    self.budget.Register("a", weight=1)
+    self.budget.Register("b", weight=4)
+    self.budget.Update({"x-ratelimit-remaining": "10",
+                        "x-ratelimit-reset": "1100"})
+    # 'a' is entitled to 2 requests, and the 8 left are reserved for 'b'.
+    self.assertEqual(0, self.budget.Acquire("a"))
+    self.assertEqual(0, self.budget.Acquire("a"))
+    self.assertEqual(101, self.budget.Acquire("a"))
+    for _ in range(7):
+      self.assertEqual(0, self.budget.Acquire("b"))
+    self.assertEqual(101, self.budget.Acquire("a"))
+    # Once 'b' is gone 'a' may have the rest.
+    self.budget.Unregister("b")
+    self.assertEqual(0, self.budget.Acquire("a"))
+
+  def testOutOfOrderResponses(self):
+    self.budget.Update({"x-ratelimit-remaining": "3",
+                        "x-ratelimit-reset": "1100"})
+    self.budget.Update({"x-ratelimit-remaining": "5",
+                        "x-ratelimit-reset": "1100"})
+    self.assertEqual(3, self.budget._remaining)
+    self.budget.Update({"x-ratelimit-remaining": "9",
+                        "x-ratelimit-reset": "4700"})
+    self.assertEqual(9, self.budget._remaining)
+
+  def testWritesAreSpacedOut(self):
+    self.assertEqual(0, self.budget.ReserveWrite())
+    self.assertEqual(2, self.budget.ReserveWrite())
+    self.assertEqual(4, self.budget.ReserveWrite())
+    self.now[0] += 10
+    self.assertEqual(0, self.budget.ReserveWrite())
+
+  def testServicesShareBudget(self):
+    http_mock = SequenceHttpMock([
+        ({"status": "200", "x-ratelimit-remaining": "0",
+          "x-ratelimit-reset": "1100"}, "{}"),
+    ])
+    services = [github_services.GitHubService(
+        GITHUB_USERNAME, repo, GITHUB_TOKEN, rate_limit=False,
+        http_instance=http_mock, rate_limit_budget=self.budget)
+                for repo in ("one", "two")]
+    services[0].PerformGetRequest("/test")
+    self.assertEqual(101, self.budget.Acquire(services[1]))
+    services[0].Close()
+    services[1].Close()
+    self.assertEqual({}, self.budget._weights)
+
+  def testConcurrentWritersShareWriteRate(self):
+    budget = github_services.RateLimitBudget(clock=lambda: 1000)
+    recording_clock = RecordingClock()
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=True,
+        http_instance=SequenceHttpMock([({"status": "201"}, "{}")] * 12),
+        clock_instance=recording_clock, rate_limit_budget=budget)
+    def Work():
+      for _ in range(3):
+        github_service.PerformPostRequest("/comments", "{}")
+    threads = [threading.Thread(target=Work) for _ in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    # The 4 workers together write at the abuse limit, not 4 times over it.
+    interval = 60.0 / github_services.ABUSE_LIMIT_WRITES_PER_MINUTE
+    self.assertEqual([interval * i for i in range(1, 12)],
+                     sorted(recording_clock.sleeps))
+
+  def testEditsShareWriteRate(self):
+    budget = github_services.RateLimitBudget(clock=lambda: 1000)
+    recording_clock = RecordingClock()
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=True,
+        http_instance=SequenceHttpMock([({"status": "200"}, "{}")] * 3),
+        clock_instance=recording_clock, rate_limit_budget=budget)
+    github_service.PerformPatchRequest("/issues/1", "{}")
+    github_service.PerformPostRequest("/issues/1/comments", "{}")
+    github_service.PerformPatchRequest("/issues/1", "{}")
+    interval = 60.0 / github_services.ABUSE_LIMIT_WRITES_PER_MINUTE
+    self.assertEqual([interval, 2 * interval], recording_clock.sleeps)
+
+
+class TestTokenPool(unittest.TestCase):
+  """Tests for spreading reads over a TokenPool."""
+
+  def _CreateService(self, responses):
+    self.http_mock = SequenceHttpMock(responses)
+    self.token_pool = github_services.TokenPool(
+        [GITHUB_TOKEN, "read_token"], clock=lambda: 1000)
+    return github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=False,
+        http_instance=self.http_mock, token_pool=self.token_pool)
+
+  def _GetToken(self):
+    query = urlparse.parse_qs(urlparse.urlparse(self.http_mock.last_url).query)
+    return query["access_token"][0]
+
+  def testReadsUseTokenWithMostRemaining(self):
+    github_service = self._CreateService([
+        ({"status": "200", "x-ratelimit-remaining": "10"}, "[]"),
+        ({"status": "200", "x-ratelimit-remaining": "20"}, "[]"),
+        ({"status": "200", "x-ratelimit-remaining": "19"}, "[]"),
+    ])
+    github_service.PerformGetRequest("/test")
+    self.assertEqual(GITHUB_TOKEN, self._GetToken())
+    github_service.PerformGetRequest("/test")
+    self.assertEqual("read_token", self._GetToken())
+    github_service.PerformGetRequest("/test")
+    self.assertEqual("read_token", self._GetToken())
+
+  def testWritesUseOwnerToken(self):
+    github_service = self._CreateService([
+        ({"status": "200", "x-ratelimit-remaining": "0"}, "[]"),
+        ({"status": "201"}, "{}"),
+    ])
+    github_service.PerformGetRequest("/test")
+    github_service.PerformPostRequest("/test", "{}")
+    self.assertEqual(GITHUB_TOKEN, self._GetToken())
+
+  def testRateLimitedReadSwitchesToken(self):
+    github_service = self._CreateService([
+        ({"status": "403", "x-ratelimit-remaining": "0",
+          "x-ratelimit-reset": "4600"}, "{}"),
+        ({"status": "200"}, "[]"),
+    ])
+    github_service.PerformGetRequest("/test")
+    self.assertEqual("read_token", self._GetToken())
+    self.assertNotIn("rate_limit", github_service.metrics.sleep_seconds)
+    self.assertTrue(self.token_pool.HasQuota())
+
+
+class TestCassettes(unittest.TestCase):
+  """Tests for the RecordingHttp and ReplayHttp transports."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.cassette_path = os.path.join(self.temp_dir, "cassette.gz")
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _Record(self):
+    http_mock = github_services.Http2Mock()
+    recording_http = github_services.RecordingHttp(
+        self.cassette_path, http_instance=http_mock)
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN,
+        rate_limit=False, http_instance=recording_http)
+    http_mock.content = {"number": 1}
+    github_service.PerformPostRequest("/test", "{}")
+    http_mock.content = {"number": 2}
+    github_service.PerformPostRequest("/test", "{}")
+    http_mock.content = [{"id": 3}]
+    github_service.PerformGetRequest("/other", params={"page": 1})
+    recording_http.Close()
+
+  def testRecordDropsAccessToken(self):
+    self._Record()
+    with gzip.open(self.cassette_path, "rb") as cassette:
+      self.assertNotIn(GITHUB_TOKEN, cassette.read())
+
+  def testReplay(self):
+    self._Record()
+    replay_http = github_services.ReplayHttp(self.cassette_path)
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, "another_token",
+        rate_limit=False, http_instance=replay_http)
+    _, content = github_service.PerformGetRequest("/other", params={"page": 1})
+    self.assertEqual([{"id": 3}], content)
+    _, content = github_service.PerformPostRequest("/test", "{}")
+    self.assertEqual({"number": 1}, content)
+    _, content = github_service.PerformPostRequest("/test", "{}")
+    self.assertEqual({"number": 2}, content)
+    self.assertEqual(3, replay_http.requests_served)
+
+  def testReplayMismatch(self):
+    self._Record()
+    replay_http = github_services.ReplayHttp(self.cassette_path)
+    with self.assertRaises(github_services.CassetteMismatchError):
+      replay_http.request(GITHUB_API_URL + "/unknown", "GET")
+
+
 class TestUserService(unittest.TestCase):
   """Tests for the UserService."""
 
@@ -183,7 +531,8 @@ class TestIssueService(unittest.TestCase):
     self.assertEqual(self.http_mock.last_url, uri)
     # The issue body gets rewritten slightly to preserve origin issue IDs.
     issue_body["body"] = (
-      "Originally reported on Google Code with ID 1\n" + issue_body["body"])
+      "Originally reported on Google Code with ID 1\n" + issue_body["body"] +
+      "\n<!-- googlecode-export-key: issue-1 -->\n")
     self.assertEqual(self.http_mock.last_body, json.dumps(issue_body))
     self.assertEqual(1, issue_number)
 
@@ -200,7 +549,8 @@ class TestIssueService(unittest.TestCase):
     comment_body = (
         "```\none\n```\n\nReported by `a_uthor` on last year\n"
         "- **Labels added**: added-label\n"
-        "- **Labels removed**: removed-label\n")
+        "- **Labels removed**: removed-label\n"
+        "\n<!-- googlecode-export-key: issue-1-comment-1 -->\n")
     self.github_issue_service.CreateComment(1, SINGLE_COMMENT)
     self.assertEqual(self.http_mock.last_method, "POST")
     uri = ("%s/repos/%s/%s/issues/%d/comments?access_token=%s" %
@@ -209,6 +559,36 @@ class TestIssueService(unittest.TestCase):
     self.assertEqual(self.http_mock.last_body,
                      json.dumps({"body": comment_body}))
 
+  def _CreateIdempotentService(self, responses):
+    self.http_mock = SequenceHttpMock(responses)
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN,
+        rate_limit=False, http_instance=self.http_mock,
+        retry_policy=github_services.RetryPolicy(base_delay=0))
+    return github_services.IssueService(github_service, comment_delay=0)
+
+  def testCreateCommentAfterAmbiguousFailureFound(self):
+    created = {"id": 7, "body": "...\n<!-- googlecode-export-key: "
+                                "issue-1-comment-1 -->\n"}
+    issue_service = self._CreateIdempotentService([
+        (socket.timeout("timed out"), None),
+        ({"status": "200"}, json.dumps([{"id": 6, "body": "other"}, created])),
+    ])
+    self.assertEqual(created, issue_service.CreateComment(1, SINGLE_COMMENT))
+    self.assertEqual(2, self.http_mock.requests)
+    self.assertEqual("GET", self.http_mock.last_method)
+    self.assertIn("since=", self.http_mock.last_url)
+
+  def testCreateIssueAfterAmbiguousFailureNotFound(self):
+    issue_service = self._CreateIdempotentService([
+        ({"status": "502"}, "<html>Bad Gateway</html>"),
+        ({"status": "200"}, json.dumps([{"number": 3, "body": None}])),
+        ({"status": "201"}, json.dumps({"number": 4})),
+    ])
+    self.assertEqual(4, issue_service.CreateIssue(SINGLE_ISSUE))
+    self.assertEqual(3, self.http_mock.requests)
+    self.assertEqual("POST", self.http_mock.last_method)
+
   def testGetIssueNumber(self):
     issue = {"number": 1347}
     issue_number = self.github_issue_service._GetIssueNumber(issue)
@@ -225,6 +605,82 @@ class TestIssueService(unittest.TestCase):
     with self.assertRaises(IOError):
       github_issue_service.GetIssues()
 
+  def testGetIssuesProjected(self):
+    http_mock = SequenceHttpMock([
+        ({"status": "200"}, json.dumps([
+            {"number": 1, "title": "First", "body": "{\"title\": 2}",
+             "user": {"login": "a", "number": 7}, "comments": 3},
+            {"number": 2, "title": "Pull", "pull_request": {"url": "x"}},
+        ])),
+        ({"status": "200"}, "[]"),
+    ])
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=False,
+        http_instance=http_mock)
+    github_issue_service = github_services.IssueService(
+        github_service, comment_delay=0)
+    self.assertEqual([{"number": 1, "title": "First", "comments": 3}],
+                     github_issue_service.GetIssues(
+                         fields=("number", "title", "comments")))
+
+
+class TestProjectedGetRequest(unittest.TestCase):
+  """Tests for keeping only some fields of a list of objects."""
+
+  def _Get(self, *contents):
+    self.http_mock = SequenceHttpMock(
+        [({"status": "200"}, content) for content in contents])
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=False,
+        http_instance=self.http_mock,
+        retry_policy=github_services.RetryPolicy(base_delay=0))
+    return github_service.PerformGetRequest("/issues", fields=["a", "c"])[1]
+
+  def testKeepsOnlyFields(self):
+    content = json.dumps([
+        {"a": 1, "b": {"a": 2}, "c": "x, \"}]", "d": [None, True]},
+        {"c": None, "a": -1.5e3},
+        {},
+    ], indent=2)
+    self.assertEqual([{"a": 1, "c": "x, \"}]"}, {"a": -1500.0, "c": None}, {}],
+                     self._Get(content))
+    self.assertEqual([], self._Get(" [ ]"))
+
+  def testIdempotencyKeyField(self):
+    content = json.dumps([
+        {"number": 1, "body": issues.AddIdempotencyKey("text", "issue-3")},
+        {"number": 2, "body": "text"},
+        {"number": 3, "body": None},
+    ])
+    self.http_mock = SequenceHttpMock([({"status": "200"}, content)])
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=False,
+        http_instance=self.http_mock)
+    self.assertEqual(
+        [{"number": 1, "idempotency_key": "issue-3"},
+         {"number": 2, "idempotency_key": None},
+         {"number": 3, "idempotency_key": None}],
+        github_service.PerformGetRequest(
+            "/issues", fields=["number", issues.IDEMPOTENCY_KEY_FIELD])[1])
+
+  def testNotAListIsRetried(self):
+    self.assertEqual([{"a": 1}], self._Get('{"message": "Not Found"}',
+                                           '[{"a": 1, "b": 2}]'))
+    self.assertEqual(2, self.http_mock.requests)
+
+  def testTruncatedPageIsRetried(self):
+    http_mock = SequenceHttpMock([
+        ({"status": "200"}, '[{"number": 1}, {"numb'),
+        ({"status": "200"}, '[{"number": 1, "title": "t"}]'),
+    ])
+    github_service = github_services.GitHubService(
+        GITHUB_USERNAME, GITHUB_REPO, GITHUB_TOKEN, rate_limit=False,
+        http_instance=http_mock,
+        retry_policy=github_services.RetryPolicy(base_delay=0))
+    _, content = github_service.PerformGetRequest("/issues", fields=["number"])
+    self.assertEqual([{"number": 1}], content)
+    self.assertEqual(2, http_mock.requests)
+
 
 if __name__ == "__main__":
   unittest.main(buffer=True)
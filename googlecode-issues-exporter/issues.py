@@ -15,14 +15,40 @@
 """Tool for uploading Google Code issues to an issue service.
 """
 
+import argparse
+import bisect
+import bz2
 import collections
 import datetime
+import gzip
+import hashlib
 import json
+import marshal
+import mmap
+import os
+import Queue
 import re
 import sys
+import threading
+import zipfile
+# datetime.strptime lazily imports _strptime, which isn't thread-safe. Import
+# it up front since comments are formatted on CommentScheduler threads.
+import _strptime  # pylint: disable=unused-import
 
 import HTMLParser
 
+import metrics
+
+# lzma is only in the standard library from Python 3, .xz files need the
+# backports.lzma package otherwise.
+try:
+  import lzma  # pylint: disable=g-import-not-at-top
+except ImportError:
+  try:
+    from backports import lzma  # pylint: disable=g-import-not-at-top
+  except ImportError:
+    lzma = None
+
 
 # Regular expression used by Google Code for auto-linking issue references,
 # e.g. "issue #8" or "bug5".
@@ -37,6 +63,45 @@ GC_ISSUE_REF_RE = re.compile(r"""
 EX_ISSUE_REF_RE = re.compile(
     r"- \*\*(?P<tag>([^\*]+))\*\*: #(?P<issues>([^\n]+))")
 
+# The default number of issues whose comments are posted concurrently by a
+# CommentScheduler.
+DEFAULT_COMMENT_WORKERS = 4
+# The default number of issues filled in concurrently by a two-phase export.
+DEFAULT_FILL_WORKERS = 8
+# The number of changed issues synced between saves of the sync manifest.
+SYNC_MANIFEST_SAVE_INTERVAL = 100
+# The body of the placeholder issues created by a two-phase export.
+PLACEHOLDER_DESCRIPTION = "Migrating Google Code issue #%s, stay tuned."
+
+# Hidden marker embedded in exported issue and comment bodies, identifying the
+# Google Code issue or comment they were created from.
+IDEMPOTENCY_KEY_FORMAT = "\n<!-- googlecode-export-key: %s -->\n"
+IDEMPOTENCY_KEY_RE = re.compile(r"<!-- googlecode-export-key: (?P<key>\S+) -->")
+# A field which can be requested of exported issues, holding the idempotency
+# key found in the body instead of the whole body.
+IDEMPOTENCY_KEY_FIELD = "idempotency_key"
+
+# The JSON tokens needed to find the structure of a Takeout file: strings (keys
+# when followed by a colon) and the brackets of objects and arrays. Numbers and
+# literals don't matter and are skipped.
+JSON_STRUCTURE_RE = re.compile(r"""
+    (?P<string>"[^"\\]*(?:\\.[^"\\]*)*")(?P<colon>\s*:)?
+  | (?P<open>[\[{])
+  | (?P<close>[\]}])""", re.VERBOSE | re.DOTALL)
+
+# A path to a .zip archive, optionally followed by the path of a member.
+ZIP_PATH_RE = re.compile(r"^(?P<archive>.*?\.zip)(?:[/\\](?P<member>.*))?$",
+                         re.IGNORECASE)
+# The fields of previously exported issues needed to match them to the Takeout.
+EXPORTED_ISSUE_FIELDS = ("number", "title", "comments", IDEMPOTENCY_KEY_FIELD)
+# The version of the issue cache format. Caches are also rebuilt whenever the
+# source of this module changes, see _GetSourceDigest, so the version only
+# needs bumping if the cached data changes because of another module.
+ISSUE_CACHE_VERSION = 1
+# The size of the blocks at the start and the end of a Takeout hashed into the
+# issue cache key.
+ISSUE_CACHE_SAMPLE_SIZE = 1 << 20
+
 def RemapIssueIds(comment, id_mapping):
   """Rewrite a comment's text based on an ID mapping.
 
@@ -95,6 +160,17 @@ def _ParseIssueReferences(issue_ref_list):
   return added, removed
 
 
+def AddIdempotencyKey(body, idempotency_key):
+  """Returns the body with a hidden idempotency key appended."""
+  return body + IDEMPOTENCY_KEY_FORMAT % idempotency_key
+
+
+def FindIdempotencyKey(body):
+  """Returns the idempotency key embedded in the body, or None."""
+  match = IDEMPOTENCY_KEY_RE.search(body or "")
+  return match.group("key") if match else None
+
+
 class IdentityDict(dict):
   def __missing__(self, key):
     return key
@@ -222,13 +298,21 @@ class GoogleCodeIssue(object):
     """
     return self._issue["id"]
 
+  def GetIdempotencyKey(self):
+    """Get a key identifying this issue across export attempts.
+
+    Returns:
+      A string, e.g. 'issue-42'.
+    """
+    return "issue-%s" % self.GetId()
+
   def GetLabels(self):
     """Get the labels from a Google Code issue.
 
     Returns:
       A list of the labels of this issue.
     """
-    labels = self._issue.get("labels", [])
+    labels = list(self._issue.get("labels", []))
     # Add status as a label.
     if "status" in self._issue:
       labels.append("Status-" + self._issue["status"])
@@ -376,6 +460,15 @@ class GoogleCodeComment(object):
     """
     return self._comment["id"]
 
+  def GetIdempotencyKey(self):
+    """Get a key identifying this comment across export attempts.
+
+    Returns:
+      A string, e.g. 'issue-42-comment-3'.
+    """
+    return "%s-comment-%s" % (
+        self._googlecode_issue.GetIdempotencyKey(), self.GetId())
+
   def GetLabels(self):
     """Get the labels modified with the comment."""
     if "updates" in self._comment:
@@ -414,6 +507,10 @@ class GoogleCodeComment(object):
 
   def GetDescription(self):
     """Returns the Description of the comment."""
+    return RemapIssueIds(self.GetSourceDescription(), self._id_mapping)
+
+  def GetSourceDescription(self):
+    """Returns the Description of the comment, before remapping issue IDs."""
     author = self.GetAuthor()
     comment_date = self.GetCreatedOn()
     comment_text = self.GetContent()
@@ -452,8 +549,7 @@ class GoogleCodeComment(object):
     # inserts a horizontal rule.)
     footer += self._GetAttachmentInfo()
 
-    raw_comment_body = body + footer
-    return RemapIssueIds(raw_comment_body, self._id_mapping)
+    return body + footer
 
   def _GetLabelInfo(self):
     """Returns Markdown text for a comment's labels as appropriate."""
@@ -536,11 +632,13 @@ class IssueService(object):
   Handles creating and updating issues and comments on an user API.
   """
 
-  def GetIssues(self, state="open"):
+  def GetIssues(self, state="open", fields=None):
     """Gets all of the issue for the repository with the given state.
 
     Args:
       state: The state of the repository can be either 'open' or 'closed'.
+      fields: Optional names of the only fields needed of each issue, others
+          may be left out. IDEMPOTENCY_KEY_FIELD may be among them.
 
     Returns:
       The list of all of the issues with the given state.
@@ -594,12 +692,18 @@ class IssueService(object):
     raise NotImplementedError()
 
 
-def LoadIssueData(issue_file_path, project_name):
+def LoadIssueData(issue_file_path, project_name, lazy=False,
+                  use_cache=False):
   """Loads issue data from a file.
 
   Args:
     issue_file_path: path to the file to load
     project_name: name of the project to load
+    lazy: whether to return a LazyIssueList, decoding issues on access,
+        rather than decoding the whole file up front.
+    use_cache: whether to load the issues from the issue cache next to the
+        file, see GetIssueCachePath, and to create it if it's missing or
+        stale. Not used when lazy.
 
   Returns:
     Issue data as a list of dictionaries.
@@ -607,7 +711,12 @@ def LoadIssueData(issue_file_path, project_name):
   Raises:
     ProjectNotFoundError: the project_name was not found in the file.
   """
-  with open(issue_file_path) as user_file:
+  if lazy:
+    return LazyIssueList.Load(issue_file_path, project_name)
+  if use_cache:
+    return _LoadCachedIssueData(issue_file_path, project_name)
+
+  with OpenIssueFile(issue_file_path) as user_file:
     user_data = json.load(user_file)
     user_projects = user_data["projects"]
 
@@ -618,6 +727,316 @@ def LoadIssueData(issue_file_path, project_name):
   raise ProjectNotFoundError("Project %s not found" % project_name)
 
 
+def _GetTakeoutFilePath(issue_file_path):
+  """Returns the path of the file holding a Takeout, e.g. its .zip archive."""
+  match = ZIP_PATH_RE.match(issue_file_path)
+  if match and os.path.isfile(match.group("archive")):
+    return match.group("archive")
+  return issue_file_path
+
+
+def GetIssueCachePath(issue_file_path, project_name):
+  """Returns the path of the issue cache of a project.
+
+  The cache is stored next to the Takeout, one per project.
+  """
+  return "%s.%s.issuecache" % (_GetTakeoutFilePath(issue_file_path),
+                               re.sub(r"[^\w.-]", "_", project_name))
+
+
+# The hash of the source of this module, see _GetSourceDigest.
+_source_digest = None
+
+
+def _GetSourceDigest():
+  """Returns the hash of the source of this module, or "" if unreadable.
+
+  It is part of the issue cache key, so that changing how issues are loaded
+  invalidates the caches.
+  """
+  global _source_digest
+  if _source_digest is None:
+    try:
+      with open(os.path.splitext(__file__)[0] + ".py", "rb") as source_file:
+        _source_digest = hashlib.sha1(source_file.read()).hexdigest()
+    except IOError:
+      _source_digest = ""
+  return _source_digest
+
+
+def _GetIssueCacheKey(issue_file_path, project_name):
+  """Returns what identifies the Takeout an issue cache was created from.
+
+  It also holds the cache version and the hash of this module's source.
+  Hashing a multi-GB Takeout would take as long as parsing it, so only its
+  first and last blocks are hashed, along with its size and mtime.
+  """
+  takeout_path = _GetTakeoutFilePath(issue_file_path)
+  stat = os.stat(takeout_path)
+  digest = hashlib.sha1()
+  with open(takeout_path, "rb") as takeout_file:
+    digest.update(takeout_file.read(ISSUE_CACHE_SAMPLE_SIZE))
+    if stat.st_size > ISSUE_CACHE_SAMPLE_SIZE:
+      takeout_file.seek(-min(ISSUE_CACHE_SAMPLE_SIZE,
+                             stat.st_size - ISSUE_CACHE_SAMPLE_SIZE),
+                        os.SEEK_END)
+      digest.update(takeout_file.read())
+  return {
+      "version": ISSUE_CACHE_VERSION,
+      "source": _GetSourceDigest(),
+      "path": issue_file_path,
+      "project": project_name,
+      "size": stat.st_size,
+      "mtime": stat.st_mtime,
+      "sha1": digest.hexdigest(),
+  }
+
+
+def _LoadCachedIssueData(issue_file_path, project_name):
+  """Loads issue data from the issue cache, creating it if needed.
+
+  The cache holds the key from _GetIssueCacheKey followed by the issues,
+  both marshaled, which loads an order of magnitude faster than JSON.
+
+  Raises:
+    ProjectNotFoundError: the project_name was not found in the file.
+  """
+  cache_path = GetIssueCachePath(issue_file_path, project_name)
+  key = _GetIssueCacheKey(issue_file_path, project_name)
+  try:
+    with open(cache_path, "rb") as cache_file:
+      if marshal.load(cache_file) == key:
+        return marshal.load(cache_file)
+  except (IOError, EOFError, ValueError, TypeError):
+    # Missing or corrupt, rebuild it.
+    pass
+
+  issue_data = LoadIssueData(issue_file_path, project_name)
+  temp_path = cache_path + ".tmp"
+  try:
+    with open(temp_path, "wb") as cache_file:
+      marshal.dump(key, cache_file)
+      marshal.dump(issue_data, cache_file)
+    os.rename(temp_path, cache_path)
+  except (IOError, OSError), e:
+    # The cache only saves time, the export can go on without it.
+    print "Could not write the issue cache %s: %s" % (cache_path, e)
+  return issue_data
+
+
+def _OpenXz(path):
+  """Opens an .xz file for reading."""
+  if lzma is None:
+    raise IOError("Reading %s requires the lzma module" % path)
+  return lzma.LZMAFile(path)
+
+
+# Openers of compressed files, by extension.
+DECOMPRESSORS = {
+    ".gz": gzip.GzipFile,
+    ".bz2": bz2.BZ2File,
+    ".xz": _OpenXz,
+}
+
+
+def OpenIssueFile(issue_file_path):
+  """Opens a Takeout file for reading, decompressing it on the fly.
+
+  Files ending in .gz, .bz2 or .xz are decompressed as they are read. A path
+  inside a .zip archive, such as "takeout.zip/GoogleCodeProjectHosting.json",
+  reads that member, and the path of the archive itself reads its only JSON
+  member.
+
+  Args:
+    issue_file_path: The path of the file.
+
+  Returns:
+    A file-like object, to be closed after use.
+
+  Raises:
+    IOError: The file can't be opened.
+  """
+  extension = os.path.splitext(issue_file_path)[1].lower()
+  if extension in DECOMPRESSORS:
+    return DECOMPRESSORS[extension](issue_file_path)
+  match = ZIP_PATH_RE.match(issue_file_path)
+  if match and os.path.isfile(match.group("archive")):
+    return _OpenZipMember(match.group("archive"), match.group("member"))
+  return open(issue_file_path, "rb")
+
+
+def _OpenZipMember(archive_path, member):
+  """Opens a member of a .zip archive for reading.
+
+  Args:
+    archive_path: The path of the archive.
+    member: The name of the member, or None for the only JSON member.
+
+  Returns:
+    A file-like object, to be closed after use.
+
+  Raises:
+    IOError: The member doesn't exist or can't be guessed.
+  """
+  try:
+    archive = zipfile.ZipFile(archive_path)
+  except zipfile.BadZipfile, e:
+    raise IOError("%s: %s" % (archive_path, e))
+  if member is None:
+    members = [name for name in archive.namelist()
+               if name.lower().endswith(".json")]
+    if len(members) != 1:
+      archive.close()
+      raise IOError("%s has %d JSON files, add the one to read to the path" %
+                    (archive_path, len(members)))
+    member = members[0]
+  try:
+    return _ZipMemberFile(archive, archive.open(member))
+  except KeyError:
+    archive.close()
+    raise IOError("%s has no member %s" % (archive_path, member))
+
+
+class _ZipMemberFile(object):
+  """A member of a .zip archive, closing the archive along with it."""
+
+  def __init__(self, archive, member_file):
+    self._archive = archive
+    self._member_file = member_file
+
+  def read(self, size=-1):
+    return self._member_file.read(size)
+
+  def close(self):
+    self._member_file.close()
+    self._archive.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def _FindIssueSlices(buf, project_name):
+  """Finds where the project's issues are in an undecoded Takeout.
+
+  Args:
+    buf: The Takeout JSON, as a string or mmap.
+    project_name: The name of the project.
+
+  Returns:
+    A list of (start, end) offsets of the project's issue objects, or None if
+    the project was not found.
+  """
+  # The open containers, as (bracket, key in the parent, start offset). The
+  # issues are the objects at root{projects[{issues{items[{.
+  stack = []
+  key = None
+  name = None
+  slices = []
+  for match in JSON_STRUCTURE_RE.finditer(buf):
+    depth = len(stack)
+    if match.group("colon"):
+      # Only keys outside of the issues matter.
+      key = json.loads(match.group("string")) if depth <= 5 else None
+    elif match.group("open"):
+      stack.append((match.group("open"), key, match.start()))
+      key = None
+    elif match.group("close"):
+      _, _, start = stack.pop()
+      key = None
+      if (depth == 6 and stack[1][1] == "projects" and
+          stack[3][1] == "issues" and stack[4][1] == "items"):
+        slices.append((start, match.end()))
+      elif depth == 3 and stack[1][1] == "projects":
+        if name == project_name:
+          return slices
+        name = None
+        slices = []
+    else:
+      if depth == 3 and key == "name" and stack[1][1] == "projects":
+        name = json.loads(match.group("string"))
+      key = None
+  return None
+
+
+class LazyIssueList(object):
+  """The issues of a project, decoded one at a time.
+
+  Each issue is kept as an undecoded slice of the Takeout (memory-mapped when
+  loaded from a file), and decoded when accessed. Decoded issues aren't kept,
+  so memory use only depends on the issues being worked on rather than on the
+  size of the project.
+  """
+
+  def __init__(self, buf, slices, closer=None):
+    """Initialize the LazyIssueList.
+
+    Args:
+      buf: The Takeout JSON, as a string or mmap.
+      slices: The (start, end) offsets of the issues in buf.
+      closer: Optional function releasing buf.
+    """
+    self._buf = buf
+    self._slices = slices
+    self._closer = closer
+
+  @staticmethod
+  def Load(issue_file_path, project_name):
+    """Memory-maps a Takeout file and finds the project's issues.
+
+    Compressed files can't be mapped, they are decompressed into memory
+    instead, which still takes a fraction of the decoded issues.
+
+    Raises:
+      ProjectNotFoundError: the project_name was not found in the file.
+    """
+    issue_file = OpenIssueFile(issue_file_path)
+    buf = None
+    if isinstance(issue_file, file):
+      try:
+        buf = mmap.mmap(issue_file.fileno(), 0, access=mmap.ACCESS_READ)
+      except (ValueError, mmap.error):
+        # Empty files can't be mapped.
+        pass
+    if buf is None:
+      buf = issue_file.read()
+    slices = _FindIssueSlices(buf, project_name)
+    if slices is None:
+      issue_file.close()
+      raise ProjectNotFoundError("Project %s not found" % project_name)
+
+    def Close():
+      if isinstance(buf, mmap.mmap):
+        buf.close()
+      issue_file.close()
+
+    return LazyIssueList(buf, slices, Close)
+
+  def __len__(self):
+    return len(self._slices)
+
+  def __getitem__(self, position):
+    start, end = self._slices[position]
+    return json.loads(self._buf[start:end])
+
+  def __iter__(self):
+    for position in range(len(self._slices)):
+      yield self[position]
+
+  def Subset(self, positions):
+    """Returns a LazyIssueList of the issues at the given positions."""
+    return LazyIssueList(self._buf,
+                         [self._slices[position] for position in positions])
+
+  def Close(self):
+    """Releases the Takeout. The issues can't be accessed afterwards."""
+    if self._closer:
+      self._closer()
+      self._closer = None
+
+
 def LoadUserData(user_file_path, user_service):
   """Loads user data from a file. If not present, the user name will
   just return whatever is passed to it.
@@ -642,6 +1061,510 @@ def LoadUserData(user_file_path, user_service):
   return result
 
 
+class IssueFilter(object):
+  """Selects a subset of the Google Code issues to export.
+
+  Every criterion that is set must match. Within a criterion any of the given
+  values may match, except for labels, which must all be present.
+  """
+
+  def __init__(self, id_ranges=None, states=None, labels=None, authors=None,
+               published_after=None, published_before=None):
+    """Initialize the IssueFilter.
+
+    Args:
+      id_ranges: A list of inclusive (first, last) issue ID ranges.
+      states: A list of issue states, i.e. 'open' or 'closed'.
+      labels: A list of labels the issues must all have, case-insensitive.
+      authors: A list of author email addresses, as in the Takeout.
+      published_after: Only issues published on or after this date, as an
+          ISO 8601 string, e.g. '2014-01-31'.
+      published_before: Only issues published before this date.
+    """
+    self.id_ranges = id_ranges
+    self.states = states
+    self.labels = labels
+    self.authors = authors
+    self.published_after = published_after
+    self.published_before = published_before
+
+  def IsEmpty(self):
+    """Returns whether the filter selects every issue."""
+    return not (self.id_ranges or self.states or self.labels or
+                self.authors or self.published_after or
+                self.published_before)
+
+
+def ParseIdRanges(id_ranges):
+  """Parses issue ID ranges such as '1-100,205'.
+
+  Args:
+    id_ranges: A comma separated list of IDs and inclusive ID ranges.
+
+  Returns:
+    A list of (first, last) tuples.
+
+  Raises:
+    ValueError: The ranges are malformed.
+  """
+  result = []
+  for part in id_ranges.split(","):
+    bounds = part.strip().split("-")
+    if len(bounds) > 2 or not all(bound.strip().isdigit() for bound in bounds):
+      raise ValueError("Invalid issue ID range '%s'" % part)
+    result.append((int(bounds[0]), int(bounds[-1])))
+  return result
+
+
+def _IdRangesArgument(value):
+  """Parses the --issue_ids argument, see ParseIdRanges."""
+  try:
+    return ParseIdRanges(value)
+  except ValueError, e:
+    raise argparse.ArgumentTypeError(str(e))
+
+
+def AddIssueFilterArguments(parser):
+  """Adds the command line arguments selecting which issues to export."""
+  parser.add_argument("--issue_ids", required=False, type=_IdRangesArgument,
+                      help="Only export these issues, e.g. '1-100,205'.")
+  parser.add_argument("--issue_state", required=False, action="append",
+                      choices=["open", "closed"],
+                      help="Only export issues in this state.")
+  parser.add_argument("--issue_label", required=False, action="append",
+                      help="Only export issues with this label, e.g. "
+                      "'Component-UI'. May be given several times.")
+  parser.add_argument("--issue_author", required=False, action="append",
+                      help="Only export issues reported by this email "
+                      "address. May be given several times.")
+  parser.add_argument("--published_after", required=False,
+                      help="Only export issues published on or after this "
+                      "date, e.g. '2014-01-31'.")
+  parser.add_argument("--published_before", required=False,
+                      help="Only export issues published before this date.")
+
+
+def IssueFilterFromArguments(parsed_args):
+  """Returns the IssueFilter for the arguments of AddIssueFilterArguments."""
+  return IssueFilter(
+      parsed_args.issue_ids,
+      parsed_args.issue_state, parsed_args.issue_label,
+      parsed_args.issue_author, parsed_args.published_after,
+      parsed_args.published_before)
+
+
+class IssueIndex(object):
+  """Indexes of the Google Code issues, to select subsets quickly.
+
+  Issues are indexed by ID, state, label, author and publication date, so a
+  filter only looks at the issues it matches.
+  """
+
+  def __init__(self, issue_json_data):
+    """Initialize the IssueIndex.
+
+    Args:
+      issue_json_data: The Google Code issues, as loaded by LoadIssueData.
+    """
+    self._issue_json_data = issue_json_data
+    self._ids = []
+    self._by_state = collections.defaultdict(set)
+    self._by_label = collections.defaultdict(set)
+    self._by_author = collections.defaultdict(set)
+    self._published = []
+    for position, issue in enumerate(issue_json_data):
+      self._ids.append((int(issue["id"]), position))
+      self._by_state[issue.get("state")].add(position)
+      for label in issue.get("labels", []):
+        self._by_label[label.lower()].add(position)
+      if "author" in issue:
+        self._by_author[issue["author"]["name"]].add(position)
+      if "published" in issue:
+        self._published.append((issue["published"], position))
+    self._ids.sort()
+    self._published.sort()
+
+  def Select(self, issue_filter):
+    """Returns the issues matching a filter, in Takeout order.
+
+    Args:
+      issue_filter: An IssueFilter.
+
+    Returns:
+      A list of issues.
+    """
+    if not issue_filter or issue_filter.IsEmpty():
+      return self._issue_json_data
+    candidates = []
+    if issue_filter.id_ranges:
+      positions = set()
+      for first, last in issue_filter.id_ranges:
+        start = bisect.bisect_left(self._ids, (first, -1))
+        end = bisect.bisect_left(self._ids, (last + 1, -1))
+        positions.update(position for _, position in self._ids[start:end])
+      candidates.append(positions)
+    if issue_filter.states:
+      candidates.append(self._Union(self._by_state, issue_filter.states))
+    for label in issue_filter.labels or []:
+      candidates.append(self._by_label.get(label.lower(), set()))
+    if issue_filter.authors:
+      candidates.append(self._Union(self._by_author, issue_filter.authors))
+    if issue_filter.published_after or issue_filter.published_before:
+      start = 0
+      end = len(self._published)
+      if issue_filter.published_after:
+        start = bisect.bisect_left(
+            self._published, (issue_filter.published_after, -1))
+      if issue_filter.published_before:
+        end = bisect.bisect_left(
+            self._published, (issue_filter.published_before, -1))
+      candidates.append(
+          set(position for _, position in self._published[start:end]))
+    # Intersect the smallest sets first.
+    candidates.sort(key=len)
+    positions = sorted(candidates[0].intersection(*candidates[1:]))
+    if isinstance(self._issue_json_data, LazyIssueList):
+      return self._issue_json_data.Subset(positions)
+    return [self._issue_json_data[position] for position in positions]
+
+  def _Union(self, index, keys):
+    """Returns the union of the positions of the keys in an index."""
+    positions = set()
+    for key in keys:
+      positions.update(index.get(key, ()))
+    return positions
+
+
+def _IsInCreationOrder(created_comments):
+  """Returns whether comments were timestamped in the order they were posted.
+
+  Args:
+    created_comments: The comments as returned by IssueService.CreateComment,
+        in posting order. Services that don't return the created comment are
+        assumed to be in order.
+  """
+  previous = None
+  for comment in created_comments:
+    if not comment or "created_at" not in comment:
+      return True
+    key = (comment["created_at"], comment.get("id"))
+    if previous is not None and key < previous:
+      return False
+    previous = key
+  return True
+
+
+class CommentScheduler(object):
+  """Posts comments on several issues concurrently, in order per issue.
+
+  The issue service orders comments by their creation time, so the comments
+  of one issue have to be created one after the other. Rather than sleeping
+  between comments, each issue's comments are posted by a single worker, the
+  next one only once the service acknowledged the previous one. Comments of
+  different issues are posted by different workers at the same time, so the
+  exporter can move on to creating the next issue meanwhile.
+
+  Attributes:
+    repaired_issues: Issue numbers whose comments had to be reordered.
+  """
+
+  def __init__(self, issue_service, workers=DEFAULT_COMMENT_WORKERS,
+               verify_order=False, max_pending_issues=None,
+               metrics_instance=None):
+    """Initialize the CommentScheduler.
+
+    Args:
+      issue_service: An instance of IssueService. It must be safe to use from
+          several threads.
+      workers: The number of issues to post comments to concurrently.
+      verify_order: Whether to compare the creation timestamps of posted
+          comments, and repair the order of an issue's comments if needed.
+      max_pending_issues: The number of issues that may be waiting for a
+          worker before Schedule blocks, defaults to twice the workers.
+      metrics_instance: The metrics.ExportMetrics instance to record
+          operations to, if not set a default will be used.
+    """
+    self._issue_service = issue_service
+    self._verify_order = verify_order
+    self._metrics = (
+        metrics_instance if metrics_instance else metrics.ExportMetrics())
+    self._jobs = Queue.Queue(max_pending_issues or workers * 2)
+    self._errors = []
+    self._errors_lock = threading.Lock()
+    self.repaired_issues = []
+    self._threads = []
+    for _ in range(workers):
+      thread = threading.Thread(target=self._Work)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def Schedule(self, issue_number, googlecode_comments, close_issue=False):
+    """Schedules posting comments to an issue.
+
+    Args:
+      issue_number: The issue number on the issue service.
+      googlecode_comments: A list of GoogleCodeComment instances, in order.
+      close_issue: Whether to close the issue after posting the comments.
+
+    Raises:
+      ServiceError: Posting previously scheduled comments failed.
+    """
+    self._RaiseErrors()
+    self._jobs.put((issue_number, list(googlecode_comments), close_issue))
+
+  def Wait(self):
+    """Waits until all scheduled comments have been posted.
+
+    Raises:
+      ServiceError: Posting scheduled comments failed.
+    """
+    self._jobs.join()
+    self._RaiseErrors()
+
+  def Close(self):
+    """Stops the workers once all scheduled comments have been posted."""
+    for _ in self._threads:
+      self._jobs.put(None)
+    for thread in self._threads:
+      thread.join()
+
+  def _RaiseErrors(self):
+    """Raises the first error a worker ran into, if any."""
+    with self._errors_lock:
+      if self._errors:
+        error = self._errors[0]
+        self._errors = []
+        raise error
+
+  def _Work(self):
+    """Worker thread main loop."""
+    while True:
+      job = self._jobs.get()
+      try:
+        if job is None:
+          return
+        self._PostComments(*job)
+      except Exception as e:  # pylint: disable=broad-except
+        with self._errors_lock:
+          self._errors.append(e)
+      finally:
+        self._jobs.task_done()
+
+  def _PostComments(self, issue_number, googlecode_comments, close_issue):
+    """Posts an issue's comments one after the other."""
+    created_comments = []
+    for googlecode_comment in googlecode_comments:
+      with self._metrics.Time("comment"):
+        created_comments.append(self._issue_service.CreateComment(
+            issue_number, googlecode_comment))
+
+    if self._verify_order and not _IsInCreationOrder(created_comments):
+      self._RepairOrder(issue_number, googlecode_comments)
+
+    if close_issue:
+      with self._metrics.Time("close"):
+        self._issue_service.CloseIssue(issue_number)
+
+  def _RepairOrder(self, issue_number, googlecode_comments):
+    """Rewrites comment bodies so they appear in the intended order.
+
+    The service lists comments by creation time. Any listed comment which
+    isn't the comment meant to be at its position is edited.
+    """
+    with self._metrics.Time("get"):
+      existing_comments = self._issue_service.GetComments(issue_number)
+    offset = len(existing_comments) - len(googlecode_comments)
+    if offset < 0:
+      raise ServiceError("Issue #%s is missing comments." % issue_number)
+    for idx, googlecode_comment in enumerate(googlecode_comments):
+      existing_comment = existing_comments[offset + idx]
+      existing_key = FindIdempotencyKey(existing_comment["body"])
+      if existing_key:
+        if existing_key == googlecode_comment.GetIdempotencyKey():
+          continue
+      elif existing_comment["body"] == googlecode_comment.GetDescription():
+        continue
+      with self._metrics.Time("edit"):
+        self._issue_service.EditComment(
+            issue_number, googlecode_comment, existing_comment["id"])
+    self.repaired_issues.append(issue_number)
+
+
+def _Hash(value):
+  """Returns a stable content hash of a JSON serializable value."""
+  return hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+
+
+def HashIssue(googlecode_issue):
+  """Returns the hash of everything an exported issue's body is made of."""
+  return _Hash([googlecode_issue.GetTitle(),
+                googlecode_issue.GetDescription(),
+                sorted(googlecode_issue.GetLabels()),
+                googlecode_issue.GetOwner()])
+
+
+def HashComment(googlecode_comment):
+  """Returns the hash of an exported comment's body.
+
+  The issue IDs are hashed as in the Takeout, rewriting them or not
+  (--rewrite_comments) doesn't count as a change.
+  """
+  return _Hash(googlecode_comment.GetSourceDescription())
+
+
+class PlaceholderIssue(object):
+  """A minimal stand-in for a GoogleCodeIssue, to reserve its issue number.
+
+  It has the title and idempotency key of the issue, but none of its content,
+  which a two-phase export fills in later by editing the issue.
+  """
+
+  def __init__(self, googlecode_issue):
+    """Initialize the PlaceholderIssue.
+
+    Args:
+      googlecode_issue: The GoogleCodeIssue to stand in for.
+    """
+    self._googlecode_issue = googlecode_issue
+
+  def __getattr__(self, name):
+    return getattr(self._googlecode_issue, name)
+
+  def GetDescription(self):
+    """Returns the placeholder body."""
+    return PLACEHOLDER_DESCRIPTION % self._googlecode_issue.GetId()
+
+  def GetOwner(self):
+    """Placeholders are unassigned."""
+    return None
+
+  def GetLabels(self):
+    """Placeholders have no labels."""
+    return []
+
+
+class ExportJournal(object):
+  """Records the progress of a two-phase export.
+
+  For every Google Code issue the journal holds the number reserved for it
+  and whether its content has been filled in. The journal file is appended
+  one JSON line per change, so recording stays cheap however many issues
+  there are, and a crash loses at most the line being written.
+  """
+
+  def __init__(self, journal_path):
+    """Initialize the ExportJournal, replaying it if it exists.
+
+    Args:
+      journal_path: The path of the journal file.
+    """
+    self._issues = {}
+    self._lock = threading.Lock()
+    partial_line = False
+    if os.path.exists(journal_path):
+      with open(journal_path) as journal_file:
+        for line in journal_file:
+          partial_line = not line.endswith("\n")
+          try:
+            record = json.loads(line)
+          except ValueError:
+            # Cut off by a crash.
+            continue
+          entry = self._issues.setdefault(
+              str(record["id"]), {"number": None, "filled": False})
+          if "number" in record:
+            entry["number"] = record["number"]
+          if record.get("filled"):
+            entry["filled"] = True
+    self._journal_file = open(journal_path, "a")
+    if partial_line:
+      self._journal_file.write("\n")
+
+  def Get(self, issue_id):
+    """Returns the entry of a Google Code issue, or None if not reserved.
+
+    The entry is a dictionary with the keys 'number' and 'filled'.
+    """
+    with self._lock:
+      return self._issues.get(str(issue_id))
+
+  def Reserve(self, issue_id, issue_number):
+    """Records the issue number reserved for a Google Code issue."""
+    self._Append({"id": issue_id, "number": issue_number},
+                 {"number": issue_number, "filled": False})
+
+  def MarkFilled(self, issue_id):
+    """Records that the content of a Google Code issue was filled in."""
+    entry = dict(self.Get(issue_id), filled=True)
+    self._Append({"id": issue_id, "filled": True}, entry)
+
+  def _Append(self, record, entry):
+    """Appends a record to the journal file and updates the entry."""
+    with self._lock:
+      self._issues[str(record["id"])] = entry
+      self._journal_file.write(json.dumps(record, sort_keys=True) + "\n")
+      self._journal_file.flush()
+
+  def Close(self):
+    """Closes the journal file."""
+    self._journal_file.close()
+
+
+class SyncManifest(object):
+  """Records what a previous export created, to sync later changes.
+
+  For every Google Code issue the manifest holds the exported issue number,
+  the hash of its content, whether it was left open, and the hash and ID of
+  each of its comments. Comparing against it tells which issues and comments
+  changed on Google Code since, without reading anything back from the
+  issue service.
+  """
+
+  VERSION = 1
+
+  def __init__(self, manifest_path):
+    """Initialize the SyncManifest, loading it if it exists.
+
+    Args:
+      manifest_path: The path of the manifest file.
+    """
+    self._manifest_path = manifest_path
+    self._issues = {}
+    if os.path.exists(manifest_path):
+      with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+      if manifest.get("version") == self.VERSION:
+        self._issues = manifest["issues"]
+
+  def Get(self, issue_id):
+    """Returns the entry of a Google Code issue, or None if not exported.
+
+    The entry is a dictionary with the keys 'number', 'hash', 'open' (None if
+    unknown) and 'comments', a list of [hash, ID] pairs (the ID may be None
+    if unknown).
+    """
+    return self._issues.get(str(issue_id))
+
+  def Set(self, issue_id, entry):
+    """Sets the entry of a Google Code issue, see Get."""
+    self._issues[str(issue_id)] = entry
+
+  def HasIssues(self, issue_ids):
+    """Returns whether all of the Google Code issues have entries."""
+    return all(str(issue_id) in self._issues for issue_id in issue_ids)
+
+  def Save(self):
+    """Writes the manifest file."""
+    # Write to a temporary file first so a crash never leaves a partial
+    # manifest behind.
+    temp_path = self._manifest_path + ".tmp"
+    with open(temp_path, "w") as manifest_file:
+      json.dump({"version": self.VERSION, "issues": self._issues},
+                manifest_file, sort_keys=True)
+    os.rename(temp_path, self._manifest_path)
+
+
 class IssueExporter(object):
   """Issue Migration.
 
@@ -649,7 +1572,9 @@ class IssueExporter(object):
   """
 
   def __init__(self, issue_service, user_service, issue_json_data,
-               project_name, user_map):
+               project_name, user_map, metrics_instance=None,
+               comment_scheduler=None, sync_manifest=None, issue_filter=None,
+               export_journal=None, fill_workers=DEFAULT_FILL_WORKERS):
     """Initialize the IssueExporter.
 
     Args:
@@ -658,12 +1583,37 @@ class IssueExporter(object):
       project_name: The name of the project to export to.
       issue_json_data: A data object of issues from Google Code.
       user_map: A map from user email addresses to service usernames.
+      metrics_instance: The metrics.ExportMetrics instance to record
+          operations to, if not set a default will be used.
+      comment_scheduler: An optional CommentScheduler. If set, comments are
+          posted (and issues closed) in the background while the export moves
+          on to the next issue.
+      sync_manifest: An optional SyncManifest. If set, Start only creates,
+          edits and closes what changed since the manifest was recorded, and
+          records the changes.
+      issue_filter: An optional IssueFilter, to only export some issues.
+          Exported issues are still matched against all issues.
+      export_journal: An optional ExportJournal. If set, Start exports in two
+          phases: placeholder issues are created in order first, reserving
+          their numbers, then filled in concurrently.
+      fill_workers: The number of issues filled in concurrently by a
+          two-phase export. The issue service must be safe to use from
+          several threads.
     """
     self._issue_service = issue_service
+    self._comment_scheduler = comment_scheduler
+    self._sync_manifest = sync_manifest
+    self._export_journal = export_journal
+    self._fill_workers = fill_workers
     self._user_service = user_service
     self._issue_json_data = issue_json_data
+    self._issue_subset = None
+    if issue_filter and not issue_filter.IsEmpty():
+      self._issue_subset = IssueIndex(issue_json_data).Select(issue_filter)
     self._project_name = project_name
     self._user_map = user_map
+    self._metrics = (
+        metrics_instance if metrics_instance else metrics.ExportMetrics())
 
     # Specialized index of issues to quickly check what has been migrated to
     # GitHub and if so, determine it's new issue ID. See Init(...).
@@ -689,28 +1639,57 @@ class IssueExporter(object):
     print "Building issue index."
     self._issue_index = {}
     index = self._issue_index
+    # The same index entries, by idempotency key and by the issue number the
+    # sync manifest recorded.
+    index_by_key = {}
+    index_by_number = {}
 
     for issue in self._issue_json_data:
       gc_issue = GoogleCodeIssue(issue, self._project_name, self._user_map)
       if gc_issue.GetTitle() not in index:
         index[gc_issue.GetTitle()] = []
-      index[gc_issue.GetTitle()].append({
+      entry = {
         "googlecode_id": gc_issue.GetId(),
         "exported": False,
         "exported_id": -1,
         "comment_count": -1,
-      })
+      }
+      index[gc_issue.GetTitle()].append(entry)
+      index_by_key[gc_issue.GetIdempotencyKey()] = entry
+      manifest_entry = (self._sync_manifest and
+                        self._sync_manifest.Get(gc_issue.GetId()))
+      if manifest_entry:
+        index_by_number[manifest_entry["number"]] = entry
+
+    if (self._sync_manifest and not require_all_issues_exported and
+        self._sync_manifest.HasIssues(
+            issue["id"] for issue in self._GetSelectedIssues())):
+      print "All issues are in the sync manifest."
+      return
 
     print "Determining which issues have already been exported."
-    open_issues = self._issue_service.GetIssues("open")
-    closed_issues = self._issue_service.GetIssues("closed")
+    with self._metrics.Time("get"):
+      open_issues = self._issue_service.GetIssues(
+          "open", fields=EXPORTED_ISSUE_FIELDS)
+      closed_issues = self._issue_service.GetIssues(
+          "closed", fields=EXPORTED_ISSUE_FIELDS)
     all_exported_issues = open_issues + closed_issues
-    # Sort issues by GitHub ID, since Google Code issues will be exported in
-    # order we can use the exported issue's chronology to resolve ambiguities
-    # for issues with the same title. Yes, GitHub number == ID.
-    all_exported_issues = sorted(all_exported_issues,
-                                 key=lambda issue: issue["number"])
+    # Issues carrying an idempotency key, or recorded in the sync manifest,
+    # match their Google Code issue whatever order they were created in.
+    unmatched_issues = []
     for exported_issue in all_exported_issues:
+      entry = (index_by_key.get(exported_issue.get(IDEMPOTENCY_KEY_FIELD))
+               or index_by_number.get(exported_issue["number"]))
+      if entry is None or entry["exported"]:
+        unmatched_issues.append(exported_issue)
+      else:
+        self._MarkExported(entry, exported_issue)
+
+    # Sort the other issues by GitHub ID, since Google Code issues will be
+    # exported in order we can use the exported issue's chronology to resolve
+    # ambiguities for issues with the same title. Yes, GitHub number == ID.
+    unmatched_issues.sort(key=lambda issue: issue["number"])
+    for exported_issue in unmatched_issues:
       exported_issue_id = exported_issue["number"]
       exported_issue_title = exported_issue["title"]
       if exported_issue_title not in index:
@@ -718,16 +1697,20 @@ class IssueExporter(object):
             exported_issue_id, exported_issue_title)
         continue
       # Mark of the issue as exported.
-      for idx in range(0, len(index[exported_issue_title])):
-        if not index[exported_issue_title][idx]["exported"]:
-          index[exported_issue_title][idx]["exported"] = True
-          index[exported_issue_title][idx]["exported_id"] = exported_issue_id
-          index[exported_issue_title][idx]["comment_count"] = (
-              exported_issue["comments"])
+      for entry in index[exported_issue_title]:
+        if not entry["exported"]:
+          self._MarkExported(entry, exported_issue)
           break
-      if idx >= len(index[exported_issue_title]):
-        print "Warning: Couldn't find the %sth issue titled '%s'." % (
-            idx, exported_issue_title)
+      else:
+        print "Warning: GitHub issue #%s '%s' matches no unexported issue." % (
+            exported_issue_id, exported_issue_title)
+        continue
+      if self._issue_subset is not None:
+        # A filtered export need not create issues in Takeout order.
+        print ("Warning: GitHub issue #%s '%s' has no idempotency key, it was "
+               "matched to issue #%s by title and may be the wrong one." % (
+                   exported_issue_id, exported_issue_title,
+                   entry["googlecode_id"]))
 
     # Build the ID map based on previously created issue. Only used if
     # rewriting comments.
@@ -747,6 +1730,18 @@ class IssueExporter(object):
     if len(self._id_mapping) < len(self._issue_json_data):
       raise Exception("Not all issues have been exported.")
 
+  def _MarkExported(self, entry, exported_issue):
+    """Marks an issue index entry as exported to the given issue."""
+    entry["exported"] = True
+    entry["exported_id"] = exported_issue["number"]
+    entry["comment_count"] = exported_issue["comments"]
+
+  def _GetSelectedIssues(self):
+    """Returns the issues to export, see the issue_filter."""
+    if self._issue_subset is not None:
+      return self._issue_subset
+    return self._issue_json_data
+
   def _GetExportedIssue(self, googlecode_issue):
     """Return metadata about the exported Google Code issue."""
     index = self._issue_index
@@ -790,9 +1785,11 @@ class IssueExporter(object):
     Returns:
       The issue number assigned by the service.
     """
-    return self._issue_service.CreateIssue(googlecode_issue)
+    with self._metrics.Time("create"):
+      return self._issue_service.CreateIssue(googlecode_issue)
 
-  def _CreateComments(self, comments, issue_number, googlecode_issue):
+  def _CreateComments(self, comments, issue_number, googlecode_issue,
+                      close_issue=False):
     """Converts a list of issue comment from Google Code to an issue service.
 
     This will take a list of Google Code issue comments and create
@@ -802,15 +1799,30 @@ class IssueExporter(object):
       comments: A list of comments (each comment is just a string).
       issue_number: The issue number.
       source_issue_id: The Google Code issue id.
+      close_issue: Whether to close the issue after creating the comments.
     """
     self._comment_total = len(comments)
     self._comment_number = 0
 
+    if self._comment_scheduler:
+      self._comment_number = len(comments)
+      self._UpdateProgressBar()
+      self._comment_scheduler.Schedule(
+          issue_number,
+          [GoogleCodeComment(googlecode_issue, c) for c in comments],
+          close_issue)
+      return
+
     for comment in comments:
       googlecode_comment = GoogleCodeComment(googlecode_issue, comment)
       self._comment_number += 1
       self._UpdateProgressBar()
-      self._issue_service.CreateComment(issue_number, googlecode_comment)
+      with self._metrics.Time("comment"):
+        self._issue_service.CreateComment(issue_number, googlecode_comment)
+
+    if close_issue:
+      with self._metrics.Time("close"):
+        self._issue_service.CloseIssue(issue_number)
 
   def _RewriteComments(self, googlecode_issue, exported_issue_number):
     """Rewrite all comments in the issue to update issue ID references.
@@ -825,11 +1837,14 @@ class IssueExporter(object):
     self._comment_total = len(comments)
     self._comment_number = 0
 
-    self._issue_service.EditIssue(googlecode_issue, exported_issue_number)
+    with self._metrics.Time("edit"):
+      self._issue_service.EditIssue(googlecode_issue, exported_issue_number)
 
     # Get existing comments from the destination, necessary because we don't
     # know the IDs used on the output side. (GitHub uses timestamps :P)
-    existing_comments = self._issue_service.GetComments(exported_issue_number)
+    with self._metrics.Time("get"):
+      existing_comments = self._issue_service.GetComments(
+          exported_issue_number)
     for comment_idx in range(0, len(comments)):
       if comment_idx >= len(existing_comments):
         print "\nError: More comments on Google Code than on dest service?"
@@ -844,8 +1859,9 @@ class IssueExporter(object):
       gc_comment = GoogleCodeComment(googlecode_issue, comment, id_mapping)
       self._comment_number += 1
       self._UpdateProgressBar()
-      self._issue_service.EditComment(
-          exported_issue_number, gc_comment, comment_number)
+      with self._metrics.Time("edit"):
+        self._issue_service.EditComment(
+            exported_issue_number, gc_comment, comment_number)
 
   def _FixBlockingBlockedOn(self, issue_json):
     """Fix the issue JSON object to normalize how blocking/blocked-on are used.
@@ -932,17 +1948,28 @@ class IssueExporter(object):
     Args:
       rewrite_comments: Bool. If set will rewrite the comments for previously
           exported issues. Used to fix export problems and remap issue IDs.
+          Rewriting is always sequential, even with an export journal.
     """
+    if self._sync_manifest:
+      self._Sync()
+      return
+    if self._export_journal and not rewrite_comments:
+      self._ReservePlaceholders()
+      self._FillPlaceholders()
+      return
+
     print "Starting issue export for '%s'" % (self._project_name)
-    self._issue_total = len(self._issue_json_data)
+    selected_issues = self._GetSelectedIssues()
+    self._issue_total = len(selected_issues)
     self._comment_total = 0
     self._issue_number = 0
     self._comment_number = 0
     self._skipped_issues = 0
+    self._metrics.SetIssueTotal(self._issue_total)
 
     last_issue_skipped = False  # Only used for formatting output.
 
-    for issue in self._issue_json_data:
+    for issue in selected_issues:
       self._FixBlockingBlockedOn(issue)
       googlecode_issue = GoogleCodeIssue(
           issue, self._project_name, self._user_map)
@@ -951,6 +1978,7 @@ class IssueExporter(object):
           issue_title[:16] + '...') if len(issue_title) > 18 else issue_title
 
       self._issue_number += 1
+      self._metrics.StartIssue(googlecode_issue.GetId())
 
       # Check if the issue has already been posted.
       if self._HasIssueBeenExported(googlecode_issue):
@@ -966,18 +1994,33 @@ class IssueExporter(object):
         num_issue_comments = len(issue_comments)
         num_existing_comments = export_metadata["comment_count"]
         if num_issue_comments > num_existing_comments:
-          for idx in range(num_existing_comments, num_issue_comments):
-            comment_data = issue_comments[idx]
-            googlecode_comment = GoogleCodeComment(
-                googlecode_issue, comment_data)
-            self._issue_service.CreateComment(
-                export_metadata["exported_id"], googlecode_comment)
-            print "  Added missing comment #%d" % (idx + 1)
+          if self._comment_scheduler:
+            self._comment_scheduler.Schedule(
+                export_metadata["exported_id"],
+                [GoogleCodeComment(googlecode_issue, c)
+                 for c in issue_comments[num_existing_comments:]])
+            print "  Adding %d missing comments" % (
+                num_issue_comments - num_existing_comments)
+          else:
+            for idx in range(num_existing_comments, num_issue_comments):
+              comment_data = issue_comments[idx]
+              googlecode_comment = GoogleCodeComment(
+                  googlecode_issue, comment_data)
+              with self._metrics.Time("comment"):
+                self._issue_service.CreateComment(
+                    export_metadata["exported_id"], googlecode_comment)
+              print "  Added missing comment #%d" % (idx + 1)
 
         if rewrite_comments:
+          if self._comment_scheduler:
+            # Rewriting relies on all comments being present.
+            self._comment_scheduler.Wait()
           self._RewriteComments(googlecode_issue, export_metadata["exported_id"])
           print ""  # Advanced past the "progress bar" line.
 
+        # Only count the issue towards throughput if it needed any work.
+        self._metrics.FinishIssue(skipped=not (
+            rewrite_comments or num_issue_comments > num_existing_comments))
         continue
 
       # Post the issue for the first time.
@@ -985,9 +2028,230 @@ class IssueExporter(object):
       last_issue_skipped = False
       posted_issue_id = self._CreateIssue(googlecode_issue)
       comments = googlecode_issue.GetComments()
-      self._CreateComments(comments, posted_issue_id, googlecode_issue)
+      self._CreateComments(comments, posted_issue_id, googlecode_issue,
+                           close_issue=not googlecode_issue.IsOpen())
+
+      self._metrics.FinishIssue()
+
+    if self._comment_scheduler:
+      self._comment_scheduler.Wait()
+    self._metrics.Flush()
+    print "Finished!"
+
+  def _ReservePlaceholders(self):
+    """Creates placeholder issues in order, recording them in the journal.
 
-      if not googlecode_issue.IsOpen():
-        self._issue_service.CloseIssue(posted_issue_id)
+    Issue numbers follow the creation order, so this phase is sequential, but
+    placeholders are small and quick to create. Issues exported by an earlier
+    run, possibly as placeholders whose reservation was lost, are recorded
+    with their existing numbers.
+    """
+    print "Reserving issue numbers for '%s'" % (self._project_name)
+    created = 0
+    for issue in self._GetSelectedIssues():
+      googlecode_issue = GoogleCodeIssue(
+          issue, self._project_name, self._user_map)
+      issue_id = googlecode_issue.GetId()
+      if self._export_journal.Get(issue_id):
+        continue
+      export_metadata = self._GetExportedIssue(googlecode_issue)
+      if export_metadata["exported"]:
+        issue_number = export_metadata["exported_id"]
+      else:
+        issue_number = self._CreateIssue(PlaceholderIssue(googlecode_issue))
+        export_metadata["exported"] = True
+        export_metadata["exported_id"] = issue_number
+        export_metadata["comment_count"] = 0
+        created += 1
+      self._export_journal.Reserve(issue_id, issue_number)
+    print "Created %d placeholder issues." % created
+
+  def _FillPlaceholders(self):
+    """Fills in the content of reserved issues, several at a time.
 
+    Raises:
+      ServiceError: Filling in an issue failed.
+    """
+    print "Filling in issues for '%s'" % (self._project_name)
+    selected_issues = self._GetSelectedIssues()
+    self._metrics.SetIssueTotal(len(selected_issues))
+    jobs = Queue.Queue(self._fill_workers * 2)
+    errors = []
+
+    def Work():
+      while True:
+        job = jobs.get()
+        try:
+          if job is None:
+            return
+          self._FillIssue(job)
+        except Exception as e:  # pylint: disable=broad-except
+          errors.append(e)
+        finally:
+          jobs.task_done()
+
+    threads = []
+    for _ in range(max(1, self._fill_workers)):
+      thread = threading.Thread(target=Work)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    try:
+      for issue in selected_issues:
+        if errors:
+          break
+        if self._export_journal.Get(issue["id"])["filled"]:
+          self._metrics.FinishIssue(skipped=True)
+          continue
+        jobs.put(issue)
+      jobs.join()
+    finally:
+      for _ in threads:
+        jobs.put(None)
+      for thread in threads:
+        thread.join()
+    if errors:
+      raise errors[0]
+    self._metrics.Flush()
     print "Finished!"
+
+  def _FillIssue(self, issue):
+    """Fills in the content, comments and state of a reserved issue."""
+    self._FixBlockingBlockedOn(issue)
+    googlecode_issue = GoogleCodeIssue(
+        issue, self._project_name, self._user_map)
+    issue_id = googlecode_issue.GetId()
+    issue_number = self._export_journal.Get(issue_id)["number"]
+    self._metrics.StartIssue(issue_id)
+    with self._metrics.Time("edit"):
+      self._issue_service.EditIssue(googlecode_issue, issue_number)
+    # Comments posted before an interruption were counted by Init.
+    existing_comments = max(
+        0, self._GetExportedIssue(googlecode_issue)["comment_count"])
+    for comment in googlecode_issue.GetComments()[existing_comments:]:
+      with self._metrics.Time("comment"):
+        self._issue_service.CreateComment(
+            issue_number, GoogleCodeComment(googlecode_issue, comment))
+    if not googlecode_issue.IsOpen():
+      with self._metrics.Time("close"):
+        self._issue_service.CloseIssue(issue_number)
+    self._export_journal.MarkFilled(issue_id)
+    self._metrics.FinishIssue()
+
+  def _Sync(self):
+    """Syncs the changes since the sync manifest was recorded."""
+    print "Syncing issues for '%s'" % (self._project_name)
+    selected_issues = self._GetSelectedIssues()
+    self._metrics.SetIssueTotal(len(selected_issues))
+    counts = collections.Counter()
+    # Saving rewrites the whole manifest, so it is only saved every few
+    # changed issues, and once more at the end with whatever was synced, even
+    # on failure.
+    unsaved_issues = 0
+    try:
+      for issue in selected_issues:
+        self._FixBlockingBlockedOn(issue)
+        googlecode_issue = GoogleCodeIssue(
+            issue, self._project_name, self._user_map)
+        self._metrics.StartIssue(googlecode_issue.GetId())
+        operations = self._SyncIssue(googlecode_issue)
+        counts.update(operations)
+        self._metrics.FinishIssue(skipped=not operations)
+        if operations:
+          unsaved_issues += 1
+          if unsaved_issues >= SYNC_MANIFEST_SAVE_INTERVAL:
+            self._sync_manifest.Save()
+            unsaved_issues = 0
+    finally:
+      self._sync_manifest.Save()
+    self._metrics.Flush()
+    print ("Finished! Created %d issues and %d comments, edited %d issues "
+           "and %d comments, closed %d issues." % (
+               counts["create"], counts["comment"], counts["edit"],
+               counts["edit_comment"], counts["close"]))
+
+  def _SyncIssue(self, googlecode_issue):
+    """Syncs the changes to a single issue.
+
+    Args:
+      googlecode_issue: The GoogleCodeIssue to sync.
+
+    Returns:
+      A list of the operations made, e.g. ['edit', 'comment'].
+    """
+    issue_id = googlecode_issue.GetId()
+    comments = [GoogleCodeComment(googlecode_issue, comment, self._id_mapping)
+                for comment in googlecode_issue.GetComments()]
+    issue_hash = HashIssue(googlecode_issue)
+    operations = []
+
+    entry = self._sync_manifest.Get(issue_id)
+    if (entry is None and googlecode_issue.GetTitle() in self._issue_index and
+        self._HasIssueBeenExported(googlecode_issue)):
+      # Exported before there was a manifest. Take the issue and its comments
+      # as they are, the manifest only tracks changes from here on.
+      export_metadata = self._GetExportedIssue(googlecode_issue)
+      existing = min(len(comments), export_metadata["comment_count"])
+      entry = {
+          "number": export_metadata["exported_id"],
+          "hash": issue_hash,
+          "open": None,
+          "comments": [[HashComment(comment), None]
+                       for comment in comments[:existing]],
+      }
+      self._sync_manifest.Set(issue_id, entry)
+      operations.append("adopt")
+    elif entry is None:
+      with self._metrics.Time("create"):
+        issue_number = self._issue_service.CreateIssue(googlecode_issue)
+      entry = {"number": issue_number, "hash": issue_hash, "open": True,
+               "comments": []}
+      self._sync_manifest.Set(issue_id, entry)
+      operations.append("create")
+    elif entry["hash"] != issue_hash:
+      with self._metrics.Time("edit"):
+        self._issue_service.EditIssue(googlecode_issue, entry["number"])
+      entry["hash"] = issue_hash
+      operations.append("edit")
+
+    issue_number = entry["number"]
+    comment_ids = None
+    for idx, comment in enumerate(comments):
+      comment_hash = HashComment(comment)
+      if idx >= len(entry["comments"]):
+        with self._metrics.Time("comment"):
+          created = self._issue_service.CreateComment(issue_number, comment)
+        comment_id = created.get("id") if isinstance(created, dict) else None
+        entry["comments"].append([comment_hash, comment_id])
+        operations.append("comment")
+        continue
+      if entry["comments"][idx][0] == comment_hash:
+        continue
+      if entry["comments"][idx][1] is None:
+        # Exported without a manifest, look the comment IDs up once.
+        if comment_ids is None:
+          with self._metrics.Time("get"):
+            comment_ids = [existing["id"] for existing in
+                           self._issue_service.GetComments(issue_number)]
+        if idx >= len(comment_ids):
+          print "Warning: Comment %s of issue #%s not found, can't edit it." % (
+              comment.GetId(), issue_id)
+          continue
+        entry["comments"][idx][1] = comment_ids[idx]
+      with self._metrics.Time("edit"):
+        self._issue_service.EditComment(
+            googlecode_issue, comment, entry["comments"][idx][1])
+      entry["comments"][idx][0] = comment_hash
+      operations.append("edit_comment")
+
+    if not googlecode_issue.IsOpen() and entry["open"] is not False:
+      with self._metrics.Time("close"):
+        self._issue_service.CloseIssue(issue_number)
+      entry["open"] = False
+      operations.append("close")
+    elif googlecode_issue.IsOpen() and entry["open"] is False:
+      print "Warning: Issue #%s was reopened, which can't be synced." % (
+          issue_id)
+    elif entry["open"] is None:
+      entry["open"] = True
+    return operations
@@ -16,9 +16,17 @@
 
 # pylint: disable=missing-docstring,protected-access
 
+import argparse
+import bz2
 import collections
 import copy
+import gzip
+import json
+import os
+import shutil
+import tempfile
 import unittest
+import zipfile
 
 import issues
 
@@ -294,11 +302,582 @@ class GoogleCodeIssueTest(unittest.TestCase):
     self.assertEqual(issues.WrapText("a b c d e f g h", 4),
                      "a b c\nd e f\ng h")
 
+  def testIdempotencyKeys(self):
+    self.assertEqual("issue-1", SINGLE_ISSUE.GetIdempotencyKey())
+    self.assertEqual("issue-1-comment-1", SINGLE_COMMENT.GetIdempotencyKey())
+    body = issues.AddIdempotencyKey("body", "issue-1-comment-1")
+    self.assertTrue(body.startswith("body"))
+    self.assertEqual("issue-1-comment-1", issues.FindIdempotencyKey(body))
+    self.assertEqual(None, issues.FindIdempotencyKey("body"))
+    self.assertEqual(None, issues.FindIdempotencyKey(None))
+
   def testLoadUserData(self):
     # Verify the "identity dictionary" behavior.
     user_data_dict = issues.LoadUserData(None, None)
     self.assertEqual(user_data_dict["chrs...@goog.com"], "chrs...@goog.com")
 
 
+class FakeIssueService(issues.IssueService):
+  """Issue service recording calls, with numbered issues and comments."""
+
+  def __init__(self, created_at=None):
+    self.calls = []
+    self.bodies = collections.defaultdict(list)
+    self._created_at = created_at
+    self._next_comment_id = 0
+
+  def CreateComment(self, issue_number, googlecode_comment):
+    self._next_comment_id += 1
+    self.calls.append(("comment", issue_number, googlecode_comment.GetId()))
+    self.bodies[issue_number].append(
+        {"id": self._next_comment_id,
+         "body": googlecode_comment.GetDescription()})
+    created_at = (self._created_at.pop(0) if self._created_at
+                  else "2015-01-01T00:00:00Z")
+    return {"id": self._next_comment_id, "created_at": created_at}
+
+  def CloseIssue(self, issue_number):
+    self.calls.append(("close", issue_number))
+
+  def GetComments(self, issue_number):
+    return self.bodies[issue_number]
+
+  def EditComment(self, issue_number, googlecode_comment, comment_number):
+    self.calls.append(("edit", issue_number, comment_number))
+
+
+class CommentSchedulerTest(unittest.TestCase):
+  """Tests for CommentScheduler."""
+
+  def testPostsInOrderPerIssue(self):
+    issue_service = FakeIssueService()
+    scheduler = issues.CommentScheduler(issue_service, workers=3)
+    comments = [issues.GoogleCodeComment(SINGLE_ISSUE, c)
+                for c in COMMENTS_DATA]
+    for issue_number in range(10):
+      scheduler.Schedule(issue_number, comments, close_issue=True)
+    scheduler.Wait()
+    scheduler.Close()
+
+    for issue_number in range(10):
+      issue_calls = [c for c in issue_service.calls if c[1] == issue_number]
+      self.assertEqual(
+          [("comment", issue_number, 1), ("comment", issue_number, 2),
+           ("comment", issue_number, 3), ("comment", issue_number, 4),
+           ("close", issue_number)],
+          issue_calls)
+    self.assertEqual([], scheduler.repaired_issues)
+
+  def testErrorsAreRaised(self):
+    issue_service = FakeIssueService()
+
+    def FailingCreateComment(issue_number, googlecode_comment):
+      raise issues.ServiceError("Failed")
+    issue_service.CreateComment = FailingCreateComment
+    scheduler = issues.CommentScheduler(issue_service, workers=1)
+    scheduler.Schedule(1, [SINGLE_COMMENT])
+    with self.assertRaises(issues.ServiceError):
+      scheduler.Wait()
+    scheduler.Close()
+
+  def testRepairsOrder(self):
+    # The second comment got an earlier timestamp than the first.
+    issue_service = FakeIssueService(created_at=[
+        "2015-01-01T00:00:02Z", "2015-01-01T00:00:01Z"])
+    scheduler = issues.CommentScheduler(
+        issue_service, workers=1, verify_order=True)
+    comments = [issues.GoogleCodeComment(SINGLE_ISSUE, c)
+                for c in COMMENTS_DATA[:2]]
+    # Simulate the service listing them by creation time.
+    original_get_comments = issue_service.GetComments
+    issue_service.GetComments = (
+        lambda issue_number: original_get_comments(issue_number)[::-1])
+    scheduler.Schedule(5, comments)
+    scheduler.Wait()
+    scheduler.Close()
+
+    self.assertEqual([5], scheduler.repaired_issues)
+    self.assertEqual([("edit", 5, 2), ("edit", 5, 1)],
+                     [c for c in issue_service.calls if c[0] == "edit"])
+
+  def testIsInCreationOrder(self):
+    self.assertTrue(issues._IsInCreationOrder([
+        {"id": 1, "created_at": "2015-01-01T00:00:00Z"},
+        {"id": 2, "created_at": "2015-01-01T00:00:00Z"}]))
+    self.assertFalse(issues._IsInCreationOrder([
+        {"id": 2, "created_at": "2015-01-01T00:00:00Z"},
+        {"id": 1, "created_at": "2015-01-01T00:00:00Z"}]))
+    self.assertTrue(issues._IsInCreationOrder([None, None]))
+
+
+class IssueIndexTest(unittest.TestCase):
+  """Tests for selecting issues with an IssueFilter."""
+
+  def setUp(self):
+    self.issue_data = [
+        {"id": 1, "state": "open", "labels": ["Component-UI"],
+         "author": {"name": "a@example.com"},
+         "published": "2010-01-01T00:00:00.000Z"},
+        {"id": 3, "state": "closed", "labels": ["Component-UI", "Type-Defect"],
+         "author": {"name": "b@example.com"},
+         "published": "2012-06-01T00:00:00.000Z"},
+        {"id": 2, "state": "open", "labels": [],
+         "author": {"name": "b@example.com"},
+         "published": "2011-03-01T00:00:00.000Z"},
+    ]
+    self.index = issues.IssueIndex(self.issue_data)
+
+  def _SelectIds(self, **kwargs):
+    return [issue["id"] for issue in
+            self.index.Select(issues.IssueFilter(**kwargs))]
+
+  def testEmptyFilterSelectsAll(self):
+    self.assertEqual([1, 3, 2], self._SelectIds())
+
+  def testIdRanges(self):
+    self.assertEqual([3, 2], self._SelectIds(
+        id_ranges=issues.ParseIdRanges("2-3")))
+    self.assertEqual([1, 3], self._SelectIds(
+        id_ranges=issues.ParseIdRanges("1, 3-10")))
+    with self.assertRaises(ValueError):
+      issues.ParseIdRanges("1-2-3")
+    for id_ranges in ["abc", "5-", ""]:
+      with self.assertRaises(ValueError):
+        issues.ParseIdRanges(id_ranges)
+
+  def testIdRangesArgument(self):
+    parser = argparse.ArgumentParser()
+    issues.AddIssueFilterArguments(parser)
+    self.assertEqual([(1, 2), (5, 5)], parser.parse_args(
+        ["--issue_ids", "1-2,5"]).issue_ids)
+    with self.assertRaises(SystemExit):
+      parser.parse_args(["--issue_ids", "abc"])
+
+  def testCriteriaAreCombined(self):
+    self.assertEqual([1, 2], self._SelectIds(states=["open"]))
+    self.assertEqual([3], self._SelectIds(labels=["component-ui",
+                                                  "Type-Defect"]))
+    self.assertEqual([2], self._SelectIds(states=["open"],
+                                          authors=["b@example.com"]))
+    self.assertEqual([], self._SelectIds(labels=["Missing"]))
+
+  def testPublishedDates(self):
+    self.assertEqual([3, 2], self._SelectIds(published_after="2011-03-01"))
+    self.assertEqual([1, 2], self._SelectIds(published_before="2012"))
+
+  def testExporterOnlyExportsSelection(self):
+    issue_service = SyncIssueService()
+    issue_data = [copy.deepcopy(ISSUE_JSON) for _ in range(3)]
+    for idx, issue in enumerate(issue_data):
+      issue["id"] = idx + 1
+    exporter = issues.IssueExporter(
+        issue_service, issues.UserService(), issue_data, REPO, USER_MAP,
+        issue_filter=issues.IssueFilter(id_ranges=[(2, 3)]))
+    exporter.Init()
+    exporter.Start()
+    self.assertEqual([("create", 2), ("close", 101), ("create", 3),
+                      ("close", 102)], issue_service.calls)
+
+  def _CreatedIds(self, exported_issues, sync_manifest=None):
+    issue_service = SyncIssueService(exported_issues)
+    issue_data = [copy.deepcopy(ISSUE_JSON) for _ in range(3)]
+    for idx, issue in enumerate(issue_data):
+      issue["id"] = idx + 1
+    issue_data[1]["title"] = "other title"
+    exporter = issues.IssueExporter(
+        issue_service, issues.UserService(), issue_data, REPO, USER_MAP,
+        sync_manifest=sync_manifest)
+    exporter.Init()
+    exporter.Start()
+    return [call[1] for call in issue_service.calls if call[0] == "create"]
+
+  def testInitMatchesFilteredExportByKey(self):
+    # Issue 3 was exported alone first, its title is the same as issue 1's.
+    self.assertEqual([1, 2], self._CreatedIds([
+        {"number": 7, "title": "issue_title", "comments": 3,
+         "idempotency_key": "issue-3"}]))
+    self.assertEqual([2, 3], self._CreatedIds([
+        {"number": 7, "title": "issue_title", "comments": 3,
+         "idempotency_key": None}]))
+
+  def testInitMatchesFilteredExportByManifest(self):
+    temp_dir = tempfile.mkdtemp()
+    try:
+      sync_manifest = issues.SyncManifest(
+          os.path.join(temp_dir, "manifest.json"))
+      sync_manifest.Set(3, {"number": 7, "hash": "", "open": False,
+                            "comments": []})
+      self.assertEqual([1, 2], self._CreatedIds(
+          [{"number": 7, "title": "issue_title", "comments": 3}],
+          sync_manifest))
+    finally:
+      shutil.rmtree(temp_dir)
+
+
+class SyncIssueService(FakeIssueService):
+  """FakeIssueService which also creates and edits issues."""
+
+  def __init__(self, exported_issues=None):
+    super(SyncIssueService, self).__init__()
+    self._exported_issues = exported_issues or []
+    self._next_issue_number = 100
+
+  def GetIssues(self, state="open", fields=None):
+    return self._exported_issues if state == "open" else []
+
+  def CreateIssue(self, googlecode_issue):
+    self._next_issue_number += 1
+    self.calls.append(("create", googlecode_issue.GetId()))
+    return self._next_issue_number
+
+  def EditIssue(self, googlecode_issue, issue_number):
+    self.calls.append(("edit_issue", issue_number))
+
+
+class SyncTest(unittest.TestCase):
+  """Tests for syncing changes with a SyncManifest."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.manifest_path = os.path.join(self.temp_dir, "manifest.json")
+    self.issue_json = copy.deepcopy(ISSUE_JSON)
+    self.issue_json["comments"]["items"] = copy.deepcopy(COMMENTS_DATA)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _Sync(self, issue_service=None):
+    issue_service = issue_service or SyncIssueService()
+    exporter = issues.IssueExporter(
+        issue_service, issues.UserService(), [copy.deepcopy(self.issue_json)],
+        REPO, USER_MAP,
+        sync_manifest=issues.SyncManifest(self.manifest_path))
+    exporter.Init()
+    exporter.Start()
+    return issue_service.calls
+
+  def testFirstSyncCreatesEverything(self):
+    self.assertEqual([("create", 1), ("comment", 101, 2), ("comment", 101, 3),
+                      ("comment", 101, 4), ("close", 101)], self._Sync())
+    manifest = issues.SyncManifest(self.manifest_path).Get(1)
+    self.assertEqual(101, manifest["number"])
+    self.assertEqual([1, 2, 3], [c[1] for c in manifest["comments"]])
+    self.assertFalse(manifest["open"])
+
+  def testUnchangedSyncDoesNothing(self):
+    self._Sync()
+    self.assertEqual([], self._Sync())
+
+  def testOnlyChangesAreSynced(self):
+    self._Sync()
+    self.issue_json["labels"].append("new-label")
+    self.issue_json["comments"]["items"][2]["content"] = "three, edited"
+    self.issue_json["comments"]["items"].append(
+        {"content": "five", "id": 5, "published": "now"})
+    self.assertEqual([("edit_issue", 101), ("edit", 2), ("comment", 5)],
+                     [(call[0], call[-1]) for call in self._Sync()])
+
+  def testAdoptsIssuesExportedWithoutManifest(self):
+    issue_service = SyncIssueService(
+        [{"number": 7, "title": "issue_title", "comments": 2}])
+    issue_service.bodies[7] = [{"id": 70}, {"id": 71}]
+    self.issue_json["comments"]["items"][1]["content"] = "two, edited"
+    calls = self._Sync(issue_service)
+    # The existing comments are assumed unchanged, the missing one is added
+    # and the state is unknown, so the issue is closed again.
+    self.assertEqual(["comment", "close"], [call[0] for call in calls])
+    self.assertEqual([None, None, 1], [
+        c[1] for c in issues.SyncManifest(self.manifest_path).Get(1)[
+            "comments"]])
+
+  def testManifestIsSavedInBatches(self):
+    saves = []
+    sync_manifest = issues.SyncManifest(self.manifest_path)
+    sync_manifest.Save = lambda: saves.append(
+        [call[0] for call in issue_service.calls].count("create"))
+    issue_json = []
+    for issue_id in range(1, 6):
+      issue_json.append(copy.deepcopy(self.issue_json))
+      issue_json[-1]["id"] = issue_id
+      del issue_json[-1]["comments"]["items"][1:]
+    issue_service = SyncIssueService()
+    exporter = issues.IssueExporter(
+        issue_service, issues.UserService(), issue_json, REPO, USER_MAP,
+        sync_manifest=sync_manifest)
+    exporter.Init()
+    interval = issues.SYNC_MANIFEST_SAVE_INTERVAL
+    issues.SYNC_MANIFEST_SAVE_INTERVAL = 2
+    try:
+      exporter.Start()
+    finally:
+      issues.SYNC_MANIFEST_SAVE_INTERVAL = interval
+    self.assertEqual([2, 4, 5], saves)
+
+  def testManifestIsSavedOnFailure(self):
+    issue_service = SyncIssueService()
+    def FailingCreateComment(issue_number, googlecode_comment):
+      raise IOError("failed")
+    issue_service.CreateComment = FailingCreateComment
+    with self.assertRaises(IOError):
+      self._Sync(issue_service)
+    self.assertEqual(
+        101, issues.SyncManifest(self.manifest_path).Get(1)["number"])
+
+  def testAdoptedCommentsMissingOnService(self):
+    issue_service = SyncIssueService(
+        [{"number": 7, "title": "issue_title", "comments": 2}])
+    issue_service.bodies[7] = [{"id": 70}]
+    self.issue_json["comments"]["items"][2]["content"] = "three, edited"
+    calls = self._Sync(issue_service)
+    self.assertEqual(["comment", "close"], [call[0] for call in calls])
+    self.assertEqual([None, None, 1], [
+        c[1] for c in issues.SyncManifest(self.manifest_path).Get(1)[
+            "comments"]])
+
+  def testCommentHashIgnoresIdMapping(self):
+    issue = issues.GoogleCodeIssue(self.issue_json, REPO, USER_MAP)
+    comment = {"content": "See issue 1", "id": 2, "published": "now",
+               "author": {"name": "user@email.com"}}
+    self.assertNotEqual(
+        issues.GoogleCodeComment(issue, comment).GetDescription(),
+        issues.GoogleCodeComment(issue, comment, {"1": "7"}).GetDescription())
+    self.assertEqual(
+        issues.HashComment(issues.GoogleCodeComment(issue, comment)),
+        issues.HashComment(issues.GoogleCodeComment(issue, comment,
+                                                    {"1": "7"})))
+
+
+class TwoPhaseExportTest(unittest.TestCase):
+  """Tests for exporting placeholders first and filling them in later."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.journal_path = os.path.join(self.temp_dir, "journal")
+    self.issue_data = []
+    for idx in range(3):
+      issue = copy.deepcopy(ISSUE_JSON)
+      issue["id"] = idx + 1
+      issue["title"] = "issue %d" % (idx + 1)
+      issue["comments"]["items"] = copy.deepcopy(COMMENTS_DATA)
+      self.issue_data.append(issue)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _Export(self, issue_service, fill_workers=2):
+    journal = issues.ExportJournal(self.journal_path)
+    exporter = issues.IssueExporter(
+        issue_service, issues.UserService(), copy.deepcopy(self.issue_data),
+        REPO, USER_MAP, export_journal=journal, fill_workers=fill_workers)
+    try:
+      exporter.Init()
+      exporter.Start()
+    finally:
+      journal.Close()
+
+  def testPlaceholdersCreatedInOrderFirst(self):
+    issue_service = SyncIssueService()
+    self._Export(issue_service)
+    self.assertEqual([("create", 1), ("create", 2), ("create", 3)],
+                     issue_service.calls[:3])
+    for number in (101, 102, 103):
+      calls = [call for call in issue_service.calls[3:]
+               if call[1] == number]
+      self.assertEqual([("edit_issue", number), ("comment", number, 2),
+                        ("comment", number, 3), ("comment", number, 4),
+                        ("close", number)], calls)
+    journal = issues.ExportJournal(self.journal_path)
+    self.assertEqual({"number": 102, "filled": True}, journal.Get(2))
+    journal.Close()
+
+  def testPlaceholderHasNoContent(self):
+    googlecode_issue = issues.GoogleCodeIssue(
+        self.issue_data[0], REPO, USER_MAP)
+    placeholder = issues.PlaceholderIssue(googlecode_issue)
+    self.assertEqual(googlecode_issue.GetTitle(), placeholder.GetTitle())
+    self.assertEqual(googlecode_issue.GetIdempotencyKey(),
+                     placeholder.GetIdempotencyKey())
+    self.assertEqual(issues.PLACEHOLDER_DESCRIPTION % 1,
+                     placeholder.GetDescription())
+    self.assertEqual([], placeholder.GetLabels())
+    self.assertEqual(None, placeholder.GetOwner())
+
+  def testResumesFromJournal(self):
+    with open(self.journal_path, "w") as journal_file:
+      journal_file.write('{"id": 1, "number": 101}\n{"id": 1, "filled": true}\n'
+                         '{"id": 2, "number": 102}\n{"id": 3, "num')
+    # Issue #3's placeholder was created but not recorded, and issue #2 got
+    # one of its comments.
+    issue_service = SyncIssueService([
+        {"number": 101, "title": "issue 1", "comments": 3},
+        {"number": 102, "title": "issue 2", "comments": 1},
+        {"number": 103, "title": "issue 3", "comments": 0},
+    ])
+    self._Export(issue_service, fill_workers=1)
+    self.assertEqual([("edit_issue", 102), ("comment", 102, 3),
+                      ("comment", 102, 4), ("close", 102),
+                      ("edit_issue", 103), ("comment", 103, 2),
+                      ("comment", 103, 3), ("comment", 103, 4),
+                      ("close", 103)], issue_service.calls)
+    journal = issues.ExportJournal(self.journal_path)
+    self.assertEqual({"number": 103, "filled": True}, journal.Get(3))
+    journal.Close()
+
+
+class LazyIssueListTest(unittest.TestCase):
+  """Tests for loading issues lazily from a Takeout file."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.issue_file_path = os.path.join(self.temp_dir, "takeout.json")
+    tricky_issue = copy.deepcopy(ISSUE_JSON)
+    tricky_issue["title"] = u"Braces {[\"]}\\ and \u00fcnicode"
+    tricky_issue["comments"]["items"] = copy.deepcopy(COMMENTS_DATA)
+    self.issues = [copy.deepcopy(ISSUE_JSON), tricky_issue]
+    takeout = {"projects": [
+        # The name may come after the issues.
+        {"issues": {"items": [{"id": 7, "name": "not-a-project"}]},
+         "name": "other-project"},
+        {"name": REPO, "issues": {"kind": "list", "items": self.issues}},
+    ]}
+    with open(self.issue_file_path, "w") as issue_file:
+      json.dump(takeout, issue_file, indent=1)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def testMatchesEagerLoading(self):
+    issue_data = issues.LoadIssueData(self.issue_file_path, REPO, lazy=True)
+    try:
+      self.assertIsInstance(issue_data, issues.LazyIssueList)
+      self.assertEqual(2, len(issue_data))
+      self.assertEqual(issues.LoadIssueData(self.issue_file_path, REPO),
+                       list(issue_data))
+      other = issues.LoadIssueData(
+          self.issue_file_path, "other-project", lazy=True)
+      self.assertEqual([{"id": 7, "name": "not-a-project"}], list(other))
+      other.Close()
+    finally:
+      issue_data.Close()
+
+  def testDecodesOnEveryAccess(self):
+    issue_data = issues.LoadIssueData(self.issue_file_path, REPO, lazy=True)
+    issue_data[0]["title"] = "Changed"
+    self.assertEqual(ISSUE_JSON["title"], issue_data[0]["title"])
+    issue_data.Close()
+
+  def testProjectNotFound(self):
+    with self.assertRaises(issues.ProjectNotFoundError):
+      issues.LoadIssueData(self.issue_file_path, "missing", lazy=True)
+
+  def testIndexSelectsLazySubset(self):
+    issue_data = issues.LoadIssueData(self.issue_file_path, REPO, lazy=True)
+    selection = issues.IssueIndex(issue_data).Select(
+        issues.IssueFilter(id_ranges=[(ISSUE_JSON["id"], ISSUE_JSON["id"])]))
+    self.assertIsInstance(selection, issues.LazyIssueList)
+    self.assertEqual(self.issues, list(selection))
+    issue_data.Close()
+
+
+class OpenIssueFileTest(unittest.TestCase):
+  """Tests for reading compressed Takeout files."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.takeout = json.dumps({"projects": [
+        {"name": REPO, "issues": {"items": [ISSUE_JSON]}}]})
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _Path(self, name):
+    return os.path.join(self.temp_dir, name)
+
+  def _AssertLoads(self, issue_file_path):
+    self.assertEqual([ISSUE_JSON],
+                     issues.LoadIssueData(issue_file_path, REPO))
+    issue_data = issues.LoadIssueData(issue_file_path, REPO, lazy=True)
+    self.assertEqual([ISSUE_JSON], list(issue_data))
+    issue_data.Close()
+
+  def testCompressedFiles(self):
+    gzip_file = gzip.open(self._Path("takeout.json.gz"), "wb")
+    gzip_file.write(self.takeout)
+    gzip_file.close()
+    self._AssertLoads(self._Path("takeout.json.gz"))
+    bz2_file = bz2.BZ2File(self._Path("takeout.json.bz2"), "w")
+    bz2_file.write(self.takeout)
+    bz2_file.close()
+    self._AssertLoads(self._Path("takeout.json.bz2"))
+
+  def testZipMembers(self):
+    archive = zipfile.ZipFile(self._Path("takeout.zip"), "w")
+    archive.writestr("Takeout/GoogleCodeProjectHosting.json", self.takeout)
+    archive.writestr("Takeout/index.html", "<html></html>")
+    archive.close()
+    self._AssertLoads(self._Path("takeout.zip"))
+    self._AssertLoads(
+        self._Path("takeout.zip/Takeout/GoogleCodeProjectHosting.json"))
+    with self.assertRaises(IOError):
+      issues.LoadIssueData(self._Path("takeout.zip/missing.json"), REPO)
+
+
+class IssueCacheTest(unittest.TestCase):
+  """Tests for the issue cache."""
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.issue_file_path = os.path.join(self.temp_dir, "takeout.json")
+    self._WriteTakeout([ISSUE_JSON])
+    self.cache_path = issues.GetIssueCachePath(self.issue_file_path, REPO)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_dir)
+
+  def _WriteTakeout(self, issue_data):
+    with open(self.issue_file_path, "w") as issue_file:
+      json.dump({"projects": [{"name": REPO, "issues": {"items": issue_data}}]},
+                issue_file)
+
+  def _Load(self):
+    return issues.LoadIssueData(self.issue_file_path, REPO, use_cache=True)
+
+  def testCreatedAndReused(self):
+    self.assertFalse(os.path.exists(self.cache_path))
+    self.assertEqual([ISSUE_JSON], self._Load())
+    self.assertTrue(os.path.exists(self.cache_path))
+    self.assertEqual(os.path.join(self.temp_dir, "takeout.json.%s.issuecache"
+                                  % REPO), self.cache_path)
+
+    # Tamper with the cached issues to tell whether they are used.
+    with open(self.cache_path, "rb") as cache_file:
+      key = issues.marshal.load(cache_file)
+    with open(self.cache_path, "wb") as cache_file:
+      issues.marshal.dump(key, cache_file)
+      issues.marshal.dump([{"id": 42}], cache_file)
+    self.assertEqual([{"id": 42}], self._Load())
+
+  def testRebuiltWhenStale(self):
+    self._Load()
+    self._WriteTakeout([ISSUE_JSON, ISSUE_JSON])
+    self.assertEqual([ISSUE_JSON, ISSUE_JSON], self._Load())
+
+  def testRebuiltWhenSourceChanges(self):
+    self._Load()
+    with open(self.cache_path, "rb") as cache_file:
+      key = issues.marshal.load(cache_file)
+    self.assertEqual(40, len(key["source"]))
+    key["source"] = "0" * 40
+    with open(self.cache_path, "wb") as cache_file:
+      issues.marshal.dump(key, cache_file)
+      issues.marshal.dump([{"id": 42}], cache_file)
+    self.assertEqual([ISSUE_JSON], self._Load())
+
+  def testRebuiltWhenCorrupt(self):
+    with open(self.cache_path, "wb") as cache_file:
+      cache_file.write("not marshal data")
+    self.assertEqual([ISSUE_JSON], self._Load())
+
+
 if __name__ == "__main__":
   unittest.main(buffer=True)
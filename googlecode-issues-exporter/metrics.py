@@ -0,0 +1,363 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Metrics and tracing for long running issue exports.
+
+An ExportMetrics instance is shared by the issue exporter and the service it
+talks to. It keeps latency histograms per operation, counts API calls and
+retries per issue, and tracks how much wall time was spent sleeping (rate
+limits, comment delays) versus doing work.
+
+Optionally every event is appended to a JSONL trace file, and an OpenMetrics
+text file is periodically rewritten so a local scraper (e.g. the node
+exporter's textfile collector) can pick it up.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the operation latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Upper bounds of the per-issue API call and retry histogram buckets.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+# The default number of seconds between rewrites of the OpenMetrics file.
+DEFAULT_FLUSH_INTERVAL = 15
+# Prefix for all exported metric names.
+METRIC_PREFIX = "issue_exporter"
+
+
+class Histogram(object):
+  """A cumulative histogram with fixed bucket bounds."""
+
+  def __init__(self, buckets):
+    """Initialize the Histogram.
+
+    Args:
+      buckets: A sorted sequence of bucket upper bounds.
+    """
+    self.buckets = tuple(buckets)
+    self.counts = [0] * len(self.buckets)
+    self.count = 0
+    self.sum = 0.0
+
+  def Observe(self, value):
+    """Records a single observation."""
+    self.count += 1
+    self.sum += value
+    for idx, bound in enumerate(self.buckets):
+      if value <= bound:
+        self.counts[idx] += 1
+        break
+
+  def CumulativeCounts(self):
+    """Returns (bound, count) pairs with cumulative counts, ending at +Inf."""
+    result = []
+    total = 0
+    for bound, count in zip(self.buckets, self.counts):
+      total += count
+      result.append((_FormatValue(bound), total))
+    result.append(("+Inf", self.count))
+    return result
+
+
+def _FormatValue(value):
+  """Formats a number for the OpenMetrics exposition format."""
+  if isinstance(value, float):
+    return repr(value)
+  return str(value)
+
+
+def _FormatLabels(labels):
+  """Formats a label dictionary as '{name="value",...}'."""
+  if not labels:
+    return ""
+  return "{%s}" % ",".join(
+      '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+      for name, value in labels)
+
+
+class ExportMetrics(object):
+  """Collects and publishes metrics about an issue export.
+
+  Attributes:
+    operation_latency: Dictionary from operation name ('create', 'comment',
+        'close', 'edit', 'get') to a latency Histogram.
+    api_calls: Total number of HTTP requests made.
+    retries: Total number of HTTP requests that were retries.
+    sleep_seconds: Dictionary from sleep reason to seconds spent sleeping.
+  """
+
+  def __init__(self, trace_path=None, metrics_path=None,
+               flush_interval=DEFAULT_FLUSH_INTERVAL, clock=None):
+    """Initialize the ExportMetrics.
+
+    Args:
+      trace_path: Optional path of a JSONL file to append trace events to.
+      metrics_path: Optional path of an OpenMetrics text file to refresh.
+      flush_interval: Minimum number of seconds between metrics file rewrites.
+      clock: Function returning the current time in seconds, defaults to
+          time.time.
+    """
+    self._clock = clock if clock else time.time
+    self._trace_file = open(trace_path, "a") if trace_path else None
+    self._metrics_path = metrics_path
+    self._flush_interval = flush_interval
+    self._start_time = self._clock()
+    self._last_flush = None
+
+    self.operation_latency = collections.defaultdict(
+        lambda: Histogram(LATENCY_BUCKETS))
+    self.api_calls = 0
+    self.retries = 0
+    self.sleep_seconds = collections.defaultdict(float)
+    self._issue_api_calls = Histogram(COUNT_BUCKETS)
+    self._issue_retries = Histogram(COUNT_BUCKETS)
+
+    self._issues_total = 0
+    self._issues_done = 0
+    self._issues_exported = 0
+    self._first_export_time = None
+    # Operations may run on several threads (see issues.CommentScheduler), so
+    # updates are locked and the current issue is tracked per thread.
+    self._lock = threading.RLock()
+    self._local = threading.local()
+
+  @property
+  def _current_issue(self):
+    return getattr(self._local, "current_issue", None)
+
+  @_current_issue.setter
+  def _current_issue(self, value):
+    self._local.current_issue = value
+
+  def Now(self):
+    """Returns the current time according to the metrics clock."""
+    return self._clock()
+
+  def SetIssueTotal(self, issue_total):
+    """Sets the number of issues the export will visit."""
+    self._issues_total = issue_total
+
+  def StartIssue(self, issue_id):
+    """Marks the start of work on a Google Code issue.
+
+    API calls and retries are attributed to the current issue until the next
+    call to FinishIssue.
+    """
+    self._current_issue = {
+        "id": issue_id,
+        "start": self._clock(),
+        "api_calls": 0,
+        "retries": 0,
+    }
+
+  def FinishIssue(self, skipped=False):
+    """Marks the end of work on the current issue.
+
+    Args:
+      skipped: Whether the issue had been exported by a previous run. Skipped
+          issues are excluded from the throughput estimate.
+    """
+    current = self._current_issue
+    self._current_issue = None
+    with self._lock:
+      self._issues_done += 1
+      if skipped or not current:
+        return
+      self._issues_exported += 1
+      if self._first_export_time is None:
+        self._first_export_time = current["start"]
+      self._issue_api_calls.Observe(current["api_calls"])
+      self._issue_retries.Observe(current["retries"])
+      self._Trace("issue", issue=current["id"],
+                  seconds=self._clock() - current["start"],
+                  api_calls=current["api_calls"], retries=current["retries"])
+      self._MaybeFlush()
+
+  @contextlib.contextmanager
+  def Time(self, operation):
+    """Context manager recording the latency of an issue service operation.
+
+    Args:
+      operation: The operation name, e.g. 'create' or 'comment'.
+    """
+    start = self._clock()
+    try:
+      yield
+    finally:
+      seconds = self._clock() - start
+      with self._lock:
+        self.operation_latency[operation].Observe(seconds)
+        self._Trace("operation", operation=operation, seconds=seconds,
+                    issue=self._CurrentIssueId())
+        self._MaybeFlush()
+
+  def RecordApiCall(self, method, status, seconds, retry=False):
+    """Records a single HTTP request to the service.
+
+    Args:
+      method: The HTTP method.
+      status: The HTTP status code of the response.
+      seconds: The time the request took.
+      retry: Whether the request was a retry of a failed request.
+    """
+    with self._lock:
+      self.api_calls += 1
+      if retry:
+        self.retries += 1
+      if self._current_issue:
+        self._current_issue["api_calls"] += 1
+        if retry:
+          self._current_issue["retries"] += 1
+      self._Trace("api_call", method=method, status=status, seconds=seconds,
+                  retry=retry, issue=self._CurrentIssueId())
+
+  def RecordSleep(self, seconds, reason):
+    """Records time deliberately spent sleeping.
+
+    Args:
+      seconds: The number of seconds slept.
+      reason: Why the sleep happened, e.g. 'rate_limit' or 'comment_delay'.
+    """
+    with self._lock:
+      self.sleep_seconds[reason] += seconds
+      self._Trace("sleep", reason=reason, seconds=seconds,
+                  issue=self._CurrentIssueId())
+      self._MaybeFlush()
+
+  def GetElapsedSeconds(self):
+    """Returns the seconds since the metrics were created."""
+    return self._clock() - self._start_time
+
+  def GetWorkSeconds(self):
+    """Returns the elapsed seconds not spent sleeping."""
+    return max(0.0, self.GetElapsedSeconds() - sum(self.sleep_seconds.values()))
+
+  def GetThroughput(self):
+    """Returns the number of newly exported issues per second."""
+    if self._first_export_time is None:
+      return 0.0
+    elapsed = self._clock() - self._first_export_time
+    if elapsed <= 0:
+      return 0.0
+    return self._issues_exported / elapsed
+
+  def GetEta(self):
+    """Returns the estimated seconds remaining, or None if unknown."""
+    throughput = self.GetThroughput()
+    if not throughput:
+      return None
+    remaining = max(0, self._issues_total - self._issues_done)
+    return remaining / throughput
+
+  def Flush(self):
+    """Rewrites the OpenMetrics file and flushes the trace file."""
+    with self._lock:
+      self._last_flush = self._clock()
+      if self._trace_file:
+        self._trace_file.flush()
+      if not self._metrics_path:
+        return
+      # Write to a temporary file first so scrapers never see a partial file.
+      temp_path = self._metrics_path + ".tmp"
+      with open(temp_path, "w") as metrics_file:
+        metrics_file.write(self.FormatOpenMetrics())
+      os.rename(temp_path, self._metrics_path)
+
+  def Close(self):
+    """Writes the final metrics and closes the trace file."""
+    self.Flush()
+    if self._trace_file:
+      self._trace_file.close()
+      self._trace_file = None
+
+  def FormatOpenMetrics(self):
+    """Returns the current metrics in the OpenMetrics text format."""
+    lines = []
+
+    def AddMetric(name, metric_type, help_text, samples):
+      full_name = "%s_%s" % (METRIC_PREFIX, name)
+      lines.append("# TYPE %s %s" % (full_name, metric_type))
+      lines.append("# HELP %s %s" % (full_name, help_text))
+      for suffix, labels, value in samples:
+        lines.append("%s%s%s %s" % (
+            full_name, suffix, _FormatLabels(labels), _FormatValue(value)))
+
+    def HistogramSamples(histogram, labels):
+      samples = []
+      for bound, count in histogram.CumulativeCounts():
+        samples.append(("_bucket", labels + [("le", bound)], count))
+      samples.append(("_count", labels, histogram.count))
+      samples.append(("_sum", labels, histogram.sum))
+      return samples
+
+    latency_samples = []
+    for operation in sorted(self.operation_latency):
+      latency_samples.extend(HistogramSamples(
+          self.operation_latency[operation], [("operation", operation)]))
+    AddMetric("operation_seconds", "histogram",
+              "Latency of issue service operations.", latency_samples)
+    AddMetric("issue_api_calls", "histogram",
+              "API calls made per exported issue.",
+              HistogramSamples(self._issue_api_calls, []))
+    AddMetric("issue_retries", "histogram",
+              "Retried API calls per exported issue.",
+              HistogramSamples(self._issue_retries, []))
+    AddMetric("api_calls", "counter", "HTTP requests made.",
+              [("_total", [], self.api_calls)])
+    AddMetric("retries", "counter", "HTTP requests that were retries.",
+              [("_total", [], self.retries)])
+    AddMetric("sleep_seconds", "counter", "Seconds spent sleeping.",
+              [("_total", [("reason", reason)], self.sleep_seconds[reason])
+               for reason in sorted(self.sleep_seconds)])
+    AddMetric("work_seconds", "counter", "Seconds spent not sleeping.",
+              [("_total", [], self.GetWorkSeconds())])
+    AddMetric("issues_done", "gauge", "Issues visited so far.",
+              [("", [], self._issues_done)])
+    AddMetric("issues", "gauge", "Issues to visit in total.",
+              [("", [], self._issues_total)])
+    AddMetric("throughput_issues_per_second", "gauge",
+              "Newly exported issues per second.",
+              [("", [], self.GetThroughput())])
+    eta = self.GetEta()
+    if eta is not None:
+      AddMetric("eta_seconds", "gauge", "Estimated seconds remaining.",
+                [("", [], eta)])
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+  def _CurrentIssueId(self):
+    """Returns the ID of the issue being worked on, if any."""
+    return self._current_issue["id"] if self._current_issue else None
+
+  def _Trace(self, event, **fields):
+    """Appends an event to the JSONL trace file, if enabled."""
+    if not self._trace_file:
+      return
+    fields["event"] = event
+    fields["ts"] = self._clock()
+    self._trace_file.write(json.dumps(fields, sort_keys=True) + "\n")
+
+  def _MaybeFlush(self):
+    """Flushes if the flush interval has passed since the last flush."""
+    if not self._metrics_path and not self._trace_file:
+      return
+    if (self._last_flush is None or
+        self._clock() - self._last_flush >= self._flush_interval):
+      self.Flush()
@@ -0,0 +1,133 @@
+# Copyright 2015 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the export metrics."""
+
+# pylint: disable=missing-docstring,protected-access
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestHistogram(unittest.TestCase):
+
+  def testCumulativeCounts(self):
+    histogram = metrics.Histogram((1, 5))
+    histogram.Observe(0.5)
+    histogram.Observe(2)
+    histogram.Observe(10)
+    self.assertEqual([("1", 1), ("5", 2), ("+Inf", 3)],
+                     histogram.CumulativeCounts())
+    self.assertEqual(3, histogram.count)
+    self.assertEqual(12.5, histogram.sum)
+
+
+class TestExportMetrics(unittest.TestCase):
+
+  def setUp(self):
+    self.temp_dir = tempfile.mkdtemp()
+    self.trace_path = os.path.join(self.temp_dir, "trace.jsonl")
+    self.metrics_path = os.path.join(self.temp_dir, "export.prom")
+    self.clock = FakeClock()
+    self.metrics = metrics.ExportMetrics(
+        self.trace_path, self.metrics_path, flush_interval=60,
+        clock=self.clock)
+
+  def tearDown(self):
+    self.metrics.Close()
+    shutil.rmtree(self.temp_dir)
+
+  def testOperationAndApiCalls(self):
+    self.metrics.SetIssueTotal(2)
+    self.metrics.StartIssue(7)
+    with self.metrics.Time("create"):
+      self.clock.now += 2
+      self.metrics.RecordApiCall("POST", 500, 1)
+      self.metrics.RecordApiCall("POST", 201, 1, retry=True)
+    self.metrics.FinishIssue()
+
+    self.assertEqual(2, self.metrics.api_calls)
+    self.assertEqual(1, self.metrics.retries)
+    self.assertEqual(1, self.metrics.operation_latency["create"].count)
+    self.assertEqual(2, self.metrics.operation_latency["create"].sum)
+    self.assertEqual(0.5, self.metrics.GetThroughput())
+    self.assertEqual(2, self.metrics.GetEta())
+
+  def testSleepVersusWork(self):
+    self.clock.now += 10
+    self.metrics.RecordSleep(4, "rate_limit")
+    self.metrics.RecordSleep(1, "comment_delay")
+    self.assertEqual(10, self.metrics.GetElapsedSeconds())
+    self.assertEqual(5, self.metrics.GetWorkSeconds())
+
+  def testSkippedIssuesExcludedFromThroughput(self):
+    self.metrics.SetIssueTotal(3)
+    self.metrics.StartIssue(1)
+    self.metrics.FinishIssue(skipped=True)
+    self.assertEqual(0.0, self.metrics.GetThroughput())
+    self.assertEqual(None, self.metrics.GetEta())
+
+  def testTraceFile(self):
+    self.metrics.StartIssue(3)
+    self.metrics.RecordApiCall("GET", 200, 0.25)
+    self.metrics.FinishIssue()
+    self.metrics.Close()
+
+    with open(self.trace_path) as trace_file:
+      events = [json.loads(line) for line in trace_file]
+    self.assertEqual(["api_call", "issue"], [e["event"] for e in events])
+    self.assertEqual(3, events[0]["issue"])
+    self.assertEqual(1, events[1]["api_calls"])
+
+  def testOpenMetricsFile(self):
+    with self.metrics.Time("comment"):
+      self.clock.now += 0.2
+    self.metrics.RecordSleep(3, "rate_limit")
+    self.metrics.Flush()
+
+    with open(self.metrics_path) as metrics_file:
+      text = metrics_file.read()
+    self.assertIn('issue_exporter_operation_seconds_bucket'
+                  '{operation="comment",le="0.25"} 1\n', text)
+    self.assertIn('issue_exporter_sleep_seconds_total'
+                  '{reason="rate_limit"} 3.0\n', text)
+    self.assertTrue(text.endswith("# EOF\n"))
+
+  def testPeriodicFlush(self):
+    self.metrics.RecordSleep(1, "rate_limit")
+    self.assertTrue(os.path.exists(self.metrics_path))
+    os.remove(self.metrics_path)
+    self.metrics.RecordSleep(1, "rate_limit")
+    self.assertFalse(os.path.exists(self.metrics_path))
+    self.clock.now += 60
+    self.metrics.RecordSleep(1, "rate_limit")
+    self.assertTrue(os.path.exists(self.metrics_path))
+
+
+if __name__ == "__main__":
+  unittest.main(buffer=True)
@@ -0,0 +1,211 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tool to measure the speed of the Wiki to Markdown conversion.
+
+  The pages of the corpus are converted in memory, several times over, and
+  the best time of each page is reported along with the number of formatting
+  rule matches, to compare the overhead per match between changes.
+
+  With --fuzz, lines made of random repeated markup fragments are converted
+  at two lengths instead, and the fragments whose conversion time grows
+  faster than the line length are reported.
+"""
+import argparse
+
+import codecs
+import os
+import random
+import sys
+import time
+
+from impl import batch_converter as batch_converter_mod
+from impl import constants
+
+
+DEFAULT_CORPUS = [os.path.join(os.path.dirname(__file__) or ".",
+                               "example.wiki")]
+
+# The pieces of markup the fuzzed lines are made of: the delimiters of the
+# formatting rules, and text that can complete or break their matches.
+FUZZ_FRAGMENTS = [
+    u"*", u"_", u"~~", u"^", u",,", u"`", u"{{{", u"}}}", u"||", u"|",
+    u"[", u"]", u"#", u"<a", u"</a", u"ns:", u" b=", u"\"", u"'", u"/>",
+    u">", u"%%", u"http://", u"mailto:", u"Wiki", u"Word", u"issue ", u"r",
+    u"1", u"x", u" ", u"  ", u"=", u".", u"!"]
+
+# Conversion time growing this much more than the line length is reported.
+FUZZ_GROWTH_LIMIT = 2.0
+
+
+def CountMatches(lines):
+  """Count the formatting rule matches of a page.
+
+  Args:
+    lines: The lines of the page.
+
+  Returns:
+    The number of matches of the line and text formatting rules.
+  """
+  matches = 0
+  for line in lines:
+    matches += sum(1 for _ in constants.LINE_FORMAT_RE.finditer(line))
+    matches += sum(1 for _ in constants.TEXT_FORMAT_RE.finditer(line))
+  return matches
+
+
+def TimePage(page_converter, lines, scale, repeat):
+  """Time the conversion of a page.
+
+  Args:
+    page_converter: The PageConverter to convert with.
+    lines: The lines of the page.
+    scale: How many times the page is repeated to make a larger page.
+    repeat: How many times the conversion is timed.
+
+  Returns:
+    The best time of the conversion, in seconds.
+  """
+  lines = lines * scale
+  best = None
+  for _ in xrange(repeat):
+    start = time.time()
+    page_converter.Convert(lines)
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def TimeLine(page_converter, line, repeat):
+  """Time the conversion of a single line.
+
+  Args:
+    page_converter: The PageConverter to convert with.
+    line: The line, without newline.
+    repeat: How many times the conversion is timed.
+
+  Returns:
+    The best time of the conversion, in seconds.
+  """
+  return TimePage(page_converter, [line + u"\n"], 1, repeat)
+
+
+def Fuzz(page_converter, cases, length, repeat, seed):
+  """Find markup whose conversion time is super-linear in the line length.
+
+  Each case is a random sequence of up to four fragments, repeated to make a
+  line of about length characters and one four times as long.
+
+  Args:
+    page_converter: The PageConverter to convert with.
+    cases: The number of fragment sequences to try.
+    length: The length of the shorter line.
+    repeat: How many times each line is converted, the best time is used.
+    seed: The seed of the random fragment sequences.
+
+  Returns:
+    The number of super-linear cases.
+  """
+  rand = random.Random(seed)
+  results = []
+  for _ in xrange(cases):
+    fragment = u"".join(rand.choice(FUZZ_FRAGMENTS)
+                        for _ in xrange(rand.randint(1, 4)))
+    count = max(length // len(fragment), 1)
+    short_time = TimeLine(page_converter, fragment * count, repeat)
+    long_time = TimeLine(page_converter, fragment * (count * 4), repeat)
+    results.append((long_time / max(short_time, 1e-6), long_time, fragment))
+
+  results.sort(reverse=True)
+  super_linear = 0
+  for growth, long_time, fragment in results:
+    # Linear conversion grows about 4 times with 4 times the line length.
+    if growth <= 4 * FUZZ_GROWTH_LIMIT:
+      break
+    super_linear += 1
+    print u"{0!r}: {1:.1f} times as slow at 4x the length, {2:.1f} ms".format(
+        fragment, growth, long_time * 1000)
+  print u"{0} of {1} cases super-linear, worst growth {2:.1f}".format(
+      super_linear, cases, results[0][0] if results else 0.0)
+  return super_linear
+
+
+def PrintTiming(name, elapsed, lines, matches):
+  """Print the timing of a conversion.
+
+  Args:
+    name: What was converted.
+    elapsed: The time of the conversion, in seconds.
+    lines: The number of lines converted.
+    matches: The number of formatting rule matches.
+  """
+  print u"{0}: {1:.1f} ms, {2} lines, {3:.2f} us/line, {4} matches{5}".format(
+      name, elapsed * 1000, lines, elapsed * 1e6 / max(lines, 1), matches,
+      u", {0:.2f} us/match".format(elapsed * 1e6 / matches) if matches else "")
+
+
+def main(args):
+  """The main function.
+
+  Args:
+    args: The command line arguments.
+  """
+  parser = argparse.ArgumentParser(
+      description="Measures the speed of converting Google Code wiki pages "
+      "to GitHub-flavored Markdown.")
+  parser.add_argument("pages", nargs="*", default=DEFAULT_CORPUS,
+                      help="The wiki pages of the corpus, defaults to "
+                      "example.wiki")
+  parser.add_argument("--scale", type=int, default=20,
+                      help="How many times each page is repeated to make a "
+                      "larger page")
+  parser.add_argument("--repeat", type=int, default=5,
+                      help="How many times each page is converted, the best "
+                      "time is reported")
+  parser.add_argument("--fuzz", type=int, metavar="CASES",
+                      help="Instead of converting the corpus, time this many "
+                      "lines of random repeated markup and report those "
+                      "whose conversion is super-linear in their length")
+  parser.add_argument("--fuzz_length", type=int, default=2000,
+                      help="The length of the shorter fuzzed lines")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="The seed of the fuzzed lines")
+  parsed_args = parser.parse_args(args[1:])
+
+  page_converter = batch_converter_mod.PageConverter("test", [], False)
+  if parsed_args.fuzz:
+    if Fuzz(page_converter, parsed_args.fuzz, parsed_args.fuzz_length,
+            parsed_args.repeat, parsed_args.seed):
+      sys.exit(1)
+    return
+
+  total_time = 0.0
+  total_lines = 0
+  total_matches = 0
+  for page in parsed_args.pages:
+    with codecs.open(page, "rU", "utf-8") as input_stream:
+      lines = input_stream.readlines()
+    best = TimePage(page_converter, lines, parsed_args.scale,
+                    parsed_args.repeat)
+    page_lines = len(lines) * parsed_args.scale
+    page_matches = CountMatches(lines) * parsed_args.scale
+    PrintTiming(page, best, page_lines, page_matches)
+    total_time += best
+    total_lines += page_lines
+    total_matches += page_matches
+  PrintTiming("Total", total_time, total_lines, total_matches)
+
+
+if __name__ == "__main__":
+  main(sys.argv)
@@ -1,37 +1,43 @@
 #!/bin/bash
 
 # Converts Google Code wiki pages to GitHub flavored Markdown. This is done
-# inside of an existing git repo, and the process will build up a series
-# of git commits for each file modified.
+# inside of an existing git repo: all pages are converted in one process and
+# piped to git fast-import, which commits each page as a separate commit on
+# the current branch. The repository must not have uncommitted changes. If
+# any page fails to convert, nothing is committed and the branch is left as
+# it was.
 USAGE="Bulk converter for wiki pages.
 
-convert-repo.sh <path-to-wiki2gfm.py> <path-to-git-repo-root>
+convert-repo.sh <path-to-wiki2gfm.py> <path-to-git-repo-root> [--squash]
 "
 
-if [ $# -eq 0 ] ; then
+if [ $# -lt 2 ] ; then
     echo "$USAGE"
     exit 1
 fi
 
 PATH_TO_WIKI2GMF=$1
 GIT_REPO_ROOT=$2
+SQUASH_FLAG=""
+if [ "$3" == "--squash" ] ; then
+    SQUASH_FLAG="--fast_import_squash"
+fi
 
-for wikifile in `find "$GIT_REPO_ROOT" -name "*.wiki"`
-do
-  mdfile="`dirname $wikifile`/`basename $wikifile .wiki`.md"
-
-  printf "**************************\n"
-  printf "Converting wiki: $file\n"
-  printf "To Markdown    : $mdfile\n"
-  printf "**************************\n"
-
-  python $PATH_TO_WIKI2GMF \
-      --input_file=$wikifile \
-      --output_file=$mdfile
-
-  git rm $wikifile
-  git add $mdfile
-  git commit -m "Converted `basename $mdfile`"
+BRANCH=`git -C "$GIT_REPO_ROOT" symbolic-ref HEAD` || exit 1
+COMMITTER="`git -C "$GIT_REPO_ROOT" config user.name` <`git -C "$GIT_REPO_ROOT" config user.email`>"
+
+set -o pipefail
+if ! python "$PATH_TO_WIKI2GMF" \
+    --input_dir="$GIT_REPO_ROOT" \
+    --fast_import \
+    --fast_import_branch="$BRANCH" \
+    --fast_import_committer="$COMMITTER" \
+    $SQUASH_FLAG \
+  | git -C "$GIT_REPO_ROOT" fast-import --quiet ; then
+    echo "Conversion failed, $BRANCH was left unchanged." >&2
+    exit 1
+fi
 
-  printf "done\n\n"
-done
+# fast-import only updated the branch, check out the converted files.
+git -C "$GIT_REPO_ROOT" reset --hard --quiet
+printf "done\n"
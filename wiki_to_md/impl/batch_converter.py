@@ -0,0 +1,408 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Handles conversion of whole trees of Wiki files."""
+import codecs
+import collections
+import multiprocessing
+import os
+import StringIO
+import sys
+import time
+import traceback
+
+from . import converter as converter_mod
+from . import document as document_mod
+from . import formatting_handler as formatting_handler_mod
+from . import page_index as page_index_mod
+from . import pragma_handler as pragma_handler_mod
+from . import renderers as renderers_mod
+
+
+WIKI_EXTENSION = page_index_mod.WIKI_EXTENSION
+MARKDOWN_EXTENSION = ".md"
+
+# The encoding of file names. A C locale reports ASCII, but the pages of a
+# wiki checkout are named in UTF-8, as git stores them.
+PATH_ENCODING = sys.getfilesystemencoding() or "utf-8"
+if codecs.lookup(PATH_ENCODING).name == "ascii":
+  PATH_ENCODING = "utf-8"
+
+# The defaults of the commits of a git fast-import stream.
+DEFAULT_BRANCH = "refs/heads/master"
+DEFAULT_COMMITTER = "wiki2gfm <wiki2gfm@localhost>"
+
+# The result of converting a page. The page is its path relative to the
+# input directory, the output is the Markdown text (None if the conversion
+# failed), warnings are (input_line, message) pairs and error is the
+# traceback of a failed conversion, or None.
+PageResult = collections.namedtuple(
+    "PageResult", ["page", "output", "warnings", "error"])
+
+
+def DecodePath(path):
+  """Decode a path, if it is bytes.
+
+  Args:
+      path: The path.
+  Returns:
+      The path, as unicode.
+  """
+  if isinstance(path, str):
+    return path.decode(PATH_ENCODING)
+  return path
+
+
+def EncodePath(path):
+  """Encode a path for the file system, if it is unicode.
+
+  Args:
+      path: The path.
+  Returns:
+      The path, as bytes.
+  """
+  if isinstance(path, unicode):
+    return path.encode(PATH_ENCODING)
+  return path
+
+
+def FindPages(input_dir):
+  """Find the wiki pages in a directory tree.
+
+  Hidden directories, such as .git, are skipped.
+
+  Args:
+      input_dir: The root of the tree.
+  Returns:
+      The sorted paths of the pages, relative to input_dir, as unicode.
+  """
+  input_dir = EncodePath(input_dir)
+  pages = []
+  for dirpath, dirnames, filenames in os.walk(input_dir):
+    dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+    for filename in filenames:
+      if filename.endswith(WIKI_EXTENSION):
+        pages.append(DecodePath(os.path.relpath(
+            os.path.join(dirpath, filename), input_dir)))
+  return sorted(pages)
+
+
+def GetPageName(page):
+  """Get the wiki name of a page, as used for auto-linking.
+
+  Args:
+      page: The path of the page.
+  Returns:
+      The file name of the page, without extension.
+  """
+  return os.path.basename(page)[:-len(WIKI_EXTENSION)]
+
+
+def GetMarkdownPath(page):
+  """Get the path of the Markdown file converted from a page.
+
+  Args:
+      page: The path of the page.
+  Returns:
+      The path with the Markdown extension instead.
+  """
+  return page[:-len(WIKI_EXTENSION)] + MARKDOWN_EXTENSION
+
+
+class PageConverter(object):
+  """Converts pages one after the other, reusing a single Converter.
+
+  A page can also be parsed once into a Document, e.g. to be cached, and
+  rendered from it as often as needed.
+  """
+
+  def __init__(self, project, wikipages, symmetric_headers):
+    """Create a page converter.
+
+    Args:
+        project: The name of the Google Code project for the Wiki.
+        wikipages: Wiki pages assumed to exist for auto-linking.
+        symmetric_headers: True if header denotations are symmetric.
+    """
+    self._warnings = []
+    self._formatting_handler = formatting_handler_mod.FormattingHandler(
+        self._TrackWarning,
+        project,
+        {},
+        symmetric_headers)
+    self._converter = converter_mod.Converter(
+        pragma_handler_mod.PragmaHandler(self._TrackWarning),
+        self._formatting_handler,
+        self._TrackWarning,
+        project,
+        wikipages)
+    self._document_builder = document_mod.DocumentBuilder()
+    self._parser = converter_mod.Converter(
+        pragma_handler_mod.PragmaHandler(self._TrackWarning),
+        self._document_builder,
+        self._TrackWarning,
+        project,
+        wikipages)
+
+  def _TrackWarning(self, input_line, message):
+    """Track a warning of the page being converted.
+
+    Args:
+        input_line: Line the warning was issued on.
+        message: The warning message.
+    """
+    self._warnings.append((input_line, message))
+
+  def Convert(self, input_stream):
+    """Convert a page.
+
+    Args:
+        input_stream: Input Wiki file.
+    Returns:
+        A tuple of the Markdown text and the list of warnings, each a tuple
+        of the input line and the message.
+    """
+    self._warnings = []
+    self._formatting_handler.Reset()
+    output_stream = StringIO.StringIO()
+    self._converter.Convert(input_stream, output_stream)
+    return output_stream.getvalue(), self._warnings
+
+  def Parse(self, input_stream):
+    """Parse a page into a document.
+
+    Args:
+        input_stream: Input Wiki file.
+    Returns:
+        A tuple of the Document and the list of warnings of the parsing.
+    """
+    self._warnings = []
+    self._document_builder.Reset()
+    # The document builder outputs nothing.
+    self._parser.Convert(input_stream, None)
+    return self._document_builder.GetDocument(), self._warnings
+
+  def RenderGfm(self, document):
+    """Render a parsed page to Markdown, as Convert does.
+
+    Args:
+        document: The Document of the page.
+    Returns:
+        A tuple of the Markdown text and the list of warnings of the
+        rendering. Along with those of the parsing, they are the warnings
+        of Convert, though not in the same order: Convert interleaves them.
+    """
+    self._warnings = []
+    self._formatting_handler.Reset()
+    output_stream = StringIO.StringIO()
+    renderers_mod.GfmRenderer(self._formatting_handler).Render(
+        document, output_stream)
+    return output_stream.getvalue(), self._warnings
+
+  def ConvertPage(self, input_dir, page):
+    """Convert a page file, catching any error.
+
+    Args:
+        input_dir: The directory the page path is relative to.
+        page: The path of the page.
+    Returns:
+        The PageResult.
+    """
+    try:
+      page_path = EncodePath(os.path.join(DecodePath(input_dir),
+                                          DecodePath(page)))
+      with codecs.open(page_path, "rU", "utf-8") as input_stream:
+        output, warnings = self.Convert(input_stream)
+    except Exception:  # pylint: disable=broad-except
+      return PageResult(page, None, list(self._warnings),
+                        traceback.format_exc())
+    return PageResult(page, output, warnings, None)
+
+
+# The PageConverter and input directory of a worker process, see _InitWorker.
+_worker_converter = None
+_worker_input_dir = None
+
+
+def _InitWorker(input_dir, project, wikipages, symmetric_headers):
+  """Initialize a worker process of the pool."""
+  global _worker_converter, _worker_input_dir
+  _worker_converter = PageConverter(project, wikipages, symmetric_headers)
+  _worker_input_dir = input_dir
+
+
+def _ConvertInWorker(page):
+  """Convert a page in a worker process of the pool."""
+  return _worker_converter.ConvertPage(_worker_input_dir, page)
+
+
+def ConvertPages(input_dir, pages, project, wikipages, symmetric_headers,
+                 processes=None):
+  """Convert pages in a pool of processes.
+
+  Every process builds a single PageConverter and reuses it for all the
+  pages it converts. The page index is sent to each process once, when it
+  starts, and shared by all its pages.
+
+  Args:
+      input_dir: The directory the page paths are relative to.
+      pages: The paths of the pages to convert.
+      project: The name of the Google Code project for the Wiki.
+      wikipages: Wiki pages assumed to exist for auto-linking.
+      symmetric_headers: True if header denotations are symmetric.
+      processes: The number of processes, defaults to the number of CPUs.
+          With a single process the pages are converted in this process.
+  Yields:
+      The PageResult of every page, in the order of pages.
+  """
+  if processes == 1 or len(pages) <= 1:
+    page_converter = PageConverter(project, wikipages, symmetric_headers)
+    for page in pages:
+      yield page_converter.ConvertPage(input_dir, page)
+    return
+
+  pool = multiprocessing.Pool(
+      processes, _InitWorker,
+      (input_dir, project, wikipages, symmetric_headers))
+  try:
+    # Small chunks keep the results flowing in page order.
+    for result in pool.imap(_ConvertInWorker, pages, chunksize=4):
+      yield result
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def WritePage(output_dir, result):
+  """Write the Markdown converted from a page.
+
+  Args:
+      output_dir: The directory the Markdown path is relative to.
+      result: The PageResult of the page.
+  """
+  output_path = EncodePath(os.path.join(
+      DecodePath(output_dir), GetMarkdownPath(DecodePath(result.page))))
+  output_parent = os.path.dirname(output_path)
+  if output_parent and not os.path.isdir(output_parent):
+    os.makedirs(output_parent)
+  with codecs.open(output_path, "wU", "utf-8") as output_stream:
+    output_stream.write(result.output)
+
+
+def _QuoteGitPath(path):
+  """Quote a path for git fast-import, if needed.
+
+  Args:
+      path: The path, as UTF-8 bytes.
+  Returns:
+      The path, C-style quoted if it starts with a quote or has a newline.
+  """
+  if not path.startswith("\"") and "\n" not in path:
+    return path
+  return "\"{0}\"".format(
+      path.replace("\\", "\\\\").replace("\"", "\\\"")
+      .replace("\n", "\\n"))
+
+
+class FastImportWriter(object):
+  """Writes converted pages as a git fast-import stream.
+
+  Each converted page replaces its .wiki file with the .md file, either in a
+  commit of its own or in a single commit of all the pages. The Markdown is
+  written as a blob as soon as a page is added, so only the paths are kept
+  until the squashed commit is written.
+
+  The stream requires fast-import to see its end, written by Close: if it
+  ends early, e.g. because the conversion failed, fast-import fails without
+  updating the branch.
+  """
+
+  def __init__(self, stream, branch=DEFAULT_BRANCH,
+               committer=DEFAULT_COMMITTER, timestamp=None, squash=False):
+    """Create a fast-import writer.
+
+    Args:
+        stream: The byte stream to write to, e.g. the stdin of git
+            fast-import.
+        branch: The branch to commit to. It must exist, the first commit is
+            made on top of it.
+        committer: The committer of the commits, as "Name <email>".
+        timestamp: The time of the commits in seconds since the epoch,
+            defaults to now.
+        squash: True to commit all the pages at once, in Close.
+    """
+    self._stream = stream
+    self._branch = branch
+    self._committer = committer
+    self._timestamp = int(time.time() if timestamp is None else timestamp)
+    self._squash = squash
+    self._started = False
+    self._first_commit = True
+    self._marks = 0
+    self._pending = []  # (page, mark) of the pages not committed yet.
+
+  def AddPage(self, result):
+    """Add a converted page.
+
+    Args:
+        result: The PageResult of the page, which must have been converted.
+    """
+    if not self._started:
+      self._stream.write("feature done\n")
+      self._started = True
+    self._marks += 1
+    data = result.output.encode("utf-8")
+    self._stream.write("blob\nmark :{0}\ndata {1}\n{2}\n".format(
+        self._marks, len(data), data))
+    page = DecodePath(result.page)
+    self._pending.append((page, self._marks))
+    if not self._squash:
+      self._Commit(u"Converted {0}".format(
+          os.path.basename(GetMarkdownPath(page))))
+
+  def Close(self):
+    """Write the squashed commit, if any, and the end of the stream."""
+    if self._pending:
+      self._Commit(u"Converted {0} wiki pages to Markdown".format(
+          len(self._pending)))
+    if self._started:
+      self._stream.write("done\n")
+    self._stream.flush()
+
+  def Abort(self):
+    """Leave the stream unfinished, so fast-import leaves the branch."""
+    self._pending = []
+    self._stream.flush()
+
+  def _Commit(self, message):
+    """Commit the pending pages.
+
+    Args:
+        message: The commit message.
+    """
+    message = message.encode("utf-8")
+    self._stream.write("commit {0}\ncommitter {1} {2} +0000\n"
+                       "data {3}\n{4}\n".format(
+                           self._branch, self._committer, self._timestamp,
+                           len(message), message))
+    if self._first_commit:
+      self._stream.write("from {0}^0\n".format(self._branch))
+      self._first_commit = False
+    for page, mark in self._pending:
+      git_path = page.replace(os.sep, "/").encode("utf-8")
+      self._stream.write("D {0}\nM 100644 :{1} {2}\n".format(
+          _QuoteGitPath(git_path), mark,
+          _QuoteGitPath(GetMarkdownPath(git_path))))
+    self._stream.write("\n")
+    self._pending = []
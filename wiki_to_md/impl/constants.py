@@ -38,11 +38,13 @@ LINE_FORMAT_RULES = [
          ----+
          $
          )""",
+    # The delimiters are single characters, the title text takes any others,
+    # so that long runs of = don't make the match quadratic.
     r"""(?P<Heading>
          ^
-         =+\s*    # Matches the leading delimiter
+         =        # Matches the leading delimiter
          .*       # Matches the heading title text
-         \s*=+\s* # Matches the trailing delimiter
+         =\s*     # Matches the trailing delimiter
          $
         )""",
 ]
@@ -97,6 +99,27 @@ PLUGIN_PARAM_RE = re.compile(PLUGIN_PARAM, re.UNICODE)
 PLUGIN_RE = re.compile(PLUGIN, re.UNICODE)
 PLUGIN_END_RE = re.compile(PLUGIN_END, re.UNICODE)
 
+# The text rules that start with an opening delimiter and may scan the rest of
+# the line for a closing one, see TEXT_FORMAT_SCAN_RE.
+INLINE_CODE2_RULE = r"\{\{\{(?P<InlineCode2>.+?)\}\}\}"
+URL_BRACKET_RULE = r"""# Matches bracketed URLs: [http://foo.bar An optional description]
+        (?P<UrlBracket>
+         \[
+          (?:{0}://|(mailto:)) # Matches supported URL schemas
+          [^]\s]+              # Matches up to the closing bracket or whitespace
+          {1}                  # Matches the optional URL description
+         \]
+        )""".format(URL_SCHEMA_RULE, OPTIONAL_DESC_RULE)
+WIKIWORD_BRACKET_RULE = r"""# Matches a forced/named WikiLink: [WikiWord an optional description]
+        (?P<WikiWordBracket>
+         \[
+          {0}  # Matches the WikiWord
+          {1}  # Matches the optional WikiLink description
+         \]
+        )""".format(WIKIWORD_RULE, OPTIONAL_DESC_RULE)
+PLUGIN_RULE = r"(?P<Plugin>{0})".format(PLUGIN)
+PLUGIN_END_RULE = r"(?P<PluginEnd>{0})".format(PLUGIN_END)
+
 TEXT_FORMAT_RULES = [
     SIMPLE_FORMAT_RULE.format("Bold", r"\*"),
     SIMPLE_FORMAT_RULE.format("Italic", "_"),
@@ -104,7 +127,7 @@ TEXT_FORMAT_RULES = [
     r"\^(?P<Superscript>.+?)\^",
     r",,(?P<Subscript>.+?),,",
     r"`(?P<InlineCode>.+?)`",
-    r"\{\{\{(?P<InlineCode2>.+?)\}\}\}",
+    INLINE_CODE2_RULE,
     r"""# Matches an entire table cell
         (?P<TableCell>
          (?:\|\|)+      # Any number of start markers, to support rowspan
@@ -120,14 +143,7 @@ TEXT_FORMAT_RULES = [
          [^\s'\"<.,}})\]]+      # After that, match all the way up to the first
                                 # character that looks like a terminator.
         )""".format(URL_SCHEMA_RULE),
-    r"""# Matches bracketed URLs: [http://foo.bar An optional description]
-        (?P<UrlBracket>
-         \[
-          (?:{0}://|(mailto:)) # Matches supported URL schemas
-          [^]\s]+              # Matches up to the closing bracket or whitespace
-          {1}                  # Matches the optional URL description
-         \]
-        )""".format(URL_SCHEMA_RULE, OPTIONAL_DESC_RULE),
+    URL_BRACKET_RULE,
     r"""# Matches a WikiWord embedded in the text.
         (?:
          (?<![A-Za-z0-9\[])  # Matches the WikiWord only if it's not preceded
@@ -145,13 +161,7 @@ TEXT_FORMAT_RULES = [
          (?![A-Za-z0-9]) # Matches the WikiWord only if it's not followed
                          # by alphanumeric characters.
         )""".format(WIKIWORD_AUTOLINK_RULE),
-    r"""# Matches a forced/named WikiLink: [WikiWord an optional description]
-        (?P<WikiWordBracket>
-         \[
-          {0}  # Matches the WikiWord
-          {1}  # Matches the optional WikiLink description
-         \]
-        )""".format(WIKIWORD_RULE, OPTIONAL_DESC_RULE),
+    WIKIWORD_BRACKET_RULE,
     r"""# Matches an issue reference.
         (?P<IssueLink>
         (
@@ -168,13 +178,36 @@ TEXT_FORMAT_RULES = [
         \d+\b
         )
         """,
-    r"(?P<Plugin>{0})".format(PLUGIN),
-    r"(?P<PluginEnd>{0})".format(PLUGIN_END),
+    PLUGIN_RULE,
+    PLUGIN_END_RULE,
     r"""# Matches a variable being used, defined in a plugin or globally.
         %%(?P<Variable>[\w|_|\-]+)%%"""
 ]
 TEXT_FORMAT_RE = re.compile("(?x)" + "|".join(TEXT_FORMAT_RULES), re.UNICODE)
 
+# The delimited rules are retried at every opening delimiter, each time
+# scanning the rest of the line for a closing one, which is quadratic. The
+# tokenizer matches them itself instead; this regex matches all the other
+# rules, and the opening delimiters of the delimited ones as Opener.
+DELIMITED_TEXT_FORMAT_RULES = [INLINE_CODE2_RULE, URL_BRACKET_RULE,
+                               WIKIWORD_BRACKET_RULE, PLUGIN_RULE,
+                               PLUGIN_END_RULE]
+TEXT_FORMAT_SCAN_RE = re.compile(
+    "(?x)" + "|".join(
+        [rule for rule in TEXT_FORMAT_RULES
+         if rule not in DELIMITED_TEXT_FORMAT_RULES] +
+        [r"(?P<Opener>\{\{\{|\[|<)"]),
+    re.UNICODE)
+
+# Plain lines: a line matches no line or text formatting rule if it doesn't
+# start with whitespace or a line rule character, and contains none of the
+# characters or patterns that every text rule needs. The digits are needed
+# by issue and revision links, the capitalized words by WikiWords.
+INDENT_CHARS = " \t\n\r\f\v"  # What INDENT_RE matches, it's not Unicode.
+LINE_FORMAT_START_CHARS = "=-"
+TEXT_FORMAT_PRESCAN_RE = re.compile(
+    r"[*_~^,`{}|:\[<%]|\d|[A-Z][a-z0-9]+_*[A-Z]", re.UNICODE)
+
 # For verification of YouTube video IDs.
 YOUTUBE_VIDEO_ID_RE = re.compile("^[a-zA-Z0-9_-]+$")
 
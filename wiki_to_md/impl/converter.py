@@ -15,6 +15,55 @@
 import urlparse
 
 from . import constants
+from . import output_builder as output_builder_mod
+from . import page_index as page_index_mod
+from . import tokenizer
+
+
+class _LineReader(object):
+  """Reads the lines of an input stream one at a time.
+
+  A single line of lookahead lets the conversion phases stop before the
+  first line they don't handle, without reading the whole stream.
+  """
+
+  def __init__(self, input_stream):
+    """Create a line reader.
+
+    Args:
+        input_stream: Input Wiki file, or any iterable of lines.
+    """
+    self._lines = iter(input_stream)
+    self._next_line = None
+
+  def HasNext(self):
+    """Returns True if there is a line left to read."""
+    if self._next_line is None:
+      self._next_line = next(self._lines, None)
+    return self._next_line is not None
+
+  def Peek(self):
+    """Returns the next line without consuming it, there must be one."""
+    self.HasNext()
+    return self._next_line
+
+  def Next(self):
+    """Returns the next line and consumes it, there must be one."""
+    line = self.Peek()
+    self._next_line = None
+    return line
+
+  def CountRemaining(self):
+    """Consumes the lines left and returns how many there were."""
+    remaining = 0
+    while self.HasNext():
+      self.Next()
+      remaining += 1
+    return remaining
+
+  def __iter__(self):
+    while self.HasNext():
+      yield self.Next()
 
 
 class Converter(object):
@@ -80,6 +129,9 @@ class Converter(object):
   _VIDEO_DEFAULT_WIDTH = "425"
   _VIDEO_DEFAULT_HEIGHT = "344"
 
+  # Tags opened and closed by formatting characters.
+  _TAGS = ["Bold", "Italic", "Strikethrough"]
+
   def __init__(
       self,
       pragma_handler,
@@ -94,10 +146,18 @@ class Converter(object):
         formatting_handler: Handler for parsed formatting rules.
         warning_method: A function to call to display a warning message.
         project: The name of the Google Code project for the Wiki page.
-        wikipages: Wiki pages assumed to exist for auto-linking.
+        wikipages: Wiki pages assumed to exist for auto-linking, as a
+            PageIndex or a list of page names.
     """
+    if not isinstance(wikipages, page_index_mod.PageIndex):
+      wikipages = page_index_mod.PageIndex(wikipages)
     self._pragma_handler = pragma_handler
     self._formatting_handler = formatting_handler
+    # The open and close handlers of each tag, looked up once.
+    self._tag_handlers = dict(
+        (tag, (getattr(formatting_handler, "Handle{0}Open".format(tag)),
+               getattr(formatting_handler, "Handle{0}Close".format(tag))))
+        for tag in self._TAGS)
     self._warning_method = warning_method
     self._wikipages = wikipages
     self._project = project
@@ -109,9 +169,11 @@ class Converter(object):
         input_stream: Input Wiki file.
         output_stream: Output Markdown file.
     """
-    # For simpler processing just load the entire file into memory.
-    input_lines = input_stream.readlines()
+    # The input is streamed, only code blocks are kept in memory. The output
+    # fragments are written in blocks.
+    input_lines = _LineReader(input_stream)
     input_line = 1
+    output_stream = output_builder_mod.OutputBuilder(output_stream)
 
     # First extract pragmas, which must be placed at the top of the file.
     input_line = self._ExtractPragmas(input_line, input_lines, output_stream)
@@ -121,9 +183,10 @@ class Converter(object):
 
     # At the main text, begin processing.
     input_line = self._ProcessBody(input_line, input_lines, output_stream)
+    output_stream.Flush()
 
     # Done, but sanity check the amount of input processed.
-    remaining_lines = len(input_lines) - input_line + 1
+    remaining_lines = input_lines.CountRemaining()
     if remaining_lines != 0:
       self._warning_method(
           input_line,
@@ -135,16 +198,17 @@ class Converter(object):
 
     Args:
         input_line: Current line number being processed.
-        input_lines: Input Wiki file lines.
+        input_lines: The _LineReader of the input Wiki file.
         output_stream: Output Markdown file.
     Returns:
         The new value of input_line after processing.
     """
-    for line in input_lines[input_line - 1:]:
-      pragma_match = constants.PRAGMA_RE.match(line)
+    while input_lines.HasNext():
+      pragma_match = constants.PRAGMA_RE.match(input_lines.Peek())
       if not pragma_match:
         # Found all the pragmas.
         break
+      input_lines.Next()
 
       # Found a pragma, strip it and pass it to the handler.
       pragma_type, pragma_value = pragma_match.groups()
@@ -165,14 +229,15 @@ class Converter(object):
 
     Args:
         input_line: Current line number being processed.
-        input_lines: Input Wiki file lines.
+        input_lines: The _LineReader of the input Wiki file.
     Returns:
         The new value of input_line after processing.
     """
-    for line in input_lines[input_line - 1:]:
-      if line.strip():
+    while input_lines.HasNext():
+      if input_lines.Peek().strip():
         # Skipped all the whitespace.
         break
+      input_lines.Next()
 
       # Moving on to the next line.
       input_line += 1
@@ -188,8 +253,8 @@ class Converter(object):
 
     Args:
         input_line: Current line number being processed.
-        input_lines: Input Wiki file lines.
-        output_stream: Output Markdown file.
+        input_lines: The _LineReader of the input Wiki file.
+        output_stream: The OutputBuilder of the output Markdown file.
     Returns:
         The new value of input_line after processing.
     """
@@ -198,12 +263,12 @@ class Converter(object):
     self._code_block_lines = []  # What lines we've collected for a code block.
     self._indents = []  # 2-tuple of indent position and list type.
     self._open_tags = []  # List of open tags, like bold or italic.
-    self._table_columns = []  # Table column sizes, taken from the header row.
+    self._table_columns = 0  # Number of table columns, from the header row.
     self._table_column = 0  # Current column in the table body, or zero if none.
     self._plugin_stack = []  # Current stack of plugins and their parameters.
 
     first_line = True
-    for line in input_lines[input_line - 1:]:
+    for line in input_lines:
       stripped_line = line.strip()
 
       self._ProcessLine(
@@ -212,6 +277,7 @@ class Converter(object):
           line,
           stripped_line,
           output_stream)
+      output_stream.EndBlock()
 
       # Moving on to the next line.
       input_line += 1
@@ -243,6 +309,20 @@ class Converter(object):
     Returns:
         The new value of input_line after processing.
     """
+    # Most lines are plain text, skip the rules for them.
+    if self._IsPlainLine(line, stripped_line):
+      if not first_line:
+        self._formatting_handler.HandleEscapedText(
+            input_line,
+            output_stream,
+            "\n")
+      self._formatting_handler.HandleEscapedText(
+          input_line,
+          output_stream,
+          stripped_line)
+      self._CloseTableRow(input_line, output_stream)
+      return
+
     # Check for the start of a code block.
     if constants.START_CODEBLOCK_RE.match(stripped_line):
       if self._code_block_depth == 0:
@@ -289,7 +369,7 @@ class Converter(object):
 
         if self._table_columns:
           self._formatting_handler.HandleTableClose(input_line, output_stream)
-        self._table_columns = []
+        self._table_columns = 0
         self._table_column = 0
 
       self._formatting_handler.HandleParagraphBreak(input_line, output_stream)
@@ -346,6 +426,25 @@ class Converter(object):
 
     self._CloseTableRow(input_line, output_stream)
 
+  def _IsPlainLine(self, line, stripped_line):
+    """Check if a line is plain text, outside of any code block.
+
+    The output of a plain line is its escaped text, the same as if it went
+    through all the rules of _ProcessLine without matching any.
+
+    Args:
+      line: The raw line string.
+      stripped_line: The line string, stripped of surrounding whitespace.
+    Returns:
+      True if the line is plain text, false otherwise.
+    """
+    return (stripped_line and
+            not self._code_block_depth and
+            not self._ConsumeTextForPlugin() and
+            line[0] not in constants.INDENT_CHARS and
+            stripped_line[0] not in constants.LINE_FORMAT_START_CHARS and
+            not constants.TEXT_FORMAT_PRESCAN_RE.search(stripped_line))
+
   def _SetCurrentList(self, input_line, indent_pos, list_type, output_stream):
     """Set the current list level based on the indentation.
 
@@ -409,8 +508,7 @@ class Converter(object):
       tag: Tag to open.
       output_stream: Output Markdown file.
     """
-    handler = getattr(
-        self._formatting_handler, u"Handle{0}Open".format(tag), None)
+    handler = self._tag_handlers.get(tag, (None, None))[0]
     if handler:
       handler(input_line, output_stream)
     else:
@@ -426,8 +524,7 @@ class Converter(object):
       tag: Tag to close.
       output_stream: Output Markdown file.
     """
-    handler = getattr(
-        self._formatting_handler, u"Handle{0}Close".format(tag), None)
+    handler = self._tag_handlers.get(tag, (None, None))[1]
     if handler:
       handler(input_line, output_stream)
     else:
@@ -458,10 +555,7 @@ class Converter(object):
 
       # Check if we just finished the header row.
       if not self._table_column:
-        self._formatting_handler.HandleTableHeader(
-            input_line,
-            output_stream,
-            self._table_columns)
+        self._formatting_handler.HandleTableHeader(input_line, output_stream)
 
       # In a table body, set the current column to 1.
       self._table_column = 1
@@ -485,10 +579,10 @@ class Converter(object):
       output_stream: Output Markdown file.
     """
     lastpos = 0
-    for fullmatch in match_regex.finditer(line):
+    for start, end, rulename, match in tokenizer.Tokenize(match_regex, line):
       # Add text before the match as regular text.
-      if lastpos < fullmatch.start():
-        starting_line = line[lastpos:fullmatch.start()]
+      if lastpos < start:
+        starting_line = line[lastpos:start]
         if self._ConsumeTextForPlugin():
           self._formatting_handler.HandleText(
               input_line,
@@ -500,18 +594,15 @@ class Converter(object):
               output_stream,
               starting_line)
 
-      for rulename, match in fullmatch.groupdict().items():
-        if match is not None:
-          if self._ConsumeTextForPlugin() and rulename != "PluginEnd":
-            self._formatting_handler.HandleText(
-                input_line,
-                output_stream,
-                match)
-          else:
-            handler = getattr(self, u"_Handle{0}".format(rulename), None)
-            handler(input_line, match, output_stream)
+      if self._ConsumeTextForPlugin() and rulename != "PluginEnd":
+        self._formatting_handler.HandleText(
+            input_line,
+            output_stream,
+            match)
+      else:
+        self._RULE_HANDLERS[rulename](self, input_line, match, output_stream)
 
-      lastpos = fullmatch.end()
+      lastpos = end
 
     # Add remainder of the line as regular text.
     if lastpos < len(line):
@@ -682,59 +773,25 @@ class Converter(object):
 
     span = pipecount / 2
 
-    # Now output the cell, tracking the size of the contents.
+    # Now output the cell. The header row is column zero.
     self._formatting_handler.HandleTableCellBorder(input_line, output_stream)
-
-    starting_pos = output_stream.tell()
+    self._formatting_handler.HandleTableCellOpen(
+        input_line,
+        output_stream,
+        self._table_column,
+        span)
     self._ProcessMatch(
         input_line,
         constants.TEXT_FORMAT_RE,
         match[pipecount:],
         output_stream)
-    ending_pos = output_stream.tell()
+    self._formatting_handler.HandleTableCellClose(input_line, output_stream)
 
-    # Handle the cell width, either tracking or padding.
-    cell_width = ending_pos - starting_pos
     if not self._table_column:
-      # In the header row, track the column sizes.
-      self._table_columns.append(cell_width)
+      self._table_columns += span
     else:
-      # In the table body, pad the cell (for prettier raw text viewing).
-      colIdx = self._table_column - 1
-      if colIdx >= len(self._table_columns):
-        colIdx = len(self._table_columns) - 1
-
-      header_cell_width = self._table_columns[colIdx]
-      remaining_width = header_cell_width - cell_width
-      if remaining_width > 0:
-        padding = " " * remaining_width
-        self._formatting_handler.HandleEscapedText(
-            input_line,
-            output_stream,
-            padding)
-
       self._table_column += 1
 
-    if span > 1:
-      self._warning_method(
-          input_line,
-          "Multi-span cells are not directly supported in GFM. They have been "
-          "emulated by adding empty cells. This may give the correct rendered "
-          "result, but the plain-text representation may be noisy. Consider "
-          "removing the multi-span cells from your table, or using HTML.")
-      while span > 1:
-        # Empty cell.
-        self._formatting_handler.HandleTableCellBorder(
-            input_line,
-            output_stream)
-        self._formatting_handler.HandleEscapedText(
-            input_line,
-            output_stream,
-            " ")
-        self._table_columns.append(1)
-
-        span -= 1
-
   def _HandleTableRowEnd(self, input_line, unused_match, output_stream):
     """Handle a table row ending.
 
@@ -1282,3 +1339,27 @@ class Converter(object):
       self._OpenTag(input_line, tag, output_stream)
     else:
       self._CloseTag(input_line, tag, output_stream)
+
+  # The handler of each formatting rule, by the name of its regex group.
+  _RULE_HANDLERS = {
+      "HRule": _HandleHRule,
+      "Heading": _HandleHeading,
+      "Bold": _HandleBold,
+      "Italic": _HandleItalic,
+      "Strikethrough": _HandleStrikethrough,
+      "Superscript": _HandleSuperscript,
+      "Subscript": _HandleSubscript,
+      "InlineCode": _HandleInlineCode,
+      "InlineCode2": _HandleInlineCode2,
+      "TableCell": _HandleTableCell,
+      "TableRowEnd": _HandleTableRowEnd,
+      "Url": _HandleUrl,
+      "UrlBracket": _HandleUrlBracket,
+      "WikiWord": _HandleWikiWord,
+      "WikiWordBracket": _HandleWikiWordBracket,
+      "IssueLink": _HandleIssueLink,
+      "RevisionLink": _HandleRevisionLink,
+      "Plugin": _HandlePlugin,
+      "PluginEnd": _HandlePluginEnd,
+      "Variable": _HandleVariable,
+  }
@@ -0,0 +1,115 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Handles the document tree a Wiki page is parsed into."""
+import collections
+
+
+# A node of a document. The kind is the formatting, named as the Handle
+# methods of FormattingHandler without the prefix, e.g. "HeaderOpen" or
+# "EscapedText", and args are the arguments of that method after the output
+# stream. Only table cells have children, the nodes of their contents;
+# otherwise children is None.
+Node = collections.namedtuple(
+    "Node", ["kind", "input_line", "args", "children"])
+
+
+class Document(object):
+  """The formatting of a Wiki page, as parsed by a Converter.
+
+  Wiki formatting need not nest, e.g. bold text can span list items, so the
+  opening and the closing of formatting are nodes of their own, in the
+  order they are met. The renderers walk the nodes to output each format.
+
+  Documents only hold tuples, lists and strings, so they can be pickled to
+  be cached.
+  """
+
+  def __init__(self, nodes=None):
+    """Create a document.
+
+    Args:
+        nodes: The nodes of the document, in reading order.
+    """
+    self.nodes = nodes if nodes is not None else []
+
+  def __eq__(self, other):
+    return isinstance(other, Document) and self.nodes == other.nodes
+
+  def __ne__(self, other):
+    return not self == other
+
+
+class DocumentBuilder(object):
+  """Builds a Document, in place of the FormattingHandler of a Converter.
+
+  Every Handle method call of the Converter is recorded as a node rather
+  than output, so the output streams it is given are ignored.
+  """
+
+  def __init__(self):
+    """Create a document builder."""
+    self.Reset()
+
+  def Reset(self):
+    """Start building another document."""
+    self._document = Document()
+    self._containers = [self._document.nodes]  # The nodes being added to.
+
+  def GetDocument(self):
+    """Get the document built so far.
+
+    Returns:
+        The Document.
+    """
+    return self._document
+
+  def HandleTableCellOpen(self, input_line, unused_output_stream, column,
+                          span):
+    """Start the contents of a table cell.
+
+    Args:
+        input_line: Current line number being processed.
+        unused_output_stream: Output Markdown file.
+        column: The column of the cell in the table body, from 1, or 0 in
+            the header row.
+        span: The number of columns the cell spans.
+    """
+    node = Node("TableCell", input_line, (column, span), [])
+    self._containers[-1].append(node)
+    self._containers.append(node.children)
+
+  def HandleTableCellClose(self, unused_input_line, unused_output_stream):
+    """End the contents of a table cell.
+
+    Args:
+        unused_input_line: Current line number being processed.
+        unused_output_stream: Output Markdown file.
+    """
+    self._containers.pop()
+
+  def __getattr__(self, name):
+    """Get a method recording the calls of a Handle method as nodes.
+
+    Args:
+        name: The name of the method.
+    Returns:
+        The method, which takes the arguments of the Handle method.
+    """
+    if not name.startswith("Handle"):
+      raise AttributeError(name)
+    kind = name[len("Handle"):]
+
+    def Record(input_line, unused_output_stream, *args):
+      self._containers[-1].append(Node(kind, input_line, args, None))
+    return Record
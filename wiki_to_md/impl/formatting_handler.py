@@ -14,7 +14,8 @@
 """Handles converting of formatting."""
 import cgi
 
-from . import constants
+from . import output_builder as output_builder_mod
+from . import tokenizer
 
 
 class FormattingHandler(object):
@@ -82,7 +83,10 @@ class FormattingHandler(object):
     self._project = project
     self._issue_map = issue_map
     self._symmetric_headers = symmetric_headers
+    self.Reset()
 
+  def Reset(self):
+    """Reset the conversion state, to start converting another page."""
     # GFM has a quirk with nested blockquotes where a blank line is needed
     # after closing a nested blockquote while continuing into another.
     self._last_blockquote_indent = 0
@@ -92,6 +96,7 @@ class FormattingHandler(object):
     # of text to be outputted, and when the tag is closed we can trim the
     # buffer before applying formatting. If the trimmed buffer is empty, we
     # can omit the formatting altogether to avoid GFM rendering issues.
+    # Each buffer is a list of the fragments written to it.
     self._format_buffer = []
 
     # GitHub won't render formatting within HTML tags. Track if this is the
@@ -102,6 +107,12 @@ class FormattingHandler(object):
     self._list_tags = []  # If writing HTML for lists, the current list tags.
     self._table_status = None  # Where we are in outputting an HTML table.
 
+    # The contents of table cells are collected apart, to measure their width
+    # in characters. The cells of the table body are padded to the width of
+    # the header cell of their column (for prettier raw text viewing).
+    self._table_columns = []  # Column widths, taken from the header row.
+    self._table_cell = None  # The OutputBuilder, column and span of a cell.
+
     # GitHub doesn't support HTML comments, so as a workaround we give
     # a bogus and empty <a> tag, which renders as nothing.
     self._in_comment = False
@@ -285,7 +296,7 @@ class FormattingHandler(object):
       self._PrintHtmlWarning(input_line, "Bold")
 
     # Open up another buffer.
-    self._format_buffer.append("")
+    self._format_buffer.append([])
 
   def HandleBoldClose(self, input_line, output_stream):
     """Handle the output for ending bold formatting.
@@ -307,7 +318,7 @@ class FormattingHandler(object):
       self._PrintHtmlWarning(input_line, "Italic")
 
     # Open up another buffer.
-    self._format_buffer.append("")
+    self._format_buffer.append([])
 
   def HandleItalicClose(self, input_line, output_stream):
     """Handle the output for ending italic formatting.
@@ -329,7 +340,7 @@ class FormattingHandler(object):
       self._PrintHtmlWarning(input_line, "Strikethrough")
 
     # Open up another buffer.
-    self._format_buffer.append("")
+    self._format_buffer.append([])
 
   def HandleStrikethroughClose(self, input_line, output_stream):
     """Handle the output for ending strikethrough formatting.
@@ -424,6 +435,60 @@ class FormattingHandler(object):
     else:
       self._Write("|", output_stream)
 
+  def HandleTableCellOpen(self, unused_input_line, unused_output_stream,
+                          column, span):
+    """Handle the output for starting the contents of a table cell.
+
+    Args:
+        unused_input_line: Current line number being processed.
+        unused_output_stream: Output Markdown file.
+        column: The column of the cell in the table body, from 1, or 0 in
+            the header row.
+        span: The number of columns the cell spans.
+    """
+    self._table_cell = (output_builder_mod.OutputBuilder(), column, span)
+
+  def HandleTableCellClose(self, input_line, output_stream):
+    """Handle the output for ending the contents of a table cell.
+
+    Args:
+        input_line: Current line number being processed.
+        output_stream: Output Markdown file.
+    """
+    cell_stream, column, span = self._table_cell
+    self._table_cell = None
+    cell_text = cell_stream.GetValue()
+    output_stream.write(cell_text)
+
+    # Handle the cell width, either tracking or padding.
+    cell_width = len(cell_text)
+    if not column:
+      # In the header row, track the column sizes.
+      self._table_columns.append(cell_width)
+    else:
+      # In the table body, pad the cell.
+      header_cell_width = self._table_columns[
+          min(column, len(self._table_columns)) - 1]
+      remaining_width = header_cell_width - cell_width
+      if remaining_width > 0:
+        self.HandleEscapedText(input_line, output_stream,
+                               " " * remaining_width)
+
+    if span > 1:
+      self._warning_method(
+          input_line,
+          "Multi-span cells are not directly supported in GFM. They have been "
+          "emulated by adding empty cells. This may give the correct rendered "
+          "result, but the plain-text representation may be noisy. Consider "
+          "removing the multi-span cells from your table, or using HTML.")
+      while span > 1:
+        # Empty cell.
+        self.HandleTableCellBorder(input_line, output_stream)
+        self.HandleEscapedText(input_line, output_stream, " ")
+        self._table_columns.append(1)
+
+        span -= 1
+
   def HandleTableRowEnd(self, input_line, output_stream):
     """Handle the output for a table row end.
 
@@ -452,6 +517,7 @@ class FormattingHandler(object):
         input_line: Current line number being processed.
         output_stream: Output Markdown file.
     """
+    self._table_columns = []
     if self._in_html:
       # HandleTableRowEnd will have been called by this point.
       # All we need to do is close the body and table.
@@ -459,20 +525,19 @@ class FormattingHandler(object):
       self.HandleHtmlClose(input_line, output_stream, "table")
       self._table_status = None
 
-  def HandleTableHeader(self, input_line, output_stream, columns):
+  def HandleTableHeader(self, input_line, output_stream):
     """Handle the output for starting a table header.
 
     Args:
         input_line: Current line number being processed.
         output_stream: Output Markdown file.
-        columns: Column sizes.
     """
     if self._in_html:
       return
 
     self.HandleText(input_line, output_stream, "\n")
 
-    for column_width in columns:
+    for column_width in self._table_columns:
       self.HandleTableCellBorder(input_line, output_stream)
 
       # Wiki tables are left-aligned, which takes one character to specify.
@@ -942,8 +1007,7 @@ class FormattingHandler(object):
     """
     if self._format_buffer:
       # End redirection.
-      format_buffer = self._format_buffer[-1]
-      self._format_buffer.pop()
+      format_buffer = "".join(self._format_buffer.pop())
 
       # Don't do anything if we didn't buffer, or it was only whitespace.
       format_buffer = format_buffer.strip()
@@ -983,18 +1047,24 @@ class FormattingHandler(object):
     text = text.replace("_", r"\_")
 
     # If we find a plugin-like bit of text, escape the angle-brackets.
-    for plugin_re in [constants.PLUGIN_RE, constants.PLUGIN_END_RE]:
-      while plugin_re.search(text):
-        match = plugin_re.search(text)
-        before_match = text[:match.start()]
-        after_match = text[match.end():]
-        escaped_match = match.group(0).replace("<", "&lt;").replace(">", "&gt;")
-        text = u"{0}{1}{2}".format(before_match, escaped_match, after_match)
+    if "<" in text:
+      chunks = []
+      lastpos = 0
+      for start, end in tokenizer.FindPlugins(text):
+        chunks.append(text[lastpos:start])
+        chunks.append(text[start:end].replace("<", "&lt;").replace(">", "&gt;"))
+        lastpos = end
+      if chunks:
+        chunks.append(text[lastpos:])
+        text = u"".join(chunks)
 
     # In Markdown, if a newline is preceeded by two spaces it breaks the line.
-    # For Wiki text, this is not the case, so we strip such endings off.
-    while text.endswith("  \n"):
-      text = text[:-len("  \n")] + "\n"
+    # For Wiki text, this is not the case, so we strip such endings off, two
+    # spaces at a time.
+    if text.endswith("  \n"):
+      line = text[:-len("\n")]
+      stripped_line = line.rstrip(" ")
+      text = stripped_line + " " * ((len(line) - len(stripped_line)) % 2) + "\n"
 
     return text
 
@@ -1038,7 +1108,10 @@ class FormattingHandler(object):
 
     if self._format_buffer:
       # Buffering is occuring, add to buffer.
-      self._format_buffer[-1] += text
+      self._format_buffer[-1].append(text)
+    elif self._table_cell:
+      # In a table cell, add to its contents.
+      self._table_cell[0].write(text)
     else:
       # No buffering occuring, just output it.
       output_stream.write(text)
@@ -0,0 +1,68 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Handles collecting the output of the conversion."""
+
+
+# How many fragments are collected before they are written to the stream.
+DEFAULT_BLOCK_SIZE = 4096
+
+
+class OutputBuilder(object):
+  """Collects the fragments of the output and writes them in blocks.
+
+  The conversion outputs many small fragments. Writing each one to a codecs
+  stream encodes them one at a time, and appending them to a string copies
+  the string every time. Instead, the fragments are kept in a list and
+  joined once per block, which is written, and so encoded, in bulk.
+
+  It can be used as the output stream of the handlers, which only write to
+  it.
+  """
+
+  def __init__(self, stream=None, block_size=DEFAULT_BLOCK_SIZE):
+    """Create an output builder.
+
+    Args:
+        stream: The stream to write the blocks to, or None to keep all the
+            output until GetValue is called.
+        block_size: How many fragments make a block, see EndBlock.
+    """
+    self._stream = stream
+    self._block_size = block_size
+    self._chunks = []
+
+    # Adding a fragment of output is by far the most frequent call, so it
+    # only appends to the list.
+    self.write = self._chunks.append  # pylint: disable=invalid-name
+
+  def EndBlock(self):
+    """Write the fragments collected so far if they make a whole block."""
+    if len(self._chunks) >= self._block_size:
+      self.Flush()
+
+  def Flush(self):
+    """Write the fragments collected so far to the stream, as one block."""
+    if self._stream is not None and self._chunks:
+      self._stream.write(self.GetValue())
+      del self._chunks[:]
+
+  def GetValue(self):
+    """Get the fragments collected so far.
+
+    Returns:
+        The fragments, joined.
+    """
+    if len(self._chunks) > 1:
+      self._chunks[:] = ["".join(self._chunks)]
+    return self._chunks[0] if self._chunks else ""
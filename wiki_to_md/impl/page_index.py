@@ -0,0 +1,107 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Handles the index of the wiki pages assumed to exist."""
+import codecs
+import os
+
+
+WIKI_EXTENSION = ".wiki"
+
+
+class PageIndex(object):
+  """The set of wiki pages assumed to exist, for auto-linking.
+
+  Lookups take constant time however many pages there are. Membership tests
+  are exact; Find also accepts a link anchor, as in "Page#Section", and
+  ignores case.
+  """
+
+  def __init__(self, pages=()):
+    """Create a page index.
+
+    Args:
+        pages: The names of the pages to start with.
+    """
+    self._pages = set()
+    self._folded_pages = {}  # Lower-cased name to the first page added.
+    for page in pages:
+      self.Add(page)
+
+  @staticmethod
+  def Load(path):
+    """Load a page index saved with Save.
+
+    Args:
+        path: The path of the index file.
+    Returns:
+        The PageIndex.
+    """
+    with codecs.open(path, "r", "utf-8") as index_file:
+      return PageIndex(line.rstrip("\n") for line in index_file
+                       if line.rstrip("\n"))
+
+  def Save(self, path):
+    """Save the page index, one page per line.
+
+    Args:
+        path: The path of the index file.
+    """
+    with codecs.open(path, "w", "utf-8") as index_file:
+      for page in sorted(self._pages):
+        index_file.write(page + "\n")
+
+  def Add(self, page):
+    """Add a page.
+
+    Args:
+        page: The name of the page.
+    """
+    self._pages.add(page)
+    self._folded_pages.setdefault(page.lower(), page)
+
+  def AddDirectory(self, path):
+    """Add all the .wiki files in a directory.
+
+    Args:
+        path: The path of the directory.
+    """
+    for filename in os.listdir(path):
+      if isinstance(filename, str):
+        # Page names are matched against the decoded wiki text.
+        filename = filename.decode("utf-8")
+      if filename.endswith(WIKI_EXTENSION):
+        self.Add(filename[:-len(WIKI_EXTENSION)])
+
+  def Find(self, target):
+    """Find the page a link target points to, ignoring case.
+
+    Args:
+        target: The link target, a page name with an optional anchor.
+    Returns:
+        The name of the page as added, or None if there is no such page.
+        An exact match is preferred over a case-insensitive one.
+    """
+    page = target.split("#", 1)[0]
+    if page in self._pages:
+      return page
+    return self._folded_pages.get(page.lower())
+
+  def __contains__(self, page):
+    return page in self._pages
+
+  def __iter__(self):
+    return iter(self._pages)
+
+  def __len__(self):
+    return len(self._pages)
@@ -0,0 +1,561 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Handles rendering parsed documents to the output formats."""
+import cgi
+import re
+
+from . import output_builder as output_builder_mod
+
+
+# The URL schemes links and images may use in HTML, URLs without a scheme
+# are relative.
+SAFE_URL_SCHEMES = frozenset(["http", "https", "ftp", "mailto"])
+
+# The scheme of a URL: the text before the first colon, if it is not in the
+# path, query or fragment. Browsers ignore control characters and spaces.
+_URL_SCHEME_RE = re.compile(r"^([^/?#]*?):", re.UNICODE)
+_URL_IGNORED_RE = re.compile(r"[\x00-\x20\x7f]+", re.UNICODE)
+
+
+def IsSafeUrl(url):
+  """Check a URL can be used in HTML without running scripts.
+
+  Args:
+      url: The URL, not escaped.
+  Returns:
+      True if the URL is relative or uses one of SAFE_URL_SCHEMES.
+  """
+  scheme_match = _URL_SCHEME_RE.match(_URL_IGNORED_RE.sub(u"", url))
+  return not scheme_match or scheme_match.group(1).lower() in SAFE_URL_SCHEMES
+
+
+class GfmRenderer(object):
+  """Renders a document to GitHub-flavored Markdown.
+
+  The nodes are handed to a FormattingHandler, as the Converter would have,
+  so the output is the same as converting the page directly.
+  """
+
+  def __init__(self, formatting_handler):
+    """Create a GFM renderer.
+
+    Args:
+        formatting_handler: The FormattingHandler to output with. It should
+            be reset for each document.
+    """
+    self._formatting_handler = formatting_handler
+
+  def Render(self, document, output_stream):
+    """Render a document.
+
+    Args:
+        document: The Document to render.
+        output_stream: Output Markdown file.
+    """
+    output_stream = output_builder_mod.OutputBuilder(output_stream)
+    for node in document.nodes:
+      self._RenderNode(node, output_stream)
+      output_stream.EndBlock()
+    output_stream.Flush()
+
+  def _RenderNode(self, node, output_stream):
+    """Render a node and its children.
+
+    Args:
+        node: The Node to render.
+        output_stream: Output Markdown file.
+    """
+    if node.children is None:
+      handler = getattr(self._formatting_handler, "Handle" + node.kind)
+      handler(node.input_line, output_stream, *node.args)
+      return
+
+    self._formatting_handler.HandleTableCellOpen(
+        node.input_line, output_stream, *node.args)
+    for child in node.children:
+      self._RenderNode(child, output_stream)
+    self._formatting_handler.HandleTableCellClose(
+        node.input_line, output_stream)
+
+
+class _Renderer(object):
+  """Base class of the renderers of other formats than GFM.
+
+  Each kind of node is rendered by the method of _NODE_HANDLERS, the nodes
+  without one output nothing.
+  """
+
+  # Render methods, by kind of node. Defined by each renderer.
+  _NODE_HANDLERS = {}
+
+  def Render(self, document, output_stream):
+    """Render a document.
+
+    Args:
+        document: The Document to render.
+        output_stream: The output file.
+    """
+    self._output = output_builder_mod.OutputBuilder(output_stream)
+    self._Start()
+    self._RenderNodes(document.nodes)
+    self._Finish()
+    self._output.Flush()
+    self._output = None
+
+  def _Start(self):
+    """Reset the rendering state, to start rendering a document."""
+    pass
+
+  def _Finish(self):
+    """Output the end of the document."""
+    pass
+
+  def _RenderNodes(self, nodes):
+    """Render nodes in order.
+
+    Args:
+        nodes: The Nodes to render.
+    """
+    for node in nodes:
+      handler = self._NODE_HANDLERS.get(node.kind)
+      if handler:
+        handler(self, node)
+
+
+class HtmlRenderer(_Renderer):
+  """Renders a document to an HTML fragment, e.g. for previews."""
+
+  # The HTML tags of the list kinds, and whether their lines are list items.
+  _LIST_TAGS = {
+      "NumericListOpen": ("ol", True),
+      "BulletListOpen": ("ul", True),
+      "BlockQuoteOpen": ("blockquote", False),
+  }
+
+  # The HTML tags of the formatting spans.
+  _FORMAT_TAGS = {
+      "Bold": "strong",
+      "Italic": "em",
+      "Strikethrough": "del",
+  }
+
+  # The HTML attributes holding URLs, dropped unless the URL is safe.
+  _URL_ATTRIBUTES = frozenset(["href", "src"])
+
+  # Links with these extensions link to images.
+  _IMAGE_URL_SCHEMAS = ("http://", "https://", "ftp://")
+  _IMAGE_EXTENSIONS = (".png", ".gif", ".jpg", ".jpeg", ".svg")
+
+  def __init__(self, project, wiki_extension=".html"):
+    """Create an HTML renderer.
+
+    Args:
+        project: The name of the Google Code project for the Wiki page, to
+            link issues and revisions to, or None.
+        wiki_extension: The extension of the pages wiki links point to.
+    """
+    self._project = project
+    self._wiki_extension = wiki_extension
+    self._output = None
+
+  def _Start(self):
+    """Reset the rendering state, to start rendering a document."""
+    self._lists = []  # The tag of each open list, and if an item is open.
+    self._open_formats = []  # The kinds of the open formatting spans.
+    self._table_status = None  # None, "header" or "body".
+    self._in_table_row = False
+    self._in_comment = False
+    self._last_kind = None  # The kind of the last node rendered.
+
+  def _Finish(self):
+    """Close everything left open."""
+    while self._open_formats:
+      self._Write(u"</{0}>".format(
+          self._FORMAT_TAGS[self._open_formats.pop()]))
+    self._CloseTable()
+    while self._lists:
+      self._CloseList()
+
+  def _RenderNodes(self, nodes):
+    """Render nodes in order.
+
+    Args:
+        nodes: The Nodes to render.
+    """
+    for node in nodes:
+      handler = self._NODE_HANDLERS.get(node.kind)
+      if handler:
+        handler(self, node)
+      self._last_kind = node.kind
+
+  def _Write(self, html):
+    """Write HTML, unless in a comment.
+
+    Args:
+        html: The HTML to write.
+    """
+    if not self._in_comment:
+      self._output.write(html)
+
+  def _WriteLink(self, target, description):
+    """Write a link, or an image.
+
+    Images without a description are inlined, image descriptions are
+    inlined in the link. Links to unsafe URLs only output their text.
+
+    Args:
+        target: The target URL of the link.
+        description: The description for the target, or None.
+    """
+    if not IsSafeUrl(target):
+      self._Write(cgi.escape(description or target))
+      return
+
+    target = cgi.escape(target, True)
+    if target.endswith(self._IMAGE_EXTENSIONS) and not description:
+      self._Write(u"<img src=\"{0}\" />".format(target))
+      return
+
+    if (description and description.startswith(self._IMAGE_URL_SCHEMAS) and
+        description.endswith(self._IMAGE_EXTENSIONS)):
+      content = u"<img src=\"{0}\" />".format(cgi.escape(description, True))
+    else:
+      content = cgi.escape(description or target)
+    self._Write(u"<a href=\"{0}\">{1}</a>".format(target, content))
+
+  def _OpenListItem(self, tag, has_items, level):
+    """Open the item of a list, opening the list if needed.
+
+    Args:
+        tag: The HTML tag of the list.
+        has_items: True if the lines of the list are items.
+        level: The nesting level of the list, from 1.
+    """
+    while len(self._lists) > level:
+      self._CloseList()
+    if len(self._lists) == level and self._lists[-1][0] != tag:
+      self._CloseList()
+    while len(self._lists) < level:
+      self._Write(u"<{0}>".format(tag))
+      self._lists.append([tag, False])
+
+    if has_items:
+      if self._lists[-1][1]:
+        self._Write(u"</li>")
+      self._Write(u"<li>")
+      self._lists[-1][1] = True
+
+  def _CloseList(self):
+    """Close the innermost list."""
+    tag, item_open = self._lists.pop()
+    if item_open:
+      self._Write(u"</li>")
+    self._Write(u"</{0}>".format(tag))
+
+  def _CloseTable(self):
+    """Close the table, if any."""
+    if self._in_table_row:
+      self._Write(u"</tr>")
+      self._in_table_row = False
+    if self._table_status == "header":
+      self._Write(u"</thead></table>")
+    elif self._table_status == "body":
+      self._Write(u"</tbody></table>")
+    self._table_status = None
+
+  def _RenderText(self, node):
+    """Render text, escaped."""
+    self._Write(cgi.escape(node.args[0]))
+
+  def _RenderParagraphBreak(self, unused_node):
+    """Render a new paragraph."""
+    if self._last_kind not in (None, "ParagraphBreak"):
+      self._Write(u"\n<p>")
+    self._Write(u"\n")
+
+  def _RenderHeaderOpen(self, node):
+    """Render the opening of a header."""
+    self._Write(u"<h{0}>".format(node.args[0]))
+
+  def _RenderHeaderClose(self, node):
+    """Render the closing of a header."""
+    self._Write(u"</h{0}>".format(node.args[0]))
+
+  def _RenderHRule(self, unused_node):
+    """Render a horizontal rule."""
+    self._Write(u"<hr />")
+
+  def _RenderCodeBlockOpen(self, node):
+    """Render the start of a code block."""
+    if node.args[0]:
+      self._Write(u"<pre><code class=\"language-{0}\">".format(
+          cgi.escape(node.args[0], True)))
+    else:
+      self._Write(u"<pre><code>")
+
+  def _RenderCodeBlockClose(self, unused_node):
+    """Render the end of a code block."""
+    self._Write(u"</code></pre>")
+
+  def _RenderListOpen(self, node):
+    """Render the opening of a list item or block quote line."""
+    tag, has_items = self._LIST_TAGS[node.kind]
+    self._OpenListItem(tag, has_items, node.args[0])
+
+  def _RenderListClose(self, unused_node):
+    """Render the closing of a list."""
+    if self._lists:
+      self._CloseList()
+
+  def _RenderFormatOpen(self, node):
+    """Render the opening of bold, italic or strikethrough text."""
+    kind = node.kind[:-len("Open")]
+    self._open_formats.append(kind)
+    self._Write(u"<{0}>".format(self._FORMAT_TAGS[kind]))
+
+  def _RenderFormatClose(self, node):
+    """Render the closing of bold, italic or strikethrough text."""
+    kind = node.kind[:-len("Close")]
+    if kind in self._open_formats:
+      self._open_formats.remove(kind)
+      self._Write(u"</{0}>".format(self._FORMAT_TAGS[kind]))
+
+  def _RenderSuperscript(self, node):
+    """Render superscript text."""
+    self._Write(u"<sup>{0}</sup>".format(cgi.escape(node.args[0])))
+
+  def _RenderSubscript(self, node):
+    """Render subscript text."""
+    self._Write(u"<sub>{0}</sub>".format(cgi.escape(node.args[0])))
+
+  def _RenderInlineCode(self, node):
+    """Render inline code."""
+    self._Write(u"<code>{0}</code>".format(cgi.escape(node.args[0])))
+
+  def _RenderTableCell(self, node):
+    """Render a table cell and its contents."""
+    if not self._table_status:
+      self._Write(u"<table><thead>")
+      self._table_status = "header"
+    if not self._in_table_row:
+      self._Write(u"<tr>")
+      self._in_table_row = True
+
+    tag = u"th" if self._table_status == "header" else u"td"
+    span = node.args[1]
+    if span > 1:
+      self._Write(u"<{0} colspan=\"{1}\">".format(tag, span))
+    else:
+      self._Write(u"<{0}>".format(tag))
+    self._RenderNodes(node.children)
+    self._Write(u"</{0}>".format(tag))
+
+  def _RenderTableRowEnd(self, unused_node):
+    """Render the end of a table row."""
+    if self._in_table_row:
+      self._Write(u"</tr>")
+      self._in_table_row = False
+
+  def _RenderTableHeader(self, unused_node):
+    """Render the end of the table header, after its row."""
+    if self._table_status == "header":
+      self._Write(u"</thead><tbody>")
+      self._table_status = "body"
+
+  def _RenderTableClose(self, unused_node):
+    """Render the end of a table."""
+    self._CloseTable()
+
+  def _RenderLink(self, node):
+    """Render a link."""
+    self._WriteLink(*node.args)
+
+  def _RenderWiki(self, node):
+    """Render a link to a wiki page."""
+    target, text = node.args
+    self._WriteLink(target + self._wiki_extension, text or target)
+
+  def _RenderIssue(self, node):
+    """Render an auto-linked issue, linked to Google Code if possible."""
+    prefix, issue = node.args
+    if self._project:
+      self._WriteLink(
+          u"https://code.google.com/p/{0}/issues/detail?id={1}".format(
+              self._project, issue),
+          u"{0}{1}".format(prefix, issue))
+    else:
+      self._Write(cgi.escape(u"{0}{1}".format(prefix, issue)))
+
+  def _RenderRevision(self, node):
+    """Render an auto-linked revision, linked to Google Code if possible."""
+    prefix, revision = node.args
+    if self._project:
+      self._WriteLink(
+          u"https://code.google.com/p/{0}/source/detail?r={1}".format(
+              self._project, revision),
+          u"{0}{1}".format(prefix, revision))
+    else:
+      self._Write(cgi.escape(u"{0}{1}".format(prefix, revision)))
+
+  def _RenderHtmlOpen(self, node):
+    """Render an opening HTML tag, without its unsafe URLs."""
+    html_tag, params, has_end = node.args
+    core = html_tag + u"".join(
+        u" {0}=\"{1}\"".format(name, cgi.escape(value, True))
+        for name, value in sorted(params.items())
+        if name not in self._URL_ATTRIBUTES or IsSafeUrl(value))
+    if has_end:
+      self._Write(u"<{0} />".format(core))
+    else:
+      self._Write(u"<{0}>".format(core))
+
+  def _RenderHtmlClose(self, node):
+    """Render a closing HTML tag."""
+    self._Write(u"</{0}>".format(node.args[0]))
+
+  def _RenderCommentOpen(self, unused_node):
+    """Render the opening of a comment, which hides its contents."""
+    self._in_comment = True
+
+  def _RenderCommentClose(self, unused_node):
+    """Render the closing of a comment."""
+    self._in_comment = False
+
+  def _RenderVideoOpen(self, node):
+    """Render an embedded YouTube video."""
+    video_id, width, height = node.args
+    self._Write(
+        u"<iframe width=\"{1}\" height=\"{2}\" "
+        u"src=\"https://www.youtube.com/embed/{0}\" allowfullscreen>"
+        u"</iframe>".format(cgi.escape(video_id, True),
+                            cgi.escape(width, True),
+                            cgi.escape(height, True)))
+
+  _NODE_HANDLERS = {
+      "Text": _RenderText,
+      "EscapedText": _RenderText,
+      "ParagraphBreak": _RenderParagraphBreak,
+      "HeaderOpen": _RenderHeaderOpen,
+      "HeaderClose": _RenderHeaderClose,
+      "HRule": _RenderHRule,
+      "CodeBlockOpen": _RenderCodeBlockOpen,
+      "CodeBlockClose": _RenderCodeBlockClose,
+      "NumericListOpen": _RenderListOpen,
+      "BulletListOpen": _RenderListOpen,
+      "BlockQuoteOpen": _RenderListOpen,
+      "ListClose": _RenderListClose,
+      "BoldOpen": _RenderFormatOpen,
+      "BoldClose": _RenderFormatClose,
+      "ItalicOpen": _RenderFormatOpen,
+      "ItalicClose": _RenderFormatClose,
+      "StrikethroughOpen": _RenderFormatOpen,
+      "StrikethroughClose": _RenderFormatClose,
+      "Superscript": _RenderSuperscript,
+      "Subscript": _RenderSubscript,
+      "InlineCode": _RenderInlineCode,
+      "TableCell": _RenderTableCell,
+      "TableRowEnd": _RenderTableRowEnd,
+      "TableHeader": _RenderTableHeader,
+      "TableClose": _RenderTableClose,
+      "Link": _RenderLink,
+      "Wiki": _RenderWiki,
+      "Issue": _RenderIssue,
+      "Revision": _RenderRevision,
+      "HtmlOpen": _RenderHtmlOpen,
+      "HtmlClose": _RenderHtmlClose,
+      "CommentOpen": _RenderCommentOpen,
+      "CommentClose": _RenderCommentClose,
+      "VideoOpen": _RenderVideoOpen,
+  }
+
+
+class TextRenderer(_Renderer):
+  """Renders a document to plain text, e.g. for search indexing.
+
+  Only the text of the page is kept: markup, comments and embedded content
+  are dropped, links are replaced by their description and table cells are
+  separated by tabs.
+  """
+
+  def __init__(self):
+    """Create a text renderer."""
+    self._output = None
+
+  def _Start(self):
+    """Reset the rendering state, to start rendering a document."""
+    self._in_comment = False
+    self._table_row_cells = 0  # The number of cells of the table row so far.
+
+  def _Write(self, text):
+    """Write text, unless in a comment.
+
+    Args:
+        text: The text to write.
+    """
+    if not self._in_comment:
+      self._output.write(text)
+
+  def _RenderText(self, node):
+    """Render text, or the text of inline formatting."""
+    self._Write(node.args[0])
+
+  def _RenderParagraphBreak(self, unused_node):
+    """Render a new paragraph."""
+    self._Write(u"\n")
+
+  def _RenderTableCell(self, node):
+    """Render the contents of a table cell."""
+    if self._table_row_cells:
+      self._Write(u"\t")
+    self._table_row_cells += 1
+    self._RenderNodes(node.children)
+
+  def _RenderTableRowEnd(self, unused_node):
+    """Render the end of a table row, or of the table."""
+    self._table_row_cells = 0
+
+  def _RenderLink(self, node):
+    """Render the description of a link, or else its target."""
+    target, description = node.args
+    self._Write(description or target)
+
+  def _RenderNumber(self, node):
+    """Render an auto-linked issue or revision, as in the page."""
+    self._Write(u"{0}{1}".format(*node.args))
+
+  def _RenderCommentOpen(self, unused_node):
+    """Render the opening of a comment, which hides its contents."""
+    self._in_comment = True
+
+  def _RenderCommentClose(self, unused_node):
+    """Render the closing of a comment."""
+    self._in_comment = False
+
+  _NODE_HANDLERS = {
+      "Text": _RenderText,
+      "EscapedText": _RenderText,
+      "Superscript": _RenderText,
+      "Subscript": _RenderText,
+      "InlineCode": _RenderText,
+      "ParagraphBreak": _RenderParagraphBreak,
+      "TableCell": _RenderTableCell,
+      "TableRowEnd": _RenderTableRowEnd,
+      "TableClose": _RenderTableRowEnd,
+      "Link": _RenderLink,
+      "Wiki": _RenderLink,
+      "Issue": _RenderNumber,
+      "Revision": _RenderNumber,
+      "CommentOpen": _RenderCommentOpen,
+      "CommentClose": _RenderCommentClose,
+  }
@@ -0,0 +1,395 @@
+# Copyright 2014 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Splits Wiki text into the matches of the formatting rules."""
+import re
+
+from . import constants
+
+
+# The pieces of the delimited text rules, matched one at a time.
+_SPACE_RE = re.compile(r"\s", re.UNICODE)
+_SPACES_RE = re.compile(r"\s+", re.UNICODE)
+_NON_SPACES_RE = re.compile(r"\S+", re.UNICODE)
+_URL_SCHEMA_RE = re.compile(r"{0}://".format(constants.URL_SCHEMA_RULE))
+_URL_BRACKET_RUN_RE = re.compile(r"[^]\s]*", re.UNICODE)
+_PAGENAME_START_RE = re.compile(r"[A-Za-z0-9]")
+_PAGENAME_RUN_RE = re.compile(r"[A-Za-z0-9_]*")
+_XALPHA_RE = re.compile(constants.XALPHA_RULE)
+_PLUGIN_START_RE = re.compile(r"<{0}".format(constants.PLUGIN_ID), re.UNICODE)
+_PLUGIN_PARAM_START_RE = re.compile(
+    r"\s+{0}\s*=\s*".format(constants.PLUGIN_NAME), re.UNICODE)
+_PLUGIN_CLOSE_RE = re.compile(r"\s*/?>", re.UNICODE)
+
+
+def Tokenize(match_regex, line):
+  """Find the matches of the formatting rules in a line.
+
+  Args:
+      match_regex: The regex of the rules, each a named group.
+      line: The line to match, without newline.
+  Returns:
+      An iterator of a tuple for each match: its start, its end, the name of
+      the rule and the text of the rule's group.
+  """
+  if match_regex is constants.TEXT_FORMAT_RE and "\n" not in line:
+    return TextTokenizer(line).Tokenize()
+  return _TokenizeRegex(match_regex, line)
+
+
+def FindPlugins(text):
+  """Find the plugin-like tags in text, as PLUGIN_RE or PLUGIN_END_RE would.
+
+  Args:
+      text: The text to search, which may contain newlines.
+  Returns:
+      An iterator of the start and end of each tag, as found by repeatedly
+      searching the text after the previous one.
+  """
+  return TextTokenizer(text).FindPlugins()
+
+
+def _TokenizeRegex(match_regex, line):
+  """Find the matches of the formatting rules in a line with a regex."""
+  for fullmatch in match_regex.finditer(line):
+    # Each rule is a named group and only one matches, the last group.
+    rulename = fullmatch.lastgroup
+    yield (fullmatch.start(), fullmatch.end(), rulename,
+           fullmatch.group(rulename))
+
+
+class TextTokenizer(object):
+  """Finds the same matches as TEXT_FORMAT_RE, in linear time.
+
+  TEXT_FORMAT_SCAN_RE finds the rules that never scan far without matching.
+  At the opening delimiter of a delimited rule, the rule is matched here,
+  following the same backtracking order as the regex engine. The closing
+  delimiters and the failed matches of the line are remembered, so that no
+  part of the line is scanned again for each opening delimiter.
+  """
+
+  def __init__(self, line):
+    """Create a tokenizer.
+
+    Args:
+        line: The line to tokenize. Tokenize needs a line without newline,
+            as the rules don't match across lines.
+    """
+    self._line = line
+    self._last_positions = {}  # Last position of each closing delimiter.
+    self._url_run = (0, 0)  # Last run of a bracketed URL, see _MatchUrl.
+    self._description_ends = {}  # Cache of _MatchDescription.
+    self._anchor_ends = {}  # Cache of _MatchAnchor.
+    self._failed_plugin_tails = set()  # Positions _MatchPluginTail failed at.
+
+  def Tokenize(self):
+    """Find the matches of the text formatting rules.
+
+    Returns:
+        An iterator of a tuple for each match: its start, its end, the name
+        of the rule and the text of the rule's group.
+    """
+    pos = 0
+    while True:
+      fullmatch = constants.TEXT_FORMAT_SCAN_RE.search(self._line, pos)
+      if not fullmatch:
+        return
+
+      rulename = fullmatch.lastgroup
+      if rulename != "Opener":
+        yield (fullmatch.start(), fullmatch.end(), rulename,
+               fullmatch.group(rulename))
+        pos = fullmatch.end()
+        continue
+
+      # No other rule starts with an opening delimiter.
+      token = self._MatchDelimited(fullmatch.start())
+      if token:
+        yield token
+        pos = token[1]
+      else:
+        pos = fullmatch.start() + 1
+
+  def FindPlugins(self):
+    """Find the matches of the plugin rules only.
+
+    Returns:
+        An iterator of the start and end of each match.
+    """
+    start = self._line.find("<")
+    while start != -1:
+      match = self._MatchTag(start)
+      if match:
+        yield start, match[0]
+        start = self._line.find("<", match[0])
+      else:
+        start = self._line.find("<", start + 1)
+
+  def _LastPosition(self, delimiter):
+    """Returns the last position of a delimiter in the line, or -1."""
+    if delimiter not in self._last_positions:
+      self._last_positions[delimiter] = self._line.rfind(delimiter)
+    return self._last_positions[delimiter]
+
+  def _MatchDelimited(self, start):
+    """Match the delimited rules at an opening delimiter, in rule order.
+
+    Args:
+        start: The position of the opening delimiter.
+    Returns:
+        The token of the match, or None if none of the rules match.
+    """
+    line = self._line
+    if line[start] == "{":
+      end = self._MatchInlineCode2(start)
+      if end:
+        return (start, end, "InlineCode2", line[start + 3:end - 3])
+    elif line[start] == "[":
+      end = self._MatchUrlBracket(start)
+      if end:
+        return (start, end, "UrlBracket", line[start:end])
+      end = self._MatchWikiWordBracket(start)
+      if end:
+        return (start, end, "WikiWordBracket", line[start:end])
+    else:
+      match = self._MatchTag(start)
+      if match:
+        end, rulename = match
+        return (start, end, rulename, line[start:end])
+    return None
+
+  def _MatchTag(self, start):
+    """Match a plugin, or else a plugin end.
+
+    Args:
+        start: The position of the opening angle bracket.
+    Returns:
+        The end of the match and the name of the rule, or None.
+    """
+    end = self._MatchPlugin(start)
+    if end:
+      return end, "Plugin"
+    fullmatch = constants.PLUGIN_END_RE.match(self._line, start)
+    if fullmatch:
+      return fullmatch.end(), "PluginEnd"
+    return None
+
+  def _MatchInlineCode2(self, start):
+    """Match {{{code}}}, the code ends at the first }}} after a character."""
+    if self._LastPosition("}}}") < start + 4:
+      return None
+    return self._line.find("}}}", start + 4) + 3
+
+  def _MatchUrlBracket(self, start):
+    """Match [url description].
+
+    Args:
+        start: The position of the opening bracket.
+    Returns:
+        The end of the match, or None.
+    """
+    if self._LastPosition("]") < start:
+      return None
+
+    # mailto:// matches both schemas, the first one is tried first.
+    url_starts = []
+    fullmatch = _URL_SCHEMA_RE.match(self._line, start + 1)
+    if fullmatch:
+      url_starts.append(fullmatch.end())
+    if self._line.startswith("mailto:", start + 1):
+      url_starts.append(start + 1 + len("mailto:"))
+
+    for url_start in url_starts:
+      end = self._MatchUrl(url_start)
+      if end:
+        return end
+    return None
+
+  def _MatchUrl(self, url_start):
+    """Match the rest of a bracketed URL, after its schema.
+
+    The URL takes all the characters up to a bracket or a space. Shorter
+    URLs are followed by another URL character, so only the longest can
+    match.
+
+    Args:
+        url_start: The position after the schema.
+    Returns:
+        The end of the match, or None.
+    """
+    # The URLs of successive opening brackets often end at the same place.
+    run_start, run_end = self._url_run
+    if not run_start <= url_start < run_end:
+      run_end = _URL_BRACKET_RUN_RE.match(self._line, url_start).end()
+      self._url_run = (url_start, run_end)
+
+    if run_end == url_start or run_end == len(self._line):
+      return None
+    if self._line[run_end] == "]":
+      return run_end + 1
+    return self._MatchDescription(run_end)
+
+  def _MatchDescription(self, start):
+    """Match a description, then the closing bracket.
+
+    The description is whitespace then at least one other character, up to
+    the first closing bracket.
+
+    Args:
+        start: The position of the whitespace.
+    Returns:
+        The end of the match, or None.
+    """
+    if start not in self._description_ends:
+      end = None
+      if self._LastPosition("]") >= start:
+        text_start = _SPACES_RE.match(self._line, start).end()
+        bracket = self._line.find("]", text_start)
+        # The description text can take the last space if it must.
+        if bracket > text_start or (bracket == text_start and
+                                    text_start - start >= 2):
+          end = bracket + 1
+      self._description_ends[start] = end
+    return self._description_ends[start]
+
+  def _MatchClose(self, pos):
+    """Match the optional description, then the closing bracket.
+
+    Args:
+        pos: The position after the link target.
+    Returns:
+        The end of the match, or None.
+    """
+    if pos >= len(self._line):
+      return None
+    if self._line[pos] == "]":
+      return pos + 1
+    if _SPACE_RE.match(self._line, pos):
+      return self._MatchDescription(pos)
+    return None
+
+  def _MatchWikiWordBracket(self, start):
+    """Match [WikiWord#anchor description].
+
+    The page name takes all the word characters and must end with a letter
+    or digit; any shorter name is followed by a word character, which
+    nothing else in the rule accepts.
+
+    Args:
+        start: The position of the opening bracket.
+    Returns:
+        The end of the match, or None.
+    """
+    if self._LastPosition("]") < start:
+      return None
+
+    pos = start + 1
+    if _PAGENAME_START_RE.match(self._line, pos):
+      pos = _PAGENAME_RUN_RE.match(self._line, pos).end()
+      if self._line[pos - 1] == "_":
+        return None
+
+    if pos < len(self._line) and self._line[pos] == "#":
+      return self._MatchAnchor(pos + 1)
+    return self._MatchClose(pos)
+
+  def _MatchAnchor(self, pos):
+    """Match the lazy anchor characters, then the rest of the link.
+
+    Args:
+        pos: The position after the #.
+    Returns:
+        The end of the match, or None.
+    """
+    # Every position walked past has the same outcome, the anchors of the
+    # following opening brackets would walk the same way.
+    walked = []
+    while pos not in self._anchor_ends:
+      walked.append(pos)
+      end = self._MatchClose(pos)
+      if end or not _XALPHA_RE.match(self._line, pos):
+        self._anchor_ends[pos] = end
+        break
+      pos += 1
+
+    end = self._anchor_ends[pos]
+    for walked_pos in walked:
+      self._anchor_ends[walked_pos] = end
+    return end
+
+  def _MatchPlugin(self, start):
+    """Match <plugin param=value ...>.
+
+    Args:
+        start: The position of the opening angle bracket.
+    Returns:
+        The end of the match, or None.
+    """
+    fullmatch = _PLUGIN_START_RE.match(self._line, start)
+    if not fullmatch:
+      return None
+    return self._MatchPluginTail(fullmatch.end())
+
+  def _GetPluginValueEnds(self, pos):
+    """Get the possible ends of the next parameter of a plugin.
+
+    Args:
+        pos: The position after the plugin ID or the previous parameter.
+    Returns:
+        The ends of the parameter value, in the order the regex engine
+        tries them: the quoted value, then the longest unquoted value first.
+    """
+    fullmatch = _PLUGIN_PARAM_START_RE.match(self._line, pos)
+    if not fullmatch:
+      return []
+
+    value_start = fullmatch.end()
+    ends = []
+    if self._line.startswith(("\"", "'"), value_start):
+      quote = self._line.find(self._line[value_start], value_start + 1)
+      if quote != -1:
+        ends.append(quote + 1)
+    fullmatch = _NON_SPACES_RE.match(self._line, value_start)
+    if fullmatch:
+      ends.extend(xrange(fullmatch.end(), value_start, -1))
+    return ends
+
+  def _MatchPluginTail(self, pos):
+    """Match the parameters of a plugin, then the closing angle bracket.
+
+    This is a depth-first search of the parameter values, which remembers
+    the positions it failed from: whichever plugin they are reached from,
+    they fail again.
+
+    Args:
+        pos: The position after the plugin ID.
+    Returns:
+        The end of the match, or None.
+    """
+    failed = self._failed_plugin_tails
+    stack = [(pos, iter(self._GetPluginValueEnds(pos)))]
+    while stack:
+      pos, value_ends = stack[-1]
+      for value_end in value_ends:
+        if value_end not in failed:
+          stack.append((value_end,
+                        iter(self._GetPluginValueEnds(value_end))))
+          break
+      else:
+        # No more parameters, the plugin must close here.
+        stack.pop()
+        fullmatch = _PLUGIN_CLOSE_RE.match(self._line, pos)
+        if fullmatch:
+          return fullmatch.end()
+        failed.add(pos)
+    return None
@@ -27,15 +27,19 @@
 import argparse
 
 import codecs
+import functools
 import os
 import sys
 
+from impl import batch_converter as batch_converter_mod
 from impl import converter as converter_mod
 from impl import formatting_handler as formatting_handler_mod
+from impl import page_index as page_index_mod
 from impl import pragma_handler as pragma_handler_mod
 
 
-def PrintWarning(input_line, message):
+def PrintWarning(input_line, message, input_file="input file",
+                 log_stream=None):
   """Print a warning.
 
   When a conversion cannot be done or may be unreliable/inexact,
@@ -44,8 +48,55 @@ def PrintWarning(input_line, message):
   Args:
     input_line: The line number this warning occurred on.
     message: The warning message.
+    input_file: The name of the file the warning occurred in.
+    log_stream: The stream to print to, defaults to stdout.
   """
-  print u"Warning (line {0} of input file):\n{1}\n".format(input_line, message)
+  print >>(log_stream or sys.stdout), (
+      u"Warning (line {0} of {1}):\n{2}\n".format(
+          input_line, input_file, message))
+
+
+def ConvertTree(input_dir, project, wikipages, symmetric_headers, processes,
+                write_page, log_stream=None):
+  """Convert all the wiki pages in a directory tree.
+
+  The results are reported in page order, whatever the number of processes.
+
+  Args:
+    input_dir: The root of the tree of wiki pages.
+    project: The name of the project for the Wiki.
+    wikipages: The PageIndex of the additional wiki pages assumed to exist
+        for auto-linking. The pages of the tree are added to it.
+    symmetric_headers: True if header denotations are symmetric.
+    processes: The number of processes converting pages.
+    write_page: A function called with the PageResult of every page
+        converted successfully.
+    log_stream: The stream to print progress and warnings to, defaults to
+        stdout in UTF-8.
+
+  Returns:
+    The number of pages that failed to convert.
+  """
+  log_stream = log_stream or codecs.getwriter("utf-8")(sys.stdout)
+  pages = batch_converter_mod.FindPages(input_dir)
+  for page in pages:
+    wikipages.Add(batch_converter_mod.GetPageName(page))
+
+  failures = 0
+  for result in batch_converter_mod.ConvertPages(
+      input_dir, pages, project, wikipages, symmetric_headers, processes):
+    print >>log_stream, u"Converted {0}".format(result.page)
+    for input_line, message in result.warnings:
+      PrintWarning(input_line, message, result.page, log_stream)
+    if result.error:
+      print >>log_stream, u"Error converting {0}:\n{1}".format(
+          result.page, result.error)
+      failures += 1
+    else:
+      write_page(result)
+  print >>log_stream, u"Converted {0} pages, {1} failed.".format(
+      len(pages), failures)
+  return failures
 
 
 def main(args):
@@ -58,10 +109,36 @@ def main(args):
       description="Converts a Google Code wiki page to GitHub-flavored "
       "Markdown.")
 
-  parser.add_argument("--input_file", required=True,
-                      help="The input Google Code Wiki file")
-  parser.add_argument("--output_file", required=True,
-                      help="The output GitHub-flavored Markdown file")
+  parser.add_argument("--input_file", required=False,
+                      help="The input Google Code Wiki file, or - for stdin")
+  parser.add_argument("--output_file", required=False,
+                      help="The output GitHub-flavored Markdown file, or - "
+                      "for stdout")
+  parser.add_argument("--input_dir", required=False,
+                      help="Convert all the .wiki files in this directory "
+                      "tree instead of a single file, each to a .md file")
+  parser.add_argument("--output_dir", required=False,
+                      help="The root of the tree to write the .md files of "
+                      "--input_dir to, defaults to --input_dir")
+  parser.add_argument("--processes", required=False, type=int,
+                      help="The number of processes converting the pages of "
+                      "--input_dir, defaults to the number of CPUs")
+  parser.add_argument("--fast_import", action="store_true",
+                      help="Write the pages of --input_dir as a git "
+                      "fast-import stream to stdout, replacing each .wiki "
+                      "file by its .md file, instead of writing .md files. "
+                      "--input_dir must be the root of the git repository. "
+                      "If any page fails to convert, the stream is left "
+                      "unfinished so that nothing is committed")
+  parser.add_argument("--fast_import_squash", action="store_true",
+                      help="Commit all the pages at once rather than one "
+                      "commit per page")
+  parser.add_argument("--fast_import_branch",
+                      default=batch_converter_mod.DEFAULT_BRANCH,
+                      help="The existing branch to commit to")
+  parser.add_argument("--fast_import_committer",
+                      default=batch_converter_mod.DEFAULT_COMMITTER,
+                      help="The committer of the commits, as 'Name <email>'")
   parser.add_argument("--project", required=False,
                       help="The name of the project for the Wiki")
   parser.add_argument("--wikipages_list", nargs="*",
@@ -71,6 +148,11 @@ def main(args):
                       help="The list of paths containing wiki pages that are "
                       "assumed to exist for the purpose of auto-linking to "
                       "other pages")
+  parser.add_argument("--wikipages_index_path", required=False,
+                      help="A file caching the wiki pages assumed to exist. "
+                      "If it exists it is used instead of scanning "
+                      "--wikipages_path, otherwise it is written after the "
+                      "scan")
   symmetric_headers_help = ("Controls if the output of header level "
                             "indicators are made symmetric. E.g. '### Header' "
                             "if disabled, and '### Header ###' if enabled")
@@ -82,40 +164,95 @@ def main(args):
 
   parsed_args, unused_unknown_args = parser.parse_known_args(args)
 
-  with codecs.open(parsed_args.input_file, "rU", "utf-8") as input_stream:
-    with codecs.open(parsed_args.output_file, "wU", "utf-8") as output_stream:
-      # Create the master list of wiki pages assumed to exist.
-      wikipages = parsed_args.wikipages_list or []
-      wikipages.append(parsed_args.input_file)
+  # Create the master index of wiki pages assumed to exist.
+  index_path = parsed_args.wikipages_index_path
+  if index_path and os.path.exists(index_path):
+    wikipages = page_index_mod.PageIndex.Load(index_path)
+  else:
+    wikipages = page_index_mod.PageIndex()
+    # Add all the .wiki files in all the given paths.
+    for path in parsed_args.wikipages_path or []:
+      wikipages.AddDirectory(path)
+    if index_path:
+      wikipages.Save(index_path)
+  for page in parsed_args.wikipages_list or []:
+    wikipages.Add(page)
+
+  if parsed_args.input_dir and parsed_args.fast_import:
+    # The stream goes to stdout, so report to stderr.
+    writer = batch_converter_mod.FastImportWriter(
+        sys.stdout,
+        parsed_args.fast_import_branch,
+        parsed_args.fast_import_committer,
+        squash=parsed_args.fast_import_squash)
+    failures = ConvertTree(
+        parsed_args.input_dir,
+        parsed_args.project,
+        wikipages,
+        parsed_args.symmetric_headers,
+        parsed_args.processes,
+        writer.AddPage,
+        codecs.getwriter("utf-8")(sys.stderr))
+    if failures:
+      # Commit either all the pages or none.
+      writer.Abort()
+      return 1
+    writer.Close()
+    return 0
+
+  if parsed_args.input_dir:
+    output_dir = parsed_args.output_dir or parsed_args.input_dir
+    failures = ConvertTree(
+        parsed_args.input_dir,
+        parsed_args.project,
+        wikipages,
+        parsed_args.symmetric_headers,
+        parsed_args.processes,
+        lambda result: batch_converter_mod.WritePage(output_dir, result))
+    return 1 if failures else 0
+
+  if not parsed_args.input_file or not parsed_args.output_file:
+    parser.error("--input_file and --output_file are required without "
+                 "--input_dir")
 
-      if parsed_args.wikipages_path:
-        # Add all the .wiki files in all the given paths.
-        for path in parsed_args.wikipages_path:
-          for f in os.listdir(path):
-            if f.endswith(".wiki"):
-              wikipages.append(f[:-len(".wiki")])
+  if parsed_args.input_file == "-":
+    input_stream = codecs.getreader("utf-8")(sys.stdin)
+  else:
+    input_stream = codecs.open(parsed_args.input_file, "rU", "utf-8")
+  warning_method = PrintWarning
+  if parsed_args.output_file == "-":
+    output_stream = codecs.getwriter("utf-8")(sys.stdout)
+    # The output goes to stdout, so warn on stderr.
+    warning_method = functools.partial(
+        PrintWarning, log_stream=codecs.getwriter("utf-8")(sys.stderr))
+  else:
+    output_stream = codecs.open(parsed_args.output_file, "wU", "utf-8")
+  with input_stream:
+    with output_stream:
+      wikipages.Add(parsed_args.input_file)
 
       # Fill this will a mapping from Google Code issue
       # to GitHub issue to automate that conversion.
       issue_map = {}
 
       # Prepare the handlers and converter.
-      pragma_handler = pragma_handler_mod.PragmaHandler(PrintWarning)
+      pragma_handler = pragma_handler_mod.PragmaHandler(warning_method)
       formatting_handler = formatting_handler_mod.FormattingHandler(
-          PrintWarning,
+          warning_method,
           parsed_args.project,
           issue_map,
           parsed_args.symmetric_headers)
       converter = converter_mod.Converter(
           pragma_handler,
           formatting_handler,
-          PrintWarning,
+          warning_method,
           parsed_args.project,
           wikipages)
 
       # And perform the conversion.
       converter.Convert(input_stream, output_stream)
+  return 0
 
 
 if __name__ == "__main__":
-  main(sys.argv)
+  sys.exit(main(sys.argv))
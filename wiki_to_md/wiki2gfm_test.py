@@ -13,12 +13,26 @@
 # limitations under the License.
 """Tests for wiki2gfm."""
 import codecs
+import os
+import pickle
+import random
+import re
+import shutil
 import StringIO
+import tempfile
 import unittest
 
+from impl import batch_converter
+from impl import constants
 from impl import converter
+from impl import document
 from impl import formatting_handler
+from impl import output_builder
+from impl import page_index
 from impl import pragma_handler
+from impl import renderers
+from impl import tokenizer
+import wiki2gfm
 
 
 class BaseTest(unittest.TestCase):
@@ -787,6 +801,23 @@ class TestFormattingHandler(BaseTest):
     self.assertOutput("**_xyz_** <a>")
     self.assertNoWarnings()
 
+  def testHandleEscapedTextPlugins(self):
+    self.formatting_handler.HandleEscapedText(
+        1, self.output, "<a b=<c>> </a> <x y='1 2'/> a<b </a><b>     \n")
+
+    self.assertOutput("&lt;a b=&lt;c&gt;&gt; &lt;/a&gt; &lt;x y='1 2'/&gt; "
+                      "a<b &lt;/a&gt;&lt;b&gt; \n")
+    self.assertNoWarnings()
+
+  def testLongFormattedSpan(self):
+    self.formatting_handler.HandleBoldOpen(1, self.output)
+    for _ in xrange(1000):
+      self.formatting_handler.HandleText(1, self.output, "ab ")
+    self.formatting_handler.HandleBoldClose(1, self.output)
+
+    self.assertOutput("**" + "ab " * 999 + "ab**")
+    self.assertNoWarnings()
+
 
 class TestConverter(BaseTest):
   """Tests the converter."""
@@ -798,6 +829,456 @@ class TestConverter(BaseTest):
 
         self.assertOutput(example_output.read())
 
+  def testStreamsInput(self):
+    lines_read = []
+
+    def ReadLines():
+      for line in [u"#summary Test\n", u"\n", u"Some *text*\n"]:
+        lines_read.append(line)
+        yield line
+
+    lines = ReadLines()
+    self.converter.Convert(lines, self.output)
+
+    self.assertOutput(u"Some **text**")
+    self.assertEqual(3, len(lines_read))
+    self.assertEqual(None, next(lines, None))
+
+  def testEveryRuleHasAHandler(self):
+    rulenames = (constants.LINE_FORMAT_RE.groupindex.keys() +
+                 constants.TEXT_FORMAT_RE.groupindex.keys())
+    self.assertItemsEqual(rulenames, converter.Converter._RULE_HANDLERS.keys())
+
+  def _ConvertLines(self, lines):
+    self.setUp()
+    self.converter.Convert(lines, self.output)
+    return self.output.getvalue(), self.warnings
+
+  def testPlainLinesSameAsFullRules(self):
+    words = [u"plain", u"Text", u"a-b", u"=", u"-", u"*", u"_", u"~~", u"^",
+             u",,", u"`", u"{{{", u"}}}", u"||", u"http://x.y", u"[", u"]",
+             u"<b>", u"%%v%%", u"issue 1", u"r2", u"WikiWord", u"TestPage",
+             u"\u00e9", u"\u0b95\t", u"!", u"#", u"  ", u"\t"]
+    rand = random.Random(1)
+    lines = []
+    for _ in xrange(2000):
+      lines.append(u" ".join(rand.choice(words)
+                             for _ in xrange(rand.randint(0, 4))) + u"\n")
+      if rand.random() < 0.2:
+        lines.append(rand.choice([u"\n", u"  * item\n", u"{{{\n",
+                                  u"}}}\n", u"<code>\n", u"</code>\n"]))
+
+    with_prescan = self._ConvertLines(lines)
+    prescan_re = constants.TEXT_FORMAT_PRESCAN_RE
+    constants.TEXT_FORMAT_PRESCAN_RE = re.compile("")
+    try:
+      without_prescan = self._ConvertLines(lines)
+    finally:
+      constants.TEXT_FORMAT_PRESCAN_RE = prescan_re
+
+    self.assertEqual(without_prescan, with_prescan)
+
+  def testWriteOnlyOutput(self):
+    class WriteOnlyStream(object):
+
+      def __init__(self):
+        self.chunks = []
+
+      def write(self, text):
+        self.chunks.append(text)
+
+    output = WriteOnlyStream()
+    self.converter.Convert(
+        [u"||a\u00e9\u00e9||b||\n", u"||\u00e9||c||\n"], output)
+
+    self.assertEqual(u"|a\u00e9\u00e9|b|\n|:--|:|\n|\u00e9  |c|",
+                     u"".join(output.chunks))
+
+  def testStreamsPragmasOnly(self):
+    self.converter.Convert(iter([u"#summary Test\n"]), self.output)
+
+    self.assertOutput(u"")
+    self.assertWarning("A summary pragma was used")
+
+
+class TestOutputBuilder(unittest.TestCase):
+  """Tests collecting the output in blocks."""
+
+  def setUp(self):
+    self.stream = StringIO.StringIO()
+    self.builder = output_builder.OutputBuilder(self.stream, block_size=3)
+
+  def testWritesWholeBlocks(self):
+    self.builder.write(u"a")
+    self.builder.write("b")
+    self.builder.EndBlock()
+    self.assertEqual("", self.stream.getvalue())
+
+    self.builder.write(u"\u00e9")
+    self.builder.EndBlock()
+    self.assertEqual(u"ab\u00e9", self.stream.getvalue())
+
+    self.builder.write("c")
+    self.builder.Flush()
+    self.builder.Flush()
+    self.assertEqual(u"ab\u00e9c", self.stream.getvalue())
+
+  def testGetValue(self):
+    builder = output_builder.OutputBuilder()
+    self.assertEqual("", builder.GetValue())
+    builder.write("a")
+    builder.write("b")
+    self.assertEqual("ab", builder.GetValue())
+    builder.write("c")
+    builder.Flush()
+    self.assertEqual("abc", builder.GetValue())
+
+
+class TestTokenizer(unittest.TestCase):
+  """Tests the tokenizer against the formatting rule regexes."""
+
+  # Fragments of the delimited rules, and of the rules next to them.
+  FRAGMENTS = [u"{{{", u"}}}", u"[", u"]", u"<", u">", u"/>", u"</", u" ",
+               u"  ", u"\t", u"\u00a0", u"a", u"B", u"_", u"#", u"=", u"\"",
+               u"'", u"http://", u"mailto:", u"mailto://", u"Wiki", u"Word",
+               u"*", u"||", u"`", u"^", u",,", u"%%", u"issue 4", u"r12",
+               u"-", u":", u"b=", u"ns:", u"!", u"\u00e9", u"1", u".", u"~~"]
+
+  def _RandomLines(self, count):
+    rand = random.Random(1)
+    for _ in xrange(count):
+      yield u"".join(rand.choice(self.FRAGMENTS)
+                     for _ in xrange(rand.randint(0, 25)))
+
+  def _RegexTokens(self, regex, line):
+    return [(fullmatch.start(), fullmatch.end(), fullmatch.lastgroup,
+             fullmatch.group(fullmatch.lastgroup))
+            for fullmatch in regex.finditer(line)]
+
+  def testSameAsTextFormatRegex(self):
+    for line in self._RandomLines(20000):
+      self.assertEqual(
+          self._RegexTokens(constants.TEXT_FORMAT_RE, line),
+          list(tokenizer.Tokenize(constants.TEXT_FORMAT_RE, line)),
+          repr(line))
+
+  def testQuadraticRegexInputs(self):
+    # TEXT_FORMAT_RE takes quadratic time on long repeats of these.
+    for fragment in [u"{{{", u"x[ b=", u"[#a", u"[http://a ", u"  b=<a",
+                     u"<a b='"]:
+      line = fragment * 200
+      self.assertEqual(
+          self._RegexTokens(constants.TEXT_FORMAT_RE, line),
+          list(tokenizer.Tokenize(constants.TEXT_FORMAT_RE, line)))
+
+  def testNewlineUsesRegex(self):
+    line = u"{{{a\n}}} [b\nc] {{{d}}}"
+    self.assertEqual(
+        [(9, 14, "WikiWordBracket", u"[b\nc]"),
+         (15, 22, "InlineCode2", u"d")],
+        list(tokenizer.Tokenize(constants.TEXT_FORMAT_RE, line)))
+
+  def testHeadingSameAsRepeatedDelimiters(self):
+    heading_re = re.compile(r"^=+\s*.*\s*=+\s*$", re.UNICODE)
+    line_format_re = constants.LINE_FORMAT_RE
+    for line in self._RandomLines(5000):
+      fullmatch = line_format_re.match(line)
+      self.assertEqual(
+          bool(heading_re.match(line)),
+          bool(fullmatch and fullmatch.lastgroup == "Heading"),
+          repr(line))
+
+
+class TestDocument(unittest.TestCase):
+  """Tests parsing pages into documents and rendering them."""
+
+  _PAGE = [u"= Title =\n", u"\n", u"Some *bold* a < b and TestPage.\n",
+           u"  * item `code`\n", u"\n", u"|| *a* || b ||\n",
+           u"|| c || d ||\n", u"\n", u"<wiki:comment>\n", u"hidden\n",
+           u"</wiki:comment>\n", u"See issue 4.\n"]
+
+  def setUp(self):
+    self.page_converter = batch_converter.PageConverter(
+        "test", ["TestPage"], False)
+
+  def _Render(self, renderer, lines):
+    parsed, _ = self.page_converter.Parse(lines)
+    output = StringIO.StringIO()
+    renderer.Render(parsed, output)
+    return output.getvalue()
+
+  def testGfmSameAsConvert(self):
+    words = [u"plain", u"= a =", u"*", u"_", u"~~", u"^", u",,", u"`",
+             u"{{{", u"}}}", u"||", u"|| x ||", u"http://x.y", u"[", u"]",
+             u"<b>", u"</b>", u"<table>", u"<td>", u"</table>", u"issue 1",
+             u"r2", u"TestPage", u"\u00e9", u"#", u"  *", u"  #", u"----",
+             u"<wiki:comment>", u"</wiki:comment>", u"<wiki:toc>"]
+    rand = random.Random(1)
+    for _ in xrange(200):
+      lines = [u" ".join(rand.choice(words)
+                         for _ in xrange(rand.randint(0, 5))) + u"\n"
+               for _ in xrange(rand.randint(1, 10))]
+
+      output, warnings = self.page_converter.Convert(lines)
+      parsed, parse_warnings = self.page_converter.Parse(lines)
+      parse_warnings = list(parse_warnings)
+      rendered, render_warnings = self.page_converter.RenderGfm(parsed)
+
+      self.assertEqual(output, rendered, repr(lines))
+      self.assertEqual(sorted(warnings),
+                       sorted(parse_warnings + render_warnings))
+
+  def testPickle(self):
+    parsed, _ = self.page_converter.Parse(self._PAGE)
+    self.assertEqual(parsed, pickle.loads(pickle.dumps(parsed, 2)))
+    self.assertNotEqual(parsed, document.Document())
+
+  def testHtmlRenderer(self):
+    self.assertEqual(
+        u"<h1>Title</h1>\n<p>\n\n"
+        u"Some <strong>bold</strong> a &lt; b and "
+        u"<a href=\"TestPage.html\">TestPage</a>.\n"
+        u"<ul><li>item <code>code</code></li></ul>\n<p>\n\n"
+        u"<table><thead><tr><th> <strong>a</strong> </th><th> b </th></tr>"
+        u"</thead><tbody>\n"
+        u"<tr><td> c </td><td> d </td></tr></tbody></table>\n<p>\n"
+        u"\n\nSee <a href=\"https://code.google.com/p/test/issues/detail?"
+        u"id=4\">issue 4</a>.",
+        self._Render(renderers.HtmlRenderer("test"), self._PAGE))
+
+  def testHtmlRendererUnsafeUrls(self):
+    self.assertEqual(
+        u"<a>x</a> <a href=\"http://a.b/\">y</a> <img> "
+        u"<a href=\"page.html\">z</a>",
+        self._Render(renderers.HtmlRenderer("test"), [
+            u"<a href=\"javascript:alert(1)\">x</a> "
+            u"<a href=\"http://a.b/\">y</a> <img src=\" JaVa\tscript:1\"> "
+            u"<a href=\"page.html\">z</a>\n"]))
+
+    links = document.Document([
+        document.Node("Link", 1, (u"javascript:alert(1)", u"click"), None),
+        document.Node("Wiki", 1, (u"data:text/html,x", None), None),
+        document.Node("Link", 1, (u"mailto:a@b", None), None)])
+    output = StringIO.StringIO()
+    renderers.HtmlRenderer("test").Render(links, output)
+    self.assertEqual(
+        u"clickdata:text/html,x<a href=\"mailto:a@b\">mailto:a@b</a>",
+        output.getvalue())
+
+    self.assertFalse(renderers.IsSafeUrl(u"vbscript:x"))
+    self.assertFalse(renderers.IsSafeUrl(u"jav\x00ascript:x"))
+    self.assertTrue(renderers.IsSafeUrl(u"MAILTO:a@b"))
+    self.assertTrue(renderers.IsSafeUrl(u"a/b:c"))
+
+  def testTextRenderer(self):
+    self.assertEqual(
+        u"Title\n\nSome bold a < b and TestPage.\nitem code\n\n"
+        u" a \t b \n c \t d \n\n\nSee issue 4.",
+        self._Render(renderers.TextRenderer(), self._PAGE))
+
+
+class TestPageIndex(unittest.TestCase):
+  """Tests for the index of wiki pages assumed to exist."""
+
+  def setUp(self):
+    self.index = page_index.PageIndex(["TestPage", "OtherPage"])
+
+  def testContains(self):
+    self.assertIn("TestPage", self.index)
+    self.assertNotIn("testpage", self.index)
+    self.assertNotIn("TestPage#Section", self.index)
+    self.assertEqual(2, len(self.index))
+
+  def testFind(self):
+    self.assertEqual("TestPage", self.index.Find("TestPage"))
+    self.assertEqual("TestPage", self.index.Find("testPAGE"))
+    self.assertEqual("OtherPage", self.index.Find("OtherPage#Section"))
+    self.assertEqual(None, self.index.Find("Missing#OtherPage"))
+
+  def testFindPrefersExactCase(self):
+    self.index.Add("Testpage")
+    self.assertEqual("Testpage", self.index.Find("Testpage"))
+    self.assertEqual("TestPage", self.index.Find("TESTPAGE"))
+
+  def testAddDirectoryAndPersist(self):
+    directory = tempfile.mkdtemp()
+    try:
+      for filename in ["Main.wiki", u"\u00c9t\u00e9.wiki", "notes.txt"]:
+        open(os.path.join(directory, filename.encode("utf-8")), "w").close()
+      index = page_index.PageIndex()
+      index.AddDirectory(directory)
+      index_path = os.path.join(directory, "index")
+      index.Save(index_path)
+      loaded = page_index.PageIndex.Load(index_path)
+    finally:
+      shutil.rmtree(directory)
+    self.assertEqual(set(["Main", u"\u00c9t\u00e9"]), set(loaded))
+
+
+class TestBatchConverter(unittest.TestCase):
+  """Tests the batch converter."""
+
+  _PAGES = {
+      "Main.wiki": u"= Main =\n\nSee OtherPage and MissingPage.\n",
+      os.path.join("sub", "OtherPage.wiki"): u"<b>Unclosed *bold\n",
+      "Third.wiki": u"#summary Third\n\n|| a || b ||\n|| c || d ||\n",
+  }
+
+  def setUp(self):
+    self.input_dir = tempfile.mkdtemp()
+    for page, text in self._PAGES.items():
+      path = os.path.join(self.input_dir, page)
+      if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      with codecs.open(path, "w", "utf-8") as page_file:
+        page_file.write(text)
+    os.makedirs(os.path.join(self.input_dir, ".git"))
+    with open(os.path.join(self.input_dir, ".git", "Ignored.wiki"), "w"):
+      pass
+
+  def tearDown(self):
+    shutil.rmtree(self.input_dir)
+
+  def _Convert(self, processes):
+    pages = batch_converter.FindPages(self.input_dir)
+    wikipages = [batch_converter.GetPageName(page) for page in pages]
+    return list(batch_converter.ConvertPages(
+        self.input_dir, pages, "test", wikipages, False, processes))
+
+  def _ConvertAlone(self, page):
+    page_converter = batch_converter.PageConverter(
+        "test", ["Main", "OtherPage", "Third"], False)
+    with codecs.open(os.path.join(self.input_dir, page), "rU",
+                     "utf-8") as input_stream:
+      return page_converter.Convert(input_stream)
+
+  def testFindPages(self):
+    self.assertEqual(["Main.wiki", "Third.wiki",
+                      os.path.join("sub", "OtherPage.wiki")],
+                     batch_converter.FindPages(self.input_dir))
+
+  def testSameAsConvertingAlone(self):
+    results = self._Convert(processes=1)
+    self.assertEqual(batch_converter.FindPages(self.input_dir),
+                     [result.page for result in results])
+    for result in results:
+      self.assertEqual(None, result.error)
+      self.assertEqual(self._ConvertAlone(result.page),
+                       (result.output, result.warnings))
+    self.assertIn("(OtherPage.md)", results[0].output)
+    self.assertNotIn("(MissingPage.md)", results[0].output)
+
+  def testDeterministicWithProcesses(self):
+    self.assertEqual(self._Convert(processes=1), self._Convert(processes=2))
+
+  def testNonAsciiPageName(self):
+    page = u"P\u00e4ge.wiki"
+    with open(batch_converter.EncodePath(
+        os.path.join(self.input_dir, page)), "w") as page_file:
+      page_file.write("See Main.\n")
+    self.assertIn(page, batch_converter.FindPages(self.input_dir))
+
+    log_stream = StringIO.StringIO()
+    output_dir = os.path.join(self.input_dir, "out")
+    failures = wiki2gfm.ConvertTree(
+        self.input_dir, "test", page_index.PageIndex(), False, 2,
+        lambda result: batch_converter.WritePage(output_dir, result),
+        log_stream)
+    self.assertEqual(0, failures)
+    self.assertIn(u"Converted P\u00e4ge.wiki\n", log_stream.getvalue())
+    with codecs.open(batch_converter.EncodePath(
+        os.path.join(output_dir, u"P\u00e4ge.md")), "r",
+                     "utf-8") as output_file:
+      self.assertEqual(u"See Main.", output_file.read())
+
+  def testWritePage(self):
+    output_dir = os.path.join(self.input_dir, "out")
+    result = batch_converter.PageResult(
+        os.path.join("sub", "OtherPage.wiki"), u"\u00e9", [], None)
+    batch_converter.WritePage(output_dir, result)
+    with codecs.open(os.path.join(output_dir, "sub", "OtherPage.md"), "r",
+                     "utf-8") as output_file:
+      self.assertEqual(u"\u00e9", output_file.read())
+
+
+class TestFastImportWriter(unittest.TestCase):
+  """Tests for the git fast-import stream of converted pages."""
+
+  def setUp(self):
+    self.stream = StringIO.StringIO()
+
+  def _AddPages(self, squash):
+    writer = batch_converter.FastImportWriter(
+        self.stream, "refs/heads/main", "A <a@b>", timestamp=42,
+        squash=squash)
+    writer.AddPage(batch_converter.PageResult("Main.wiki", u"\u00e9\n",
+                                              [], None))
+    writer.AddPage(batch_converter.PageResult(
+        os.path.join("sub", "Other.wiki"), u"x\n", [], None))
+    writer.Close()
+    return self.stream.getvalue()
+
+  def testCommitPerPage(self):
+    self.assertEqual(
+        "feature done\n"
+        "blob\nmark :1\ndata 3\n\xc3\xa9\n\n"
+        "commit refs/heads/main\ncommitter A <a@b> 42 +0000\n"
+        "data 17\nConverted Main.md\n"
+        "from refs/heads/main^0\n"
+        "D Main.wiki\nM 100644 :1 Main.md\n\n"
+        "blob\nmark :2\ndata 2\nx\n\n"
+        "commit refs/heads/main\ncommitter A <a@b> 42 +0000\n"
+        "data 18\nConverted Other.md\n"
+        "D sub/Other.wiki\nM 100644 :2 sub/Other.md\n\n"
+        "done\n",
+        self._AddPages(squash=False))
+
+  def testSquash(self):
+    self.assertEqual(
+        "feature done\n"
+        "blob\nmark :1\ndata 3\n\xc3\xa9\n\n"
+        "blob\nmark :2\ndata 2\nx\n\n"
+        "commit refs/heads/main\ncommitter A <a@b> 42 +0000\n"
+        "data 34\nConverted 2 wiki pages to Markdown\n"
+        "from refs/heads/main^0\n"
+        "D Main.wiki\nM 100644 :1 Main.md\n"
+        "D sub/Other.wiki\nM 100644 :2 sub/Other.md\n\n"
+        "done\n",
+        self._AddPages(squash=True))
+
+  def testQuotedPath(self):
+    writer = batch_converter.FastImportWriter(self.stream, squash=True)
+    writer.AddPage(batch_converter.PageResult("\"a\\b.wiki", u"", [], None))
+    writer.Close()
+    self.assertIn("D \"\\\"a\\\\b.wiki\"\nM 100644 :1 \"\\\"a\\\\b.md\"\n",
+                  self.stream.getvalue())
+
+  def testNonAsciiPath(self):
+    writer = batch_converter.FastImportWriter(self.stream, squash=False)
+    writer.AddPage(batch_converter.PageResult(
+        u"P\u00e4ge.wiki".encode("utf-8"), u"", [], None))
+    writer.AddPage(batch_converter.PageResult(u"\u00c9t\u00e9.wiki", u"",
+                                              [], None))
+    writer.Close()
+    self.assertIn("Converted P\xc3\xa4ge.md\n", self.stream.getvalue())
+    self.assertIn("D P\xc3\xa4ge.wiki\nM 100644 :1 P\xc3\xa4ge.md\n",
+                  self.stream.getvalue())
+    self.assertIn("D \xc3\x89t\xc3\xa9.wiki\n"
+                  "M 100644 :2 \xc3\x89t\xc3\xa9.md\n",
+                  self.stream.getvalue())
+
+  def testAbort(self):
+    writer = batch_converter.FastImportWriter(self.stream, squash=True)
+    writer.AddPage(batch_converter.PageResult("Main.wiki", u"x", [], None))
+    writer.Abort()
+    self.assertTrue(self.stream.getvalue().startswith("feature done\n"))
+    self.assertNotIn("commit", self.stream.getvalue())
+    self.assertNotIn("done\n", self.stream.getvalue()[len("feature done"):])
+
+  def testNoPages(self):
+    batch_converter.FastImportWriter(self.stream).Close()
+    self.assertEqual("", self.stream.getvalue())
+
 
 if __name__ == "__main__":
   unittest.main()